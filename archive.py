@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# =============== أرشفة الطلبات القديمة ===============
+# الطلبات المنتهية (وصل الكود/أُلغيت/انتهت مهلتها) والمسوّاة في دفتر الرصيد،
+# الأقدم من after_days، تُنقل على دفعات من orders إلى ملفات SQLite شهرية
+# (orders-YYYY-MM.db) لا يُكتب فيها إلا إلحاقًا. فيبقى الجدول الساخن وفهارسه
+# بحجم الطلبات الحديثة فقط. عدّادات stats تراكمية فلا تتأثر، وملخص كل مستخدم
+# يُجمَّع في archived_user_stats فتبقى «الإحصائيات» بقراءة واحدة. البحث برقم
+# الطلب أو المستخدم يمر على الجدول الساخن ثم على الأرشيف عند الحاجة.
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import metrics
+from db import DB, read, write, _ORDER_COLS
+
+log = logging.getLogger(__name__)
+
+FINAL = ("CODE_RECEIVED", "CANCELED", "TIMEOUT")
+
+ARCHIVED = metrics.register(metrics.Counter("bot_orders_archived_total", "Orders moved to the monthly archive"))
+
+_ARCHIVE_SCHEMA = f"""CREATE TABLE IF NOT EXISTS arch.orders(
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    provider TEXT,
+    country TEXT,
+    service TEXT,
+    phone TEXT,
+    price REAL,
+    status TEXT,
+    created_at TEXT,
+    ext_id TEXT,
+    chat_id INTEGER,
+    message_id INTEGER,
+    code TEXT
+)"""
+
+
+def _path(directory, month):
+    return os.path.join(directory, f"orders-{month}.db")
+
+
+def _archive_batch(con, directory, cutoff, limit):
+    """نقل حتى limit طلبًا؛ يعيد عدد المنقول (0 = لا شيء متبقٍ)."""
+    marks = ",".join("?" * len(FINAL))
+    rows = con.execute(f"""SELECT id, substr(created_at,1,7) FROM orders
+        WHERE created_at<? AND status IN ({marks})
+          AND (NOT EXISTS(SELECT 1 FROM transactions t WHERE t.order_id=orders.id AND t.kind='reserve')
+               OR EXISTS(SELECT 1 FROM transactions t WHERE t.order_id=orders.id AND t.kind IN ('commit','refund')))
+        ORDER BY created_at LIMIT ?""", (cutoff,) + FINAL + (limit,)).fetchall()
+    if not rows:
+        return 0
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS archive_ids(id INTEGER PRIMARY KEY, month TEXT)")
+    con.execute("DELETE FROM temp.archive_ids")
+    con.executemany("INSERT INTO temp.archive_ids VALUES(?,?)", rows)
+    con.commit()
+    # 1) نسخ لكل شهر في ملفه. ATTACH/DETACH خارج أي معاملة، وINSERT OR IGNORE يجعل
+    #    إعادة الدفعة بعد توقف مفاجئ بين الخطوتين آمنة (النسخة الساخنة تُقرأ أولًا).
+    months = sorted({m for _, m in rows})
+    for month in months:
+        con.execute("ATTACH DATABASE ? AS arch", (_path(directory, month),))
+        try:
+            con.execute(_ARCHIVE_SCHEMA)
+            con.execute("CREATE INDEX IF NOT EXISTS arch.orders_user ON orders(user_id, id)")
+            con.execute(f"INSERT OR IGNORE INTO arch.orders({_ORDER_COLS}) SELECT {_ORDER_COLS} FROM main.orders "
+                        "WHERE id IN (SELECT id FROM temp.archive_ids WHERE month=?)", (month,))
+            con.commit()
+        finally:
+            con.execute("DETACH DATABASE arch")
+    # 2) الملخصات ثم الحذف من الجدول الساخن في معاملة واحدة
+    con.execute("""INSERT INTO archived_user_stats(user_id,status,n,amount)
+        SELECT user_id, status, COUNT(*), COALESCE(SUM(price),0) FROM orders
+        WHERE id IN (SELECT id FROM temp.archive_ids) GROUP BY user_id, status
+        ON CONFLICT(user_id,status) DO UPDATE SET n=n+excluded.n, amount=amount+excluded.amount""")
+    con.execute("""INSERT INTO archive_months(month,min_id,max_id,rows)
+        SELECT month, MIN(id), MAX(id), COUNT(*) FROM temp.archive_ids GROUP BY month
+        ON CONFLICT(month) DO UPDATE SET min_id=MIN(min_id,excluded.min_id), max_id=MAX(max_id,excluded.max_id),
+            rows=rows+excluded.rows""")
+    con.execute("DELETE FROM orders WHERE id IN (SELECT id FROM temp.archive_ids)")
+    return len(rows)
+
+
+def _months_for_id(con, order_id):
+    return [r[0] for r in con.execute("SELECT month FROM archive_months WHERE ?>=min_id AND ?<=max_id "
+                                      "ORDER BY month DESC", (order_id, order_id))]
+
+
+def _months(con):
+    return [r[0] for r in con.execute("SELECT month FROM archive_months ORDER BY month DESC")]
+
+
+def _hot_order(con, order_id):
+    return con.execute(f"SELECT {_ORDER_COLS} FROM orders WHERE id=?", (order_id,)).fetchone()
+
+
+def _hot_user_orders(con, user_id, limit):
+    return con.execute(f"SELECT {_ORDER_COLS} FROM orders WHERE user_id=? ORDER BY id DESC LIMIT ?",
+                       (user_id, limit)).fetchall()
+
+
+# اتصالات قراءة فقط بملفات الأرشيف، واحد لكل (خيط قراءة، شهر)
+_local = threading.local()
+_archive_cons = []
+_archive_lock = threading.Lock()
+
+
+def _archive_con(directory, month):
+    cons = getattr(_local, "cons", None)
+    if cons is None:
+        cons = _local.cons = {}
+    con = cons.get(month)
+    if con is None:
+        path = _path(directory, month)
+        if not os.path.exists(path):
+            return None
+        con = cons[month] = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        with _archive_lock:
+            _archive_cons.append(con)
+    return con
+
+
+def _cold_order(con, directory, order_id):
+    for month in _months_for_id(con, order_id):
+        arch = _archive_con(directory, month)
+        if arch is not None:
+            row = arch.execute(f"SELECT {_ORDER_COLS} FROM orders WHERE id=?", (order_id,)).fetchone()
+            if row:
+                return row
+    return None
+
+
+def _cold_user_orders(con, directory, user_id, limit):
+    out = []
+    for month in _months(con):
+        arch = _archive_con(directory, month)
+        if arch is None:
+            continue
+        out += arch.execute(f"SELECT {_ORDER_COLS} FROM orders WHERE user_id=? ORDER BY id DESC LIMIT ?",
+                            (user_id, limit - len(out))).fetchall()
+        if len(out) >= limit:
+            break
+    return out
+
+
+class Archiver:
+    def __init__(self, directory=None, after_days=30, interval=6 * 3600, batch=5000):
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(DB)), "archive")
+        self.after_days = after_days
+        self.interval = interval
+        self.batch = batch
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.after_days > 0
+
+    async def run_once(self):
+        """أرشفة كل ما تجاوز after_days؛ دفعات صغيرة حتى لا يُحجز خيط الكاتب طويلًا."""
+        os.makedirs(self.directory, exist_ok=True)
+        cutoff = (datetime.utcnow() - timedelta(days=self.after_days)).isoformat()
+        total = 0
+        while True:
+            n = await write(_archive_batch, self.directory, cutoff, self.batch)
+            if not n:
+                break
+            total += n
+            ARCHIVED.inc(n=n)
+        if total:
+            log.info("archived %d orders older than %s", total, cutoff[:10])
+        return total
+
+    async def get_order(self, order_id):
+        """الطلب من الجدول الساخن، وإلا من ملف شهره في الأرشيف."""
+        row = await read(_hot_order, order_id)
+        # حتى مع تعطيل الأرشفة لاحقًا يبقى ما أُرشف سابقًا مرئيًا (archive_months فارغ وإلا)
+        if row is None:
+            row = await read(_cold_order, self.directory, order_id)
+        return row
+
+    async def user_orders(self, user_id, limit=10):
+        """أحدث طلبات المستخدم، ثم الأرشيف من الأحدث للأقدم حتى يكتمل limit."""
+        rows = await read(_hot_user_orders, user_id, limit)
+        if len(rows) < limit:
+            rows += await read(_cold_user_orders, self.directory, user_id, limit - len(rows))
+        return rows
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        with _archive_lock:
+            for con in _archive_cons:
+                con.close()
+            _archive_cons.clear()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                metrics.count_error("archive", e)
+                log.exception("order archival failed")
+            await asyncio.sleep(self.interval)
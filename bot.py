@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import html
 import os
 import re
-import sqlite3
-from contextlib import closing
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.dispatcher import FSMContext
 from aiogram.utils import executor
@@ -20,16 +20,86 @@ ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "YOUR_USERNAME")
 ADMIN_IDS = [int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip().isdigit()]
 
 FORCE_CHANNELS = [os.getenv("FORCE_CH1", "@SMSFARS_1"), os.getenv("FORCE_CH2", "@SMSFARS_2")]
+FORCE_SUB_TTL        = float(os.getenv("FORCE_SUB_TTL", "300"))
+FORCE_SUB_NEG_TTL    = float(os.getenv("FORCE_SUB_NEG_TTL", "5"))
+FORCE_SUB_CACHE_SIZE = int(os.getenv("FORCE_SUB_CACHE_SIZE", "10000"))
 
 CH_ATTEMPTS   = int(os.getenv("CH_ATTEMPTS",   "-1002627555519"))
 CH_LOGIN      = int(os.getenv("CH_LOGIN",      "-10026017331"))
 CH_SUPPORT_IN = int(os.getenv("CH_SUPPORT_IN", "-1002555952121"))
+# حد الإرسال لكل قناة إدارة (تيليجرام يسمح بنحو 20 رسالة/دقيقة للمجموعة الواحدة)
+NOTIFY_PER_MIN = float(os.getenv("NOTIFY_RATE_PER_MIN", "20"))
+NOTIFY_BURST  = int(os.getenv("NOTIFY_BURST", "3"))
 
 PUBLIC_ACTIVATIONS = os.getenv("PUBLIC_ACTIVATIONS", "@SMSFARS_2")
 PUBLIC_OFFICIAL    = os.getenv("PUBLIC_OFFICIAL", "@SMSFARS_1")
 
 FIVESIM_API_KEY     = os.getenv("FIVESIM_API_KEY", "")
 SMSACTIVATE_API_KEY = os.getenv("SMSACTIVATE_API_KEY", "")
+FIVESIM_URL         = os.getenv("FIVESIM_URL", "")
+SMSACTIVATE_URL     = os.getenv("SMSACTIVATE_URL", "")
+FIVESIM_TIMEOUT     = float(os.getenv("FIVESIM_TIMEOUT", "10"))
+SMSACTIVATE_TIMEOUT = float(os.getenv("SMSACTIVATE_TIMEOUT", "10"))
+PROVIDER_RETRIES    = int(os.getenv("PROVIDER_RETRIES", "2"))
+ORDER_TTL           = float(os.getenv("ORDER_TTL", "1200"))      # مهلة الرقم لدى المزوّد (ثوانٍ)
+POLL_FIRST_DELAY    = float(os.getenv("POLL_FIRST_DELAY", "3"))
+POLL_MAX_INTERVAL   = float(os.getenv("POLL_MAX_INTERVAL", "30"))
+# مخزون الأرقام الجاهزة لكل (دولة، خدمة) حسب الطلب الحديث (POOL_MAX=0 يعطّله)
+POOL_MAX            = int(os.getenv("POOL_MAX", "3"))
+POOL_HORIZON        = float(os.getenv("POOL_HORIZON", "60"))
+POOL_MAX_AGE        = float(os.getenv("POOL_MAX_AGE", "300"))
+POOL_TICK           = float(os.getenv("POOL_TICK", "5"))
+# مزامنة قوائم المزوّدين: سعر البيع = تكلفة أرخص مزوّد × RATE × (1 + MARGIN) مقرّبًا للأعلى لأقرب STEP
+CATALOG_RATE        = float(os.getenv("CATALOG_RATE", "1"))
+CATALOG_MARGIN      = float(os.getenv("CATALOG_MARGIN", "0.3"))
+CATALOG_STEP        = float(os.getenv("CATALOG_STEP", "0.5"))
+CATALOG_INTERVAL    = float(os.getenv("CATALOG_INTERVAL", "600"))
+
+# وضع التشغيل: polling (افتراضي) أو webhook؛ worker داخلي للعمليات العاملة
+BOT_MODE            = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL         = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH        = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET      = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST         = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT         = int(os.getenv("PORT", os.getenv("WEBAPP_PORT", "8080")))
+WEBHOOK_WORKERS     = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+WORKER_INDEX        = int(os.getenv("WORKER_INDEX", "0"))
+WORKERS             = WEBHOOK_WORKERS if BOT_MODE == "worker" else 1
+# العمال يتقاسمون حد القناة الواحدة؛ في polling أو webhook بعملية واحدة الحد كاملًا
+NOTIFY_RATE         = NOTIFY_PER_MIN / 60 / max(1, WORKERS)
+
+# تخزين حالات المحادثة: sqlite (افتراضي) أو redis أو memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_TTL     = float(os.getenv("FSM_TTL", "86400"))
+REDIS_URL   = os.getenv("REDIS_URL", "")
+
+# القياسات: /metrics على منفذ محلي (0 = معطّل)؛ كل عامل على METRICS_PORT + رقمه
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# الحد من الإغراق لكل مستخدم: "عدد/دقيقة/دفعة" لكل مجموعة معالجات
+def _limit(name, default):
+    per_min, burst = os.getenv(name, default).split("/")
+    return float(per_min) / 60, int(burst)
+
+THROTTLE_LIMITS = {
+    "order":   _limit("THROTTLE_ORDER", "20/5"),
+    "account": _limit("THROTTLE_ACCOUNT", "30/5"),
+    "support": _limit("THROTTLE_SUPPORT", "6/3"),
+    "admin":   _limit("THROTTLE_ADMIN", "120/20"),
+}
+SHED_LAG          = float(os.getenv("SHED_LAG", "0.5"))         # تأخر الحلقة (ثوانٍ) الذي يوقف تحويل الدعم
+THROTTLE_IDLE_TTL = float(os.getenv("THROTTLE_IDLE_TTL", "600"))
+
+# الرسائل الجماعية: حد عام (رسالة/ث) وعدد الإرسالات المتزامنة
+BROADCAST_RATE        = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+
+# أرشفة الطلبات المنتهية الأقدم من ARCHIVE_AFTER_DAYS يومًا إلى ملفات شهرية (0 = معطّلة)
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_DIR        = os.getenv("ARCHIVE_DIR", "")
+ARCHIVE_INTERVAL   = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "6")) * 3600
 
 CURRENCY = os.getenv("CURRENCY", "₽")
 BRAND = "𓆪•|ــــــ( 𝗖𝗥𝗔𝗭𝗬◉▿◉𝗦𝙈𝗦)ــــــ|•𓆩"
@@ -38,108 +108,92 @@ if not BOT_TOKEN:
     raise SystemExit("⚠️ ضع BOT_TOKEN في .env")
 
 # =============== قاعدة البيانات ===============
-DB = "crazy_sms.db"
-
-def init_db():
-    with closing(sqlite3.connect(DB)) as con, con:
-        con.execute("""CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            email TEXT,
-            balance REAL DEFAULT 0,
-            created_at TEXT,
-            last_ip TEXT,
-            last_seen TEXT
-        )""")
-        con.execute("""CREATE TABLE IF NOT EXISTS sessions(
-            user_id INTEGER PRIMARY KEY,
-            logged_in INTEGER DEFAULT 0
-        )""")
-        con.execute("""CREATE TABLE IF NOT EXISTS orders(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            provider TEXT,
-            country TEXT,
-            service TEXT,
-            phone TEXT,
-            price REAL,
-            status TEXT,
-            created_at TEXT
-        )""")
-        con.execute("""CREATE TABLE IF NOT EXISTS settings(
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )""")
-        con.execute("""CREATE TABLE IF NOT EXISTS prices(
-            country TEXT PRIMARY KEY,
-            price REAL
-        )""")
-        # أسعار افتراضية
-        defaults = {"sa":30,"eg":25,"ye":20,"tr":18}
-        for c,p in defaults.items():
-            con.execute("INSERT OR IGNORE INTO prices(country,price) VALUES(?,?)", (c,p))
-        # مزودون مفعّلون افتراضياً
-        for k,v in [("provider_5sim_enabled","1"),("provider_sms_enabled","1")]:
-            con.execute("INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)",(k,v))
-
-def get_setting(key, default=None):
-    with closing(sqlite3.connect(DB)) as con:
-        cur = con.execute("SELECT value FROM settings WHERE key=?",(key,))
-        r = cur.fetchone()
-        return r[0] if r else default
-
-def set_setting(key, value):
-    with closing(sqlite3.connect(DB)) as con, con:
-        con.execute("INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",(key,str(value)))
-
-def get_price(country_code, default=25):
-    with closing(sqlite3.connect(DB)) as con:
-        cur = con.execute("SELECT price FROM prices WHERE country=?",(country_code,))
-        r = cur.fetchone()
-        return float(r[0]) if r else default
-
-def set_price(country_code, price):
-    with closing(sqlite3.connect(DB)) as con, con:
-        con.execute("INSERT OR REPLACE INTO prices(country,price) VALUES(?,?)",(country_code, float(price)))
-
-def db_get_user(user_id):
-    with closing(sqlite3.connect(DB)) as con:
-        cur = con.execute("SELECT user_id,email,balance,created_at,last_ip,last_seen FROM users WHERE user_id=?",(user_id,))
-        return cur.fetchone()
-
-def db_upsert_user(user_id, email=None, ip=None):
-    now = datetime.utcnow().isoformat()
-    row = db_get_user(user_id)
-    with closing(sqlite3.connect(DB)) as con, con:
-        if row is None:
-            con.execute("INSERT INTO users(user_id,email,balance,created_at,last_ip,last_seen) VALUES(?,?,?,?,?,?)",
-                        (user_id, email, 0, now, ip, now))
-            con.execute("INSERT OR REPLACE INTO sessions(user_id,logged_in) VALUES(?,?)", (user_id, 1))
-        else:
-            if email:
-                con.execute("UPDATE users SET email=? WHERE user_id=?", (email, user_id))
-            if ip:
-                con.execute("UPDATE users SET last_ip=?, last_seen=? WHERE user_id=?", (ip, now, user_id))
-            con.execute("INSERT OR REPLACE INTO sessions(user_id,logged_in) VALUES(?,?)", (user_id, 1))
-
-def db_is_logged_in(user_id)->bool:
-    with closing(sqlite3.connect(DB)) as con:
-        cur = con.execute("SELECT logged_in FROM sessions WHERE user_id=?", (user_id,))
-        r = cur.fetchone()
-        return bool(r and r[0])
-
-def db_get_balance(user_id):
-    with closing(sqlite3.connect(DB)) as con:
-        cur = con.execute("SELECT COALESCE(balance,0) FROM users WHERE user_id=?", (user_id,))
-        r = cur.fetchone()
-        return float(r[0]) if r else 0.0
+from db import (init_db, shutdown_db, start_flusher, load_cache, CACHE_STATS, CACHE_LISTENERS, prices_version, get_setting, set_setting, get_price, set_price,
+                db_get_user, db_upsert_user, db_is_logged_in, db_get_balance,
+                db_set_order_number, db_set_order_status, db_stats, db_user_stats,
+                ledger_open_order, ledger_settle, ledger_deposit, ledger_reconcile, LEDGER_STATS, COMMIT, REFUND)
+from subscription import SubscriptionChecker
+from storage import make_storage
+from providers import FiveSim, SmsActivate, ProviderRouter, ProviderError, NoNumbers, CODE_RECEIVED, TIMEOUT
+from poller import CodePoller
+from notify import Notifier
+from pool import NumberPool, POOL_TAKES
+from catalog import Catalog
+from throttle import ThrottleMiddleware
+from broadcast import Broadcaster
+from archive import Archiver
+from export import Exporter
+from metrics import MetricsMiddleware, Sampler, count_error, current_handler_name, instrument_bot
+import metrics
+import webhook
 
 # =============== بوت ===============
 bot = Bot(token=BOT_TOKEN, parse_mode=types.ParseMode.HTML)
-dp  = Dispatcher(bot, storage=MemoryStorage())
+dp  = Dispatcher(bot, storage=make_storage(FSM_STORAGE, FSM_TTL, REDIS_URL))
+instrument_bot(bot)
+sampler = Sampler()
+
+notifier = Notifier(bot, rate=NOTIFY_RATE, burst=NOTIFY_BURST)
+broadcaster = Broadcaster(bot, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+archiver = Archiver(ARCHIVE_DIR or None, after_days=ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL)
+exporter = Exporter(archiver.directory)
+
+# مزوّدو الأرقام (يُفعَّل فقط من له مفتاح API)
+_providers = []
+if FIVESIM_API_KEY:
+    _providers.append(FiveSim(FIVESIM_API_KEY, base_url=FIVESIM_URL, timeout=FIVESIM_TIMEOUT, retries=PROVIDER_RETRIES))
+if SMSACTIVATE_API_KEY:
+    _providers.append(SmsActivate(SMSACTIVATE_API_KEY, base_url=SMSACTIVATE_URL, timeout=SMSACTIVATE_TIMEOUT, retries=PROVIDER_RETRIES))
+router = ProviderRouter(_providers)
+PROVIDER_SETTINGS = [("5sim","provider_5sim_enabled"),("sms-activate","provider_sms_enabled")]
+
+async def enabled_providers():
+    # الترتيب هنا هو ترتيب التفضيل؛ عند تعطل الأول يُستعمل التالي تلقائيًا
+    return [name for name, key in PROVIDER_SETTINGS if await get_setting(key,"1")=="1"]
+
+async def provider_order(country, service):
+    # مزوّدو مسار القائمة (الأرخص أولًا)، ثم بقية المفعّلين احتياطًا إن كانت القائمة قديمة
+    enabled = await enabled_providers()
+    route = catalog.route(country, service)
+    order = [p for p in route.providers if p in enabled] if route else []
+    return order + [p for p in enabled if p not in order]
+
+async def order_finished(o, status, code):
+    refunded = await ledger_settle(o.id, COMMIT if status == CODE_RECEIVED else REFUND) and status != CODE_RECEIVED
+    if status == CODE_RECEIVED:
+        text = (f"✅ <b>وصل كود التفعيل</b>\n"
+                f"• الدولة: <code>{o.country}</code>\n"
+                f"• الخدمة: <code>{o.service}</code>\n"
+                f"• الرقم: <code>{o.phone}</code>\n"
+                f"• الكود: <code>{code}</code>")
+    elif status == TIMEOUT:
+        text = f"⌛ انتهت مهلة الرقم <code>{o.phone}</code> دون وصول كود، وتم إلغاؤه."
+    else:
+        text = f"❌ ألغى المزوّد الرقم <code>{o.phone}</code>."
+    if refunded:
+        text += f"\n💳 أُعيد {o.price} {CURRENCY} إلى رصيدك."
+    if o.chat_id and o.message_id:
+        try:
+            await bot.edit_message_text(text, o.chat_id, o.message_id)
+        except Exception as e:
+            count_error("order_finished", e)
+    state = dp.current_state(chat=o.chat_id, user=o.user_id)
+    if (await state.get_data()).get("order_id") == o.id:
+        await state.finish()
+
+poller = CodePoller(router, order_finished, first_delay=POLL_FIRST_DELAY,
+                    max_interval=POLL_MAX_INTERVAL, ttl=ORDER_TTL)
+pool = NumberPool(router, provider_order, max_size=POOL_MAX, horizon=POOL_HORIZON,
+                  max_age=POOL_MAX_AGE, tick=POOL_TICK)
+catalog = Catalog(router, enabled_providers, rate=CATALOG_RATE, margin=CATALOG_MARGIN, step=CATALOG_STEP,
+                  interval=CATALOG_INTERVAL, sync=WORKER_INDEX == 0)
+# تعديل مزوّد/سعر أو مزامنة في عامل آخر: نعيد تحميل جدول التوجيه هنا أيضًا
+CACHE_LISTENERS.append(catalog.reload)
 
-# دول + خدمات
+# دول + خدمات: هذه تظهر أولًا وبأسمائها، والبقية من جدول التوجيه (catalog.py)
 COUNTRIES = [("🇸🇦 السعودية","sa"),("🇪🇬 مصر","eg"),("🇾🇪 اليمن","ye"),("🇹🇷 تركيا","tr")]
 SERVICES  = [("WhatsApp","whatsapp"),("Telegram","telegram")]
+PAGE_SIZE = 20
 
 # FSM
 class Auth(StatesGroup):
@@ -147,34 +201,64 @@ class Auth(StatesGroup):
 class AdminSetPrice(StatesGroup):
     choose_country = State()
     enter_price = State()
+class AdminBroadcast(StatesGroup):
+    message = State()
 
 # =============== أدوات ===============
-async def ensure_force_sub(user_id: int) -> bool:
-    for ch in FORCE_CHANNELS:
-        try:
-            st = await bot.get_chat_member(ch, user_id)
-            if st.status in ("left","kicked"):
-                return False
-        except Exception:
-            return False
-    return True
+sub_checker = SubscriptionChecker(bot, FORCE_CHANNELS, ttl=FORCE_SUB_TTL,
+                                  negative_ttl=FORCE_SUB_NEG_TTL, maxsize=FORCE_SUB_CACHE_SIZE)
 
-def main_menu(balance: float):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("⚡ طلب رقم", "👤 لوحة الحساب")
-    kb.add("🧾 شروط الاستخدام", "🆘 الدعم والمساعدة")
-    return kb
+async def ensure_force_sub(user_id: int, fresh: bool = False) -> bool:
+    return await sub_checker.check(user_id, fresh)
+
+# اللوحات الثابتة تُبنى مرة واحدة وتُحفظ كنص JSON جاهز: aiogram يمرّر النص
+# كما هو إلى تيليجرام، فلا تخصيص كائنات ولا إعادة تسلسل مع كل رد.
+# أزرار لوحة الكتابة تُسجَّل في قاموس مرة واحدة، ومعالج نصي وحيد (آخر الملف)
+# يوجّه كل رسالة ببحث واحد؛ ما لا يطابق زرًا يذهب لقناة الدعم.
+BUTTONS = {}
+
+def button(label):
+    def register(handler):
+        BUTTONS[label] = handler
+        return handler
+    return register
+
+def frozen(kb) -> str:
+    return kb.as_json()
+
+_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+_kb.add("⚡ طلب رقم", "👤 لوحة الحساب")
+_kb.add("🧾 شروط الاستخدام", "🆘 الدعم والمساعدة")
+MAIN_MENU = frozen(_kb)
+
+_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+_kb.add("🔙 رجوع", "🏠 الصفحة الرئيسية")
+BACK_HOME_MENU = frozen(_kb)
+
+def main_menu(balance: float = None):
+    # الرصيد لا يظهر في اللوحة حاليًا، فهي واحدة للجميع ولا داعي لقراءته.
+    # إن أُضيف الرصيد للأزرار يجب أن يصبح جزءًا من مفتاح الكاش.
+    return MAIN_MENU
 
 def back_home_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("🔙 رجوع", "🏠 الصفحة الرئيسية")
-    return kb
+    return BACK_HOME_MENU
 
-def welcome_text(ip: str):
-    return (f"<b>{BRAND}</b>\n"
+# اللوحات المعتمدة على الأسعار تُعاد بناؤها فقط عند تغيّر إصدار الأسعار (set_price)
+# أو جدول التوجيه (مزامنة القائمة)
+_price_kbs = {}
+
+async def price_keyboard(name, build):
+    v = (prices_version(), catalog.version)
+    hit = _price_kbs.get(name)
+    if hit is None or hit[0] != v:
+        hit = _price_kbs[name] = (v, frozen(await build()))
+    return hit[1]
+
+_WELCOME_HEAD = (f"<b>{BRAND}</b>\n"
             f"━━━━━━━━━━━━━━━\n"
             f"👋 أهلاً وسهلاً بك عزيزي\n"
-            f"🛰️ IP دخولك: <code>{ip or 'N/A'}</code>\n\n"
+            f"🛰️ IP دخولك: <code>")
+_WELCOME_TAIL = (f"</code>\n\n"
             f"🚀 <b>{BRAND}</b> يمكنك:\n"
             f"• تفعيل حساباتك في جميع المنصات بسهولة\n"
             f"• استخدام أرقام وهمية شغّالة 100%\n"
@@ -190,6 +274,9 @@ def welcome_text(ip: str):
             f"━━━━━━━━━━━━━━━\n"
             f"💎 CRAZY SMS — حيث تبدأ رحلتك نحو التفعيل السريع!")
 
+def welcome_text(ip: str):
+    return _WELCOME_HEAD + (ip or 'N/A') + _WELCOME_TAIL
+
 TERMS_TEXT = (
 "📜 <b>شروط الاستخدام</b>\n\n"
 "• هذه الخدمة مخصّصة للتفعيل والاختبار والخصوصية وفق القانون المحلي وسياسات المنصات.\n"
@@ -198,11 +285,13 @@ TERMS_TEXT = (
 "• باستخدامك للبوت فأنت توافق على هذه الشروط."
 )
 
+SUPPORT_TEXT = (f"🧑‍💻 للتواصل مع الدعم الفني والإدارة:\n"
+                f"@{ADMIN_USERNAME}\n"
+                f"🔗 <a href='https://t.me/{ADMIN_USERNAME}'>اضغط هنا للتواصل المباشر</a>\n\n"
+                f"إن كان الخاص مغلقًا، أرسل رسالتك هنا وسيحوّلها البوت لقناة الدعم.")
+
 def support_text():
-    return (f"🧑‍💻 للتواصل مع الدعم الفني والإدارة:\n"
-            f"@{ADMIN_USERNAME}\n"
-            f"🔗 <a href='https://t.me/{ADMIN_USERNAME}'>اضغط هنا للتواصل المباشر</a>\n\n"
-            f"إن كان الخاص مغلقًا، أرسل رسالتك هنا وسيحوّلها البوت لقناة الدعم.")
+    return SUPPORT_TEXT
 
 # =============== أوامر عامة ===============
 @dp.message_handler(commands=["start"])
@@ -217,75 +306,102 @@ async def start(m: types.Message, state: FSMContext):
         await m.answer("🔔 للمتابعة، الرجاء الاشتراك في القنوات التالية:\n"+chs+"\n\nثم اضغط الزر للتحقّق.", reply_markup=btn)
         return
     ip = m.from_user.language_code or "N/A"
-    db_upsert_user(m.from_user.id, ip=ip)
-    await m.answer(welcome_text(ip), reply_markup=main_menu(db_get_balance(m.from_user.id)))
+    await db_upsert_user(m.from_user.id, ip=ip)
+    await m.answer(welcome_text(ip), reply_markup=main_menu())
 
 @dp.callback_query_handler(lambda c:c.data=="recheck")
 async def recheck(c: types.CallbackQuery):
-    if await ensure_force_sub(c.from_user.id):
+    if await ensure_force_sub(c.from_user.id, fresh=True):
         await c.message.delete()
-        await c.message.answer("✅ تم التحقّق من الاشتراك. أهلاً بك!", reply_markup=main_menu(db_get_balance(c.from_user.id)))
+        await c.message.answer("✅ تم التحقّق من الاشتراك. أهلاً بك!", reply_markup=main_menu())
     else:
         await c.answer("لا يزال الاشتراك غير مكتمل.", show_alert=True)
 
-@dp.message_handler(lambda m: m.text == "🧾 شروط الاستخدام")
-async def terms(m: types.Message):
+@button("🧾 شروط الاستخدام")
+async def terms(m: types.Message, state:FSMContext):
     await m.answer(TERMS_TEXT, reply_markup=back_home_menu())
 
-@dp.message_handler(lambda m: m.text == "🆘 الدعم والمساعدة")
-async def support(m: types.Message):
+@button("🆘 الدعم والمساعدة")
+async def support(m: types.Message, state:FSMContext):
     await m.answer(support_text(), reply_markup=back_home_menu())
 
-@dp.message_handler(lambda m: m.text == "🏠 الصفحة الرئيسية")
-async def home(m: types.Message):
-    await m.answer("🏠 عدت إلى الصفحة الرئيسية.", reply_markup=main_menu(db_get_balance(m.from_user.id)))
+@button("🏠 الصفحة الرئيسية")
+@button("🔙 رجوع")
+async def home(m: types.Message, state:FSMContext):
+    await m.answer("🏠 عدت إلى الصفحة الرئيسية.", reply_markup=main_menu())
 
 # =============== حساب المستخدم ===============
+_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+_kb.add("💡 إنشاء حساب", "✅ تسجيل الدخول")
+_kb.add("📊 الإحصائيات", "🏠 الصفحة الرئيسية")
+ACCOUNT_MENU = frozen(_kb)
+
 def account_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("💡 إنشاء حساب", "✅ تسجيل الدخول")
-    kb.add("📊 الإحصائيات", "🏠 الصفحة الرئيسية")
-    return kb
+    return ACCOUNT_MENU
 
-@dp.message_handler(lambda m: m.text == "👤 لوحة الحساب")
-async def account(m: types.Message):
-    u = db_get_user(m.from_user.id)
-    bal = db_get_balance(m.from_user.id)
-    logged = "✅ مسجل" if db_is_logged_in(m.from_user.id) else "❌ غير مسجل"
+@button("👤 لوحة الحساب")
+async def account(m: types.Message, state:FSMContext):
+    u = await db_get_user(m.from_user.id)
+    bal = await db_get_balance(m.from_user.id)
+    logged = "✅ مسجل" if await db_is_logged_in(m.from_user.id) else "❌ غير مسجل"
     email = u[1] if u else None
     await m.answer(f"👤 <b>حسابك</b>\n• البريد: <code>{email or 'غير مضاف'}</code>\n• الحالة: {logged}\n• الرصيد: {bal:.3f} {CURRENCY}", reply_markup=account_menu())
 
-class Auth(StatesGroup):
-    ask_email = State()
+_STATUS_NAMES = {"WAIT_CODE": "⏳ بانتظار الكود", "CODE_RECEIVED": "✅ مكتملة",
+                 "CANCELED": "❌ ملغاة", "TIMEOUT": "⌛ منتهية"}
 
-@dp.message_handler(lambda m: m.text == "💡 إنشاء حساب")
+def order_line(o):
+    # o: صف بأعمدة _ORDER_COLS، من الجدول الساخن أو من الأرشيف
+    oid, _, _, country, service, _, price, status, created_at = o[:9]
+    return (f"#{oid} • {country}/{service} • {price} {CURRENCY} • {_STATUS_NAMES.get(status, status)} • "
+            f"{(created_at or '')[:10]}")
+
+@button("📊 الإحصائيات")
+async def my_stats(m: types.Message, state:FSMContext):
+    rows = await db_user_stats(m.from_user.id)
+    if not rows:
+        await m.answer("📊 لا توجد طلبات بعد.", reply_markup=account_menu())
+        return
+    total = sum(n for _, n, _ in rows)
+    spent = sum(p or 0 for s, _, p in rows if s == "CODE_RECEIVED")
+    lines = "\n".join(f"• {_STATUS_NAMES.get(s, s)}: {n}" for s, n, _ in rows)
+    # آخر الطلبات عبر الأرشيف: ما نُقل للملفات الشهرية يظهر بعد الحديثة
+    recent = "\n".join(order_line(o) for o in await archiver.user_orders(m.from_user.id, limit=5))
+    await m.answer(f"📊 <b>إحصائياتك</b>\n• إجمالي الطلبات: {total}\n{lines}\n• المصروف: {spent:.3f} {CURRENCY}\n\n"
+                   f"🧾 <b>آخر الطلبات</b>\n{recent}",
+                   reply_markup=account_menu())
+
+@button("💡 إنشاء حساب")
 async def ask_email(m: types.Message, state:FSMContext):
     await Auth.ask_email.set()
     await m.answer("📧 أرسل بريدك الإلكتروني (لن تحتاج كلمة مرور).", reply_markup=back_home_menu())
 
 @dp.message_handler(state=Auth.ask_email, content_types=types.ContentTypes.TEXT)
 async def save_email(m: types.Message, state:FSMContext):
+    if m.text in BUTTONS:
+        # ضغط زر من القائمة يُنهي طلب البريد
+        await state.finish()
+        await BUTTONS[m.text](m, state)
+        return
     email = m.text.strip()
     if not re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", email):
         await m.answer("❌ بريد غير صالح. حاول مجددًا.")
         return
-    db_upsert_user(m.from_user.id, email=email)
+    await db_upsert_user(m.from_user.id, email=email)
     await state.finish()
     # إشعار للإدارة
-    try:
-        await bot.send_message(CH_LOGIN, f"🔔 <b>تسجيل جديد/دخول</b>\n• المستخدم: <a href='tg://user?id={m.from_user.id}'>{m.from_user.full_name}</a>\n• الآيدي: <code>{m.from_user.id}</code>\n• البريد: <code>{email}</code>")
-    except: pass
-    await m.answer("✅ تم إنشاء حسابك وتسجيل دخولك.", reply_markup=main_menu(db_get_balance(m.from_user.id)))
+    notifier.push(CH_LOGIN, f"🔔 <b>تسجيل جديد/دخول</b>\n• المستخدم: <a href='tg://user?id={m.from_user.id}'>{m.from_user.full_name}</a>\n• الآيدي: <code>{m.from_user.id}</code>\n• البريد: <code>{email}</code>",
+                  kind="تسجيل جديد", summary=f"🔔 <code>{m.from_user.id}</code> | <code>{email}</code>")
+    await m.answer("✅ تم إنشاء حسابك وتسجيل دخولك.", reply_markup=main_menu())
 
-@dp.message_handler(lambda m: m.text == "✅ تسجيل الدخول")
-async def login(m: types.Message):
-    u = db_get_user(m.from_user.id)
+@button("✅ تسجيل الدخول")
+async def login(m: types.Message, state:FSMContext):
+    u = await db_get_user(m.from_user.id)
     if u and u[1]:
-        db_upsert_user(m.from_user.id)
-        try:
-            await bot.send_message(CH_LOGIN, f"🔓 <b>تسجيل دخول</b> | {m.from_user.id} | البريد: <code>{u[1]}</code>")
-        except: pass
-        await m.answer(f"✅ تم تسجيل دخولك.\nبريدك: <code>{u[1]}</code>", reply_markup=main_menu(db_get_balance(m.from_user.id)))
+        await db_upsert_user(m.from_user.id)
+        notifier.push(CH_LOGIN, f"🔓 <b>تسجيل دخول</b> | {m.from_user.id} | البريد: <code>{u[1]}</code>",
+                      kind="تسجيل دخول", summary=f"🔓 <code>{m.from_user.id}</code> | <code>{u[1]}</code>")
+        await m.answer(f"✅ تم تسجيل دخولك.\nبريدك: <code>{u[1]}</code>", reply_markup=main_menu())
     else:
         await m.answer("ℹ️ يجب أن يكون لديك بريد مسجّل مسبقًا. استخدم «إنشاء حساب».", reply_markup=account_menu())
 
@@ -295,54 +411,165 @@ class OrderFlow(StatesGroup):
     choose_service = State()
     waiting_code = State()
 
-@dp.message_handler(lambda m: m.text == "⚡ طلب رقم")
-async def order_entry(m: types.Message, state:FSMContext):
+_COUNTRY_NAMES, _SERVICE_NAMES = dict((c, n) for n, c in COUNTRIES), dict((s, n) for n, s in SERVICES)
+
+def country_label(code):
+    if code in _COUNTRY_NAMES:
+        return _COUNTRY_NAMES[code]
+    flag = "".join(chr(0x1F1E6 + ord(ch) - 97) for ch in code) if len(code) == 2 and code.isalpha() else "🌐"
+    return f"{flag} {catalog.names.get(code) or code.upper()}"
+
+async def order_price(country, service=None):
+    """سعر البيع: سعر جدول التوجيه، وسعر الأدمن حدّ أدنى له؛ بلا قائمة نعود للسعر الثابت."""
+    if not catalog.routes:
+        return await get_price(country, 25)
+    if service is None:
+        prices = [r.price for r in (catalog.route(country, s) for s in catalog.services.get(country, ())) if r]
+        route_price = min(prices) if prices else 0
+    else:
+        r = catalog.route(country, service)
+        route_price = r.price if r else 0
+    return max(route_price, await get_price(country, 0))
+
+def _ordered(curated, available, key):
+    # المختار يدويًا أولًا بترتيبه، ثم البقية حسب key
+    first = [c for c in curated if c in available]
+    return first + sorted((c for c in available if c not in curated), key=key)
+
+def _page_buttons(kb, page, total, prefix):
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"{prefix}{page - 1}"))
+    if (page + 1) * PAGE_SIZE < total:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"{prefix}{page + 1}"))
+    if nav:
+        kb.row(*nav)
+
+async def _countries_kb(page=0):
     kb = types.InlineKeyboardMarkup(row_width=2)
-    for name, code in COUNTRIES:
-        price = get_price(code, 25)
-        kb.insert(types.InlineKeyboardButton(f"{name} — {price} {CURRENCY}", callback_data=f"c_{code}"))
-    await m.answer(f"🌍 اختر الدولة.\n<b>{BRAND}</b>", reply_markup=kb)
+    curated = [code for _, code in COUNTRIES]
+    codes = _ordered(curated, set(catalog.stock), lambda c: -catalog.stock[c]) if catalog.routes else curated
+    for code in codes[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+        prefix = "من " if catalog.routes else ""
+        price = await order_price(code)
+        kb.insert(types.InlineKeyboardButton(f"{country_label(code)} — {prefix}{price} {CURRENCY}", callback_data=f"c_{code}"))
+    _page_buttons(kb, page, len(codes), "cp_")
+    return kb
+
+async def _services_kb(country, page=0):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    if not catalog.routes:
+        for label, sid in SERVICES:
+            kb.insert(types.InlineKeyboardButton(label, callback_data=f"s_{sid}"))
+        return kb
+    services = _ordered([s for _, s in SERVICES], set(catalog.services.get(country, ())), str)
+    for sid in services[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+        label = _SERVICE_NAMES.get(sid, sid)
+        kb.insert(types.InlineKeyboardButton(f"{label} — {await order_price(country, sid)} {CURRENCY}",
+                                             callback_data=f"s_{sid}"))
+    _page_buttons(kb, page, len(services), "sp_")
+    return kb
+
+def countries_keyboard(page=0):
+    return price_keyboard(f"countries:{page}", lambda: _countries_kb(page))
+
+def services_keyboard(country, page=0):
+    return price_keyboard(f"services:{country}:{page}", lambda: _services_kb(country, page))
+
+_kb = types.InlineKeyboardMarkup()
+_kb.add(types.InlineKeyboardButton("🔁 تغيير الرقم", callback_data="chg_num"))
+_kb.add(types.InlineKeyboardButton("❌ إلغاء الرقم", callback_data="cancel_num"))
+ORDER_ACTIONS_KB = frozen(_kb)
+
+@button("⚡ طلب رقم")
+async def order_entry(m: types.Message, state:FSMContext):
+    await m.answer(f"🌍 اختر الدولة.\n<b>{BRAND}</b>", reply_markup=await countries_keyboard())
     await OrderFlow.choose_country.set()
 
+@dp.callback_query_handler(lambda c:c.data.startswith("cp_"), state=OrderFlow.choose_country)
+async def countries_page(c: types.CallbackQuery):
+    await c.message.edit_reply_markup(await countries_keyboard(int(c.data[3:])))
+
 @dp.callback_query_handler(lambda c:c.data.startswith("c_"), state=OrderFlow.choose_country)
 async def picked_country(c: types.CallbackQuery, state:FSMContext):
     country = c.data.split("_",1)[1]
     await state.update_data(country=country)
-    kb = types.InlineKeyboardMarkup(row_width=2)
-    for label, sid in SERVICES:
-        kb.insert(types.InlineKeyboardButton(label, callback_data=f"s_{sid}"))
-    await c.message.edit_text("اختر الخدمة:", reply_markup=kb)
+    await c.message.edit_text(f"اختر الخدمة ({country_label(country)}):", reply_markup=await services_keyboard(country))
     await OrderFlow.choose_service.set()
 
+@dp.callback_query_handler(lambda c:c.data.startswith("sp_"), state=OrderFlow.choose_service)
+async def services_page(c: types.CallbackQuery, state:FSMContext):
+    country = (await state.get_data()).get("country")
+    await c.message.edit_reply_markup(await services_keyboard(country, int(c.data[3:])))
+
 @dp.callback_query_handler(lambda c:c.data.startswith("s_"), state=OrderFlow.choose_service)
 async def picked_service(c: types.CallbackQuery, state:FSMContext):
     service = c.data.split("_",1)[1]
     data = await state.get_data()
     country = data.get("country")
 
-    # مكان الدمج الحقيقي مع 5SIM/sms-activate (لاحقًا)
-    provider = "5sim" if get_setting("provider_5sim_enabled","1")=="1" else "sms-activate"
-    price = get_price(country, 25)
-    phone = "+99900012345"  # Placeholder رقم افتراضي
+    route = catalog.route(country, service)
+    if catalog.routes and route is None:
+        await c.answer("😔 لا توجد أرقام متاحة حاليًا لهذه الخدمة. جرّب دولة أخرى.", show_alert=True)
+        return
+    price = await order_price(country, service)
+    # فحص مبدئي لتجنّب شراء رقم لن يُدفع ثمنه؛ الخصم الفعلي ذرّي في ledger_open_order
+    if await db_get_balance(c.from_user.id) < price:
+        await c.answer(f"💳 رصيدك غير كافٍ. سعر الرقم {price} {CURRENCY}، تواصل مع الدعم للشحن.", show_alert=True)
+        return
+    hit = pool.take(country, service)
+    if hit is not None:
+        act, bought_at = hit
+    else:
+        try:
+            act = await router.buy(country, service, await provider_order(country, service))
+        except NoNumbers:
+            await c.answer("😔 لا توجد أرقام متاحة حاليًا لهذه الخدمة. جرّب دولة أخرى.", show_alert=True)
+            return
+        except ProviderError:
+            await c.answer("⚠️ تعذر طلب الرقم الآن. حاول لاحقًا.", show_alert=True)
+            return
+        bought_at = None
+    provider, phone = act.provider, act.phone
+
+    async def give_back():
+        # الرقم لم يُربط بطلب: نعيده للمخزون أو للمزوّد حتى لا يضيع ثمنه
+        if hit is not None:
+            pool.put_back(act, bought_at)
+        else:
+            try:
+                await router.cancel(provider, act.id)
+            except ProviderError as e:
+                count_error("picked_service", e)
 
-    with closing(sqlite3.connect(DB)) as con, con:
-        con.execute("INSERT INTO orders(user_id,provider,country,service,phone,price,status,created_at) VALUES(?,?,?,?,?,?,?,?)",
-                    (c.from_user.id, provider, country, service, phone, price, "WAIT_CODE", datetime.utcnow().isoformat()))
+    try:
+        order_id = await ledger_open_order(c.from_user.id, price, provider, country, service, phone,
+                                           ext_id=act.id, chat_id=c.message.chat.id, message_id=c.message.message_id)
+    except Exception as e:
+        count_error("picked_service", e)
+        await give_back()
+        await c.answer("⚠️ تعذر إتمام الطلب الآن ولم يُخصم شيء من رصيدك. حاول لاحقًا.", show_alert=True)
+        return
+    if order_id is None:
+        # سبقتها عملية أخرى على نفس الرصيد
+        await give_back()
+        await c.answer(f"💳 رصيدك غير كافٍ. سعر الرقم {price} {CURRENCY}، تواصل مع الدعم للشحن.", show_alert=True)
+        return
+    await state.update_data(service=service, order_id=order_id, provider=provider, ext_id=act.id, price=price)
+    poller.track(order_id, c.from_user.id, provider, act.id, country, service, phone, price,
+                 c.message.chat.id, c.message.message_id, created_at=bought_at)
 
     # إشعار محاولات الشراء (واضح)
-    try:
-        await bot.send_message(CH_ATTEMPTS,
-            f"🟠 <b>محاولة شراء</b>\n"
-            f"• المستخدم: <a href='tg://user?id={c.from_user.id}'>{c.from_user.full_name}</a>\n"
-            f"• الدولة: <code>{country}</code>\n"
-            f"• الخدمة: <code>{service}</code>\n"
-            f"• السعر: {price} {CURRENCY}\n"
-            f"• الرقم: <code>{phone}</code>")
-    except: pass
+    notifier.push(CH_ATTEMPTS,
+        f"🟠 <b>محاولة شراء</b>\n"
+        f"• المستخدم: <a href='tg://user?id={c.from_user.id}'>{c.from_user.full_name}</a>\n"
+        f"• الدولة: <code>{country}</code>\n"
+        f"• الخدمة: <code>{service}</code>\n"
+        f"• السعر: {price} {CURRENCY}\n"
+        f"• الرقم: <code>{phone}</code>",
+        kind="محاولة شراء",
+        summary=f"🟠 <code>{c.from_user.id}</code> | {country}/{service} | {price} {CURRENCY} | <code>{phone}</code>")
 
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("🔁 تغيير الرقم", callback_data="chg_num"))
-    kb.add(types.InlineKeyboardButton("❌ إلغاء الرقم", callback_data="cancel_num"))
     await c.message.edit_text(
         f"📲 تم طلب رقمك بنجاح من <b>{BRAND}</b>\n"
         f"• الدولة: <code>{country}</code>\n"
@@ -350,7 +577,7 @@ async def picked_service(c: types.CallbackQuery, state:FSMContext):
         f"• السعر: <b>{price} {CURRENCY}</b>\n"
         f"• الرقم: <code>{phone}</code>\n\n"
         f"عند وصول الكود سيظهر هنا مباشرة.",
-        reply_markup=kb
+        reply_markup=ORDER_ACTIONS_KB
     )
     await OrderFlow.waiting_code.set()
 
@@ -358,8 +585,27 @@ async def picked_service(c: types.CallbackQuery, state:FSMContext):
 async def change_number(c: types.CallbackQuery, state:FSMContext):
     data = await state.get_data()
     country = data.get("country")
-    new_phone = "+99900054321"
-    price = get_price(country, 25)
+    hit = pool.take(country, data.get("service"))
+    if hit is not None:
+        act, bought_at = hit
+        try:
+            await router.cancel(data.get("provider"), data.get("ext_id"))
+        except ProviderError as e:
+            count_error("change_number", e)
+    else:
+        try:
+            act = await router.replace(data.get("provider"), data.get("ext_id"), country, data.get("service"),
+                                       await provider_order(country, data.get("service")))
+        except ProviderError:
+            await c.answer("⚠️ تعذر تغيير الرقم الآن. حاول لاحقًا.", show_alert=True)
+            return
+        bought_at = None
+    new_phone = act.phone
+    await db_set_order_number(data.get("order_id"), act.provider, act.id, new_phone)
+    await state.update_data(provider=act.provider, ext_id=act.id)
+    price = data.get("price") or await order_price(country, data.get("service"))
+    poller.track(data.get("order_id"), c.from_user.id, act.provider, act.id, country, data.get("service"),
+                 new_phone, price, c.message.chat.id, c.message.message_id, created_at=bought_at)
     await c.message.edit_text(
         f"🔁 تم تغيير الرقم بنجاح (نفس الدولة).\n"
         f"• الدولة: <code>{country}</code>\n"
@@ -368,57 +614,82 @@ async def change_number(c: types.CallbackQuery, state:FSMContext):
         f"بانتظار كود التفعيل…"
     )
 
-@dp.callback_query_handler(lambda c:c.data=="cancel_num", state=OrderFlow.waiting_code)
-async def cancel_number(c: types.CallbackQuery, state:FSMContext):
-    await state.finish()
+async def _after_cancel_kb():
     # أزرار ما بعد الإلغاء
-    price_label = get_price("ye", 20)  # افتراضي للعرض
+    price_label = await get_price("ye", 20)  # افتراضي للعرض
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton(f"🛒 الشراء مجددًا بسعر ({price_label} {CURRENCY})", callback_data="relist_countries"))
     kb.add(types.InlineKeyboardButton("🌍 رجوع للدول", callback_data="relist_countries"))
     kb.add(types.InlineKeyboardButton("🏠 الصفحة الرئيسية", callback_data="go_home"))
-    await c.message.edit_text("✅ تم إلغاء الرقم بنجاح.", reply_markup=kb)
+    return kb
+
+@dp.callback_query_handler(lambda c:c.data=="cancel_num", state=OrderFlow.waiting_code)
+async def cancel_number(c: types.CallbackQuery, state:FSMContext):
+    data = await state.get_data()
+    order_id = data.get("order_id")
+    # نوقف المتابعة قبل الإلغاء حتى لا يسلّم الفاحص كودًا أثناءه
+    tracked = poller.untrack(order_id)
+    try:
+        await router.cancel(data.get("provider"), data.get("ext_id"))
+    except ProviderError:
+        if tracked is not None:
+            poller.resume(tracked)
+        await c.answer("⚠️ تعذر إلغاء الرقم الآن. حاول بعد قليل.", show_alert=True)
+        return
+    if not await db_set_order_status(order_id, "CANCELED"):
+        # سبقه الفاحص (وصل الكود أو انتهت المهلة)؛ order_finished أبلغ المستخدم وسوّى الحجز
+        await c.answer("ℹ️ انتهى هذا الطلب قبل الإلغاء.", show_alert=True)
+        return
+    refunded = await ledger_settle(order_id, REFUND)
+    await state.finish()
+    await c.message.edit_text("✅ تم إلغاء الرقم بنجاح." + ("\n💳 أُعيد المبلغ إلى رصيدك." if refunded else ""), reply_markup=await price_keyboard("after_cancel", _after_cancel_kb))
 
 @dp.callback_query_handler(lambda c:c.data=="relist_countries")
 async def relist_countries(c: types.CallbackQuery):
-    kb = types.InlineKeyboardMarkup(row_width=2)
-    for name, code in COUNTRIES:
-        price = get_price(code, 25)
-        kb.insert(types.InlineKeyboardButton(f"{name} — {price} {CURRENCY}", callback_data=f"c_{code}"))
-    await c.message.edit_text("🌍 اختر الدولة:", reply_markup=kb)
+    await c.message.edit_text("🌍 اختر الدولة:", reply_markup=await countries_keyboard())
 
 @dp.callback_query_handler(lambda c:c.data=="go_home")
 async def go_home_cb(c: types.CallbackQuery):
     await c.message.edit_text("🏠 عدت إلى الصفحة الرئيسية.")
-    await c.message.answer(".", reply_markup=main_menu(db_get_balance(c.from_user.id)))
+    await c.message.answer(".", reply_markup=main_menu())
 
 # =============== لوحة تحكم الأدمن ===============
 def is_admin(user_id:int)->bool:
     return user_id in ADMIN_IDS
 
+_kb = types.InlineKeyboardMarkup(row_width=2)
+_kb.add(
+    types.InlineKeyboardButton("💰 تعديل الأسعار", callback_data="ad_prices"),
+    types.InlineKeyboardButton("🔌 المزوّدون", callback_data="ad_providers"),
+)
+_kb.add(
+    types.InlineKeyboardButton("📢 القنوات", callback_data="ad_channels"),
+    types.InlineKeyboardButton("📈 إحصائيات", callback_data="ad_stats"),
+)
+_kb.add(
+    types.InlineKeyboardButton("📢 رسالة جماعية", callback_data="ad_broadcast"),
+    types.InlineKeyboardButton("🔬 المحلّل", callback_data="ad_profiler"),
+)
+_kb.add(types.InlineKeyboardButton("📤 تصدير", callback_data="ad_export"))
+ADMIN_KB = frozen(_kb)
+
 @dp.message_handler(commands=["admin"])
 async def admin_panel(m: types.Message, state:FSMContext):
     if not is_admin(m.from_user.id):
         return
+    await m.answer("🛠 <b>لوحة تحكم الإدارة</b>", reply_markup=ADMIN_KB)
+
+async def _admin_prices_kb():
     kb = types.InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        types.InlineKeyboardButton("💰 تعديل الأسعار", callback_data="ad_prices"),
-        types.InlineKeyboardButton("🔌 المزوّدون", callback_data="ad_providers"),
-    )
-    kb.add(
-        types.InlineKeyboardButton("📢 القنوات", callback_data="ad_channels"),
-        types.InlineKeyboardButton("📈 إحصائيات", callback_data="ad_stats"),
-    )
-    await m.answer("🛠 <b>لوحة تحكم الإدارة</b>", reply_markup=kb)
+    for name, code in COUNTRIES:
+        kb.insert(types.InlineKeyboardButton(f"{name} ({await get_price(code)} {CURRENCY})", callback_data=f"adp_{code}"))
+    kb.add(types.InlineKeyboardButton("↩️ رجوع", callback_data="ad_back"))
+    return kb
 
 @dp.callback_query_handler(lambda c:c.data=="ad_prices")
 async def ad_prices(c: types.CallbackQuery, state:FSMContext):
     if not is_admin(c.from_user.id): return
-    kb = types.InlineKeyboardMarkup(row_width=2)
-    for name, code in COUNTRIES:
-        kb.insert(types.InlineKeyboardButton(f"{name} ({get_price(code)} {CURRENCY})", callback_data=f"adp_{code}"))
-    kb.add(types.InlineKeyboardButton("↩️ رجوع", callback_data="ad_back"))
-    await c.message.edit_text("💰 اختر دولة لتعديل السعر:", reply_markup=kb)
+    await c.message.edit_text("💰 اختر دولة لتعديل السعر الأدنى (يُطبَّق إن كان أعلى من سعر القائمة):", reply_markup=await price_keyboard("admin_prices", _admin_prices_kb))
 
 @dp.callback_query_handler(lambda c:c.data.startswith("adp_"))
 async def ad_price_pick(c: types.CallbackQuery, state:FSMContext):
@@ -434,20 +705,21 @@ async def ad_price_set(m: types.Message, state:FSMContext):
         await state.finish(); return
     try:
         price = float(m.text.strip())
-        data = await state.get_data()
-        code = data.get("ad_country")
-        set_price(code, price)
-        await state.finish()
-        await m.answer(f"✅ تم تحديث سعر <code>{code}</code> إلى {price} {CURRENCY}.")
-        await admin_panel(m, state)
-    except:
+    except ValueError:
         await m.answer("❌ أدخل رقمًا صالحًا.")
+        return
+    data = await state.get_data()
+    code = data.get("ad_country")
+    await set_price(code, price)
+    await state.finish()
+    await m.answer(f"✅ تم تحديث سعر <code>{code}</code> إلى {price} {CURRENCY}.")
+    await admin_panel(m, state)
 
 @dp.callback_query_handler(lambda c:c.data=="ad_providers")
 async def ad_providers(c: types.CallbackQuery, state:FSMContext):
     if not is_admin(c.from_user.id): return
-    p5 = "مفعل ✅" if get_setting("provider_5sim_enabled","1")=="1" else "معطل ❌"
-    ps = "مفعل ✅" if get_setting("provider_sms_enabled","1")=="1" else "معطل ❌"
+    p5 = "مفعل ✅" if await get_setting("provider_5sim_enabled","1")=="1" else "معطل ❌"
+    ps = "مفعل ✅" if await get_setting("provider_sms_enabled","1")=="1" else "معطل ❌"
     ap5 = "موجود 🔐" if FIVESIM_API_KEY else "غير مُضاف ⚠️"
     aps = "موجود 🔐" if SMSACTIVATE_API_KEY else "غير مُضاف ⚠️"
     kb = types.InlineKeyboardMarkup(row_width=2)
@@ -465,15 +737,17 @@ async def ad_providers(c: types.CallbackQuery, state:FSMContext):
 @dp.callback_query_handler(lambda c:c.data=="tog_5sim")
 async def tog_5sim(c: types.CallbackQuery):
     if not is_admin(c.from_user.id): return
-    cur = get_setting("provider_5sim_enabled","1")
-    set_setting("provider_5sim_enabled", "0" if cur=="1" else "1")
+    cur = await get_setting("provider_5sim_enabled","1")
+    await set_setting("provider_5sim_enabled", "0" if cur=="1" else "1")
+    await catalog.rebuild()
     await ad_providers(c, None)
 
 @dp.callback_query_handler(lambda c:c.data=="tog_sms")
 async def tog_sms(c: types.CallbackQuery):
     if not is_admin(c.from_user.id): return
-    cur = get_setting("provider_sms_enabled","1")
-    set_setting("provider_sms_enabled", "0" if cur=="1" else "1")
+    cur = await get_setting("provider_sms_enabled","1")
+    await set_setting("provider_sms_enabled", "0" if cur=="1" else "1")
+    await catalog.rebuild()
     await ad_providers(c, None)
 
 @dp.callback_query_handler(lambda c:c.data=="ad_channels")
@@ -492,11 +766,65 @@ async def ad_channels(c: types.CallbackQuery, state:FSMContext):
 @dp.callback_query_handler(lambda c:c.data=="ad_stats")
 async def ad_stats(c: types.CallbackQuery, state:FSMContext):
     if not is_admin(c.from_user.id): return
-    with closing(sqlite3.connect(DB)) as con:
-        users = con.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        orders= con.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
-    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("↩️ رجوع", callback_data="ad_back"))
-    await c.message.edit_text(f"📈 <b>إحصائيات</b>\n• المستخدمون: {users}\n• الطلبات: {orders}", reply_markup=kb)
+    st = await db_stats(days=1)
+    users, orders = st.get("users", {}).get("", (0, 0))[0], st.get("orders", {}).get("", (0, 0))[0]
+    done, revenue = st.get("revenue", {}).get("", (0, 0.0))
+    hits, misses = POOL_TAKES.get(("hit",)), POOL_TAKES.get(("miss",))
+    today = sum(a for _, a in st.get("day", {}).values())
+    statuses = " | ".join(f"{_STATUS_NAMES.get(k, k)} {n}" for k, (n, _) in sorted(st.get("status", {}).items()) if n)
+    kb = types.InlineKeyboardMarkup(row_width=2).add(
+        types.InlineKeyboardButton("🔎 تفصيل", callback_data="ad_stats_more"),
+        types.InlineKeyboardButton("↩️ رجوع", callback_data="ad_back"),
+    )
+    await c.message.edit_text(f"📈 <b>إحصائيات</b>\n• المستخدمون: {users}\n• الطلبات: {orders}\n"
+                              f"• الحالات: {statuses or '—'}\n"
+                              f"• الإيراد: {revenue:.2f} {CURRENCY} ({done} مكتملة) | اليوم: {today:.2f} {CURRENCY}\n"
+                              f"• الكاش: {CACHE_STATS['hits']} إصابة / {CACHE_STATS['misses']} إخفاق\n"
+                              f"• دفتر الرصيد: {LEDGER_STATS['ops']} عملية في {LEDGER_STATS['batches']} دفعة\n"
+                              f"• مخزون الأرقام: {pool.size} جاهز | إصابة {hits}/{hits + misses}\n"
+                              f"• الإشعارات: بالطابور {notifier.depth} | أُرسلت {notifier.stats['sent']} | "
+                              f"دُمجت {notifier.stats['merged']} | أُسقطت {notifier.stats['dropped'] + notifier.stats['failed']}",
+                              reply_markup=kb)
+
+def _breakdown(rows, top=10):
+    rows = sorted(((k or "—", n) for k, (n, _) in rows.items() if n), key=lambda r: -r[1])
+    return "\n".join(f"  • {k}: {n}" for k, n in rows[:top]) or "  • —"
+
+@dp.callback_query_handler(lambda c:c.data=="ad_stats_more")
+async def ad_stats_more(c: types.CallbackQuery, state:FSMContext):
+    if not is_admin(c.from_user.id): return
+    st = await db_stats(days=7)
+    days = "\n".join(f"  • {d}: {a:.2f} {CURRENCY} ({n})" for d, (n, a) in sorted(st.get("day", {}).items(), reverse=True))
+    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("↩️ رجوع", callback_data="ad_stats"))
+    await c.message.edit_text(f"🔎 <b>تفصيل الطلبات</b>\n"
+                              f"🔌 حسب المزوّد:\n{_breakdown(st.get('provider', {}))}\n"
+                              f"🌍 حسب الدولة:\n{_breakdown(st.get('country', {}))}\n"
+                              f"📱 حسب الخدمة:\n{_breakdown(st.get('service', {}))}\n"
+                              f"💵 الإيراد آخر 7 أيام:\n{days or '  • —'}",
+                              reply_markup=kb)
+
+@dp.callback_query_handler(lambda c:c.data in ("ad_profiler", "prof_toggle"))
+async def ad_profiler(c: types.CallbackQuery, state:FSMContext):
+    # محلّل بأخذ العينات لخيط الحلقة؛ يعمل في العملية التي عالجت الضغطة فقط
+    if not is_admin(c.from_user.id): return
+    text = ""
+    if c.data == "prof_toggle":
+        if sampler.running:
+            sampler.stop()
+            secs = time.monotonic() - sampler.started_at
+            top = "\n".join(f"• {n * 100 / max(1, sampler.samples):.1f}% <code>{html.escape(f)}</code>"
+                            for f, n in sampler.top(10))
+            text = f"⏹ أُوقف بعد {secs:.0f} ث و{sampler.samples} عينة. الأعلى (وقت ذاتي):\n{top or '—'}\n\n"
+        else:
+            sampler.start()
+    state_line = f"🟢 يعمل ({sampler.samples} عينة)" if sampler.running else "⚪️ متوقف"
+    kb = types.InlineKeyboardMarkup(row_width=2).add(
+        types.InlineKeyboardButton("⏹ إيقاف وعرض" if sampler.running else "▶️ تشغيل", callback_data="prof_toggle"),
+        types.InlineKeyboardButton("↩️ رجوع", callback_data="ad_back"),
+    )
+    where = f"http://{METRICS_HOST}:{METRICS_PORT + WORKER_INDEX}/profile" if METRICS_PORT else "—"
+    await c.message.edit_text(f"🔬 <b>المحلّل</b>\n{text}• الحالة: {state_line}\n• المكدسات الكاملة: <code>{where}</code>",
+                              reply_markup=kb)
 
 @dp.callback_query_handler(lambda c:c.data=="ad_back")
 async def ad_back(c: types.CallbackQuery):
@@ -508,26 +836,291 @@ async def ad_back(c: types.CallbackQuery):
     D=Dummy(); D.from_user=c.from_user
     await admin_panel(D, None)
 
+@dp.message_handler(commands=["order"])
+async def ad_order(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    try:
+        order_id = int(m.get_args().split()[0])
+    except (IndexError, ValueError):
+        await m.answer("الاستخدام: <code>/order رقم_الطلب</code>")
+        return
+    o = await archiver.get_order(order_id)
+    if o is None:
+        await m.answer(f"❌ لا يوجد طلب #{order_id}.")
+        return
+    await m.answer(f"🧾 <b>طلب #{o[0]}</b>\n"
+                   f"• المستخدم: <a href='tg://user?id={o[1]}'>{o[1]}</a>\n"
+                   f"• المزوّد: <code>{o[2]}</code> (<code>{o[9] or '—'}</code>)\n"
+                   f"• الدولة/الخدمة: <code>{o[3]}</code> / <code>{o[4]}</code>\n"
+                   f"• الرقم: <code>{o[5]}</code>\n"
+                   f"• السعر: {o[6]} {CURRENCY}\n"
+                   f"• الحالة: {_STATUS_NAMES.get(o[7], o[7])}\n"
+                   f"• الكود: <code>{o[12] or '—'}</code>\n"
+                   f"• التاريخ: {o[8]}")
+
+@dp.message_handler(commands=["deposit"])
+async def ad_deposit(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    parts = m.get_args().split()
+    try:
+        user_id, amount = int(parts[0]), float(parts[1])
+    except (IndexError, ValueError):
+        await m.answer("الاستخدام: <code>/deposit آيدي_المستخدم المبلغ</code> (مبلغ سالب للخصم)")
+        return
+    balance = await ledger_deposit(user_id, amount)
+    if balance is None:
+        await m.answer("❌ المستخدم غير موجود أو الرصيد لا يسمح بالخصم.")
+        return
+    await m.answer(f"✅ رصيد <code>{user_id}</code> الآن {balance:.3f} {CURRENCY}.")
+    if amount > 0:
+        try:
+            await bot.send_message(user_id, f"💳 تم شحن رصيدك بمبلغ {amount} {CURRENCY}.\nرصيدك الحالي: {balance:.3f} {CURRENCY}")
+        except Exception as e:
+            count_error("ad_deposit", e)
+
+@dp.callback_query_handler(lambda c:c.data=="ad_broadcast")
+async def ad_broadcast(c: types.CallbackQuery, state:FSMContext):
+    if not is_admin(c.from_user.id): return
+    await AdminBroadcast.message.set()
+    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ إلغاء", callback_data="bc_cancel"))
+    await c.message.edit_text("📢 أرسل الآن الرسالة المراد نشرها (نص، صورة، ملف…)؛ ستُنسخ كما هي لكل المستخدمين.",
+                              reply_markup=kb)
+
+@dp.message_handler(state=AdminBroadcast.message, content_types=types.ContentTypes.ANY)
+async def bc_preview(m: types.Message, state:FSMContext):
+    if not is_admin(m.from_user.id):
+        await state.finish(); return
+    await state.update_data(bc_src=m.message_id)
+    kb = types.InlineKeyboardMarkup(row_width=2).add(
+        types.InlineKeyboardButton("✅ إرسال", callback_data="bc_go"),
+        types.InlineKeyboardButton("❌ إلغاء", callback_data="bc_cancel"),
+    )
+    await m.reply(f"📢 سيتم نسخ هذه الرسالة إلى {await broadcaster.recipients()} مستخدم. تأكيد؟", reply_markup=kb)
+
+@dp.callback_query_handler(lambda c:c.data=="bc_go", state=AdminBroadcast.message)
+async def bc_go(c: types.CallbackQuery, state:FSMContext):
+    if not is_admin(c.from_user.id): return
+    src = (await state.get_data()).get("bc_src")
+    await state.finish()
+    await c.message.edit_text("📢 جارٍ البدء…")
+    bid = await broadcaster.start(c.from_user.id, c.message.chat.id, src, c.message.chat.id, c.message.message_id)
+    if bid is None:
+        await c.message.edit_text("⚠️ يوجد إرسال جماعي جارٍ؛ انتظر انتهاءه أو أوقفه أولًا.")
+
+@dp.callback_query_handler(lambda c:c.data=="bc_cancel", state="*")
+async def bc_cancel(c: types.CallbackQuery, state:FSMContext):
+    if not is_admin(c.from_user.id): return
+    await state.finish()
+    await c.message.edit_text("🛠 <b>لوحة تحكم الإدارة</b>", reply_markup=ADMIN_KB)
+
+@dp.callback_query_handler(lambda c:c.data.startswith("bc_stop_"))
+async def bc_stop(c: types.CallbackQuery):
+    if not is_admin(c.from_user.id): return
+    await broadcaster.cancel(int(c.data.rsplit("_", 1)[1]))
+    await c.answer("⏹ سيتوقف الإرسال خلال ثوانٍ.")
+
+# =============== التصدير ===============
+EXPORT_MAX_BYTES = 50 * 1024 * 1024     # حد رفع الملفات لبوتات تيليجرام
+EXPORT_TITLES = {"orders": "الطلبات", "users": "المستخدمون", "ledger": "دفتر الرصيد"}
+
+_kb = types.InlineKeyboardMarkup(row_width=3)
+_kb.add(
+    types.InlineKeyboardButton("🧾 آخر 7 أيام", callback_data="exp_orders_7"),
+    types.InlineKeyboardButton("🧾 آخر 30 يومًا", callback_data="exp_orders_30"),
+    types.InlineKeyboardButton("🧾 كل الطلبات", callback_data="exp_orders_0"),
+)
+_kb.add(
+    types.InlineKeyboardButton("👥 المستخدمون", callback_data="exp_users"),
+    types.InlineKeyboardButton("💳 دفتر الرصيد", callback_data="exp_ledger"),
+)
+_kb.add(types.InlineKeyboardButton("↩️ رجوع", callback_data="ad_back"))
+EXPORT_KB = frozen(_kb)
+
+async def _export_status(chat_id, message_id, text):
+    try:
+        await bot.edit_message_text(text, chat_id, message_id)
+    except Exception as e:
+        count_error("export_progress", e)
+
+async def run_export(task, chat_id, message_id, kind, start=None, end=None):
+    # الكتابة في خيط التصدير؛ هنا فقط تحديث رسالة التقدم ثم الرفع
+    title = EXPORT_TITLES[kind]
+    while not task.done():
+        await asyncio.wait({task}, timeout=5)
+        if not task.done():
+            await _export_status(chat_id, message_id, f"⏳ جارٍ تصدير {title}… {exporter.progress[0]} صف")
+    try:
+        path, rows = task.result()
+    except Exception as e:
+        count_error("export", e)
+        await _export_status(chat_id, message_id, "❌ فشل التصدير، راجع السجلات.")
+        return
+    try:
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await _export_status(chat_id, message_id, f"⚠️ الملف {size / 1048576:.1f} ميغابايت، أكبر من حد تيليجرام (50). "
+                                                      f"ضيّق المدى: <code>/export orders 2024-01-01 2024-02-01</code>")
+            return
+        name = f"{kind}-{start[:10]}_{end[:10]}.csv.gz" if start else f"{kind}-{datetime.utcnow():%Y-%m-%d}.csv.gz"
+        await bot.edit_message_text(f"📤 جارٍ رفع {title} ({rows} صف)…", chat_id, message_id)
+        await bot.send_document(chat_id, types.InputFile(path, filename=name), caption=f"📤 {title}: {rows} صف")
+    except Exception as e:
+        # المهمة بلا منتظر (ensure_future): لا نترك الرسالة على «جارٍ الرفع»
+        count_error("export_upload", e)
+        await _export_status(chat_id, message_id, f"❌ فشل رفع {title} ({type(e).__name__})، حاول مجددًا.")
+        return
+    finally:
+        os.unlink(path)
+    try:
+        await bot.delete_message(chat_id, message_id)
+    except Exception as e:
+        count_error("export_progress", e)
+
+async def _start_export(chat_id, kind, start=None, end=None, message:types.Message=None):
+    task = exporter.start(kind, start, end)
+    if task is None:
+        return False
+    if message is None:
+        message = await bot.send_message(chat_id, "⏳ جارٍ التصدير…")
+    else:
+        await message.edit_text("⏳ جارٍ التصدير…")
+    asyncio.ensure_future(run_export(task, chat_id, message.message_id, kind, start, end))
+    return True
+
+@dp.callback_query_handler(lambda c:c.data=="ad_export")
+async def ad_export(c: types.CallbackQuery):
+    if not is_admin(c.from_user.id): return
+    await c.message.edit_text("📤 <b>تصدير CSV مضغوط</b>\nللطلبات بمدى محدد: <code>/export orders 2024-01-01 2024-02-01</code>",
+                              reply_markup=EXPORT_KB)
+
+@dp.callback_query_handler(lambda c:c.data.startswith("exp_"))
+async def exp_pick(c: types.CallbackQuery):
+    if not is_admin(c.from_user.id): return
+    parts = c.data.split("_")
+    start = end = None
+    if parts[1] == "orders":
+        # النهاية حصرية (بداية الغد)، فآخر N أيام تشمل اليوم
+        end = datetime.utcnow() + timedelta(days=1)
+        start = end - timedelta(days=int(parts[2])) if int(parts[2]) else datetime(2000, 1, 1)
+        start, end = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+    if not await _start_export(c.message.chat.id, parts[1], start, end, message=c.message):
+        await c.answer("⏳ يوجد تصدير جارٍ، انتظر انتهاءه.", show_alert=True)
+
+@dp.message_handler(commands=["export"])
+async def exp_command(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    parts = m.get_args().split()
+    kind = parts[0] if parts else ""
+    start = end = None
+    try:
+        if kind == "orders":
+            start, end = (datetime.strptime(p, "%Y-%m-%d").strftime("%Y-%m-%d") for p in parts[1:3])
+        elif kind not in EXPORT_TITLES:
+            raise ValueError(kind)
+    except ValueError:
+        await m.answer("الاستخدام: <code>/export orders من إلى</code> (YYYY-MM-DD، النهاية غير مشمولة)\n"
+                       "أو <code>/export users</code> / <code>/export ledger</code>")
+        return
+    if not await _start_export(m.chat.id, kind, start, end):
+        await m.answer("⏳ يوجد تصدير جارٍ، انتظر انتهاءه.")
+
 # =============== تحويل رسائل العملاء إلى قناة الدعم ===============
 @dp.message_handler(content_types=types.ContentTypes.TEXT)
+async def route_text(m: types.Message, state:FSMContext):
+    handler = BUTTONS.get(m.text)
+    if handler is not None:
+        await handler(m, state)
+    else:
+        await route_to_support(m)
+
 async def route_to_support(m: types.Message):
-    # تجاهل أزرارنا المعروفة
-    known = {"⚡ طلب رقم","👤 لوحة الحساب","🧾 شروط الاستخدام","🆘 الدعم والمساعدة",
-             "🏠 الصفحة الرئيسية","🔙 رجوع","💡 إنشاء حساب","✅ تسجيل الدخول","📊 الإحصائيات"}
-    if m.text in known:
-        return
-    try:
-        await bot.send_message(
-            CH_SUPPORT_IN,
-            f"📩 <b>رسالة عميل</b>\n"
-            f"• من: <a href='tg://user?id={m.from_user.id}'>{m.from_user.full_name}</a> (<code>{m.from_user.id}</code>)\n"
-            f"• النص:\n{m.text}"
-        )
-        await m.answer("✅ تم تحويل رسالتك للدعم. سنعاود التواصل معك قريبًا.", reply_markup=main_menu(db_get_balance(m.from_user.id)))
-    except:
-        await m.answer("⚠️ تعذر تحويل رسالتك الآن. حاول لاحقًا.")
+    notifier.push(
+        CH_SUPPORT_IN,
+        f"📩 <b>رسالة عميل</b>\n"
+        f"• من: <a href='tg://user?id={m.from_user.id}'>{m.from_user.full_name}</a> (<code>{m.from_user.id}</code>)\n"
+        f"• النص:\n{m.text}",
+        kind="رسالة عميل",
+        summary=f"📩 <a href='tg://user?id={m.from_user.id}'>{m.from_user.id}</a>: {m.text}"
+    )
+    await m.answer("✅ تم تحويل رسالتك للدعم. سنعاود التواصل معك قريبًا.", reply_markup=main_menu())
+
+# =============== القياسات والحد من الإغراق ===============
+def resolve_handler(handler, obj):
+    # route_text يوجّه لزر أو للدعم؛ نقيس ونحدّ باسم المعالج الفعلي
+    if handler is route_text:
+        return BUTTONS.get(obj.text, route_to_support)
+    return handler
+
+_THROTTLE_GROUPS = {}
+for _group, _handlers in (
+        ("order", (order_entry, countries_page, picked_country, services_page, picked_service,
+                   change_number, cancel_number, relist_countries)),
+        ("support", (route_to_support,)),
+        ("admin", (admin_panel, ad_prices, ad_price_pick, ad_price_set, ad_providers, tog_5sim, tog_sms,
+                   ad_channels, ad_stats, ad_stats_more, ad_profiler, ad_back, ad_order, ad_deposit,
+                   ad_broadcast, bc_preview, bc_go, bc_cancel, bc_stop, ad_export, exp_pick, exp_command))):
+    _THROTTLE_GROUPS.update(dict.fromkeys(_handlers, _group))
+
+throttle = ThrottleMiddleware(THROTTLE_LIMITS, lambda h, obj: _THROTTLE_GROUPS.get(resolve_handler(h, obj)),
+                              lag_threshold=SHED_LAG, idle_ttl=THROTTLE_IDLE_TTL)
+dp.middleware.setup(MetricsMiddleware(resolve=resolve_handler))
+dp.middleware.setup(throttle)
+
+@dp.errors_handler()
+async def count_errors(update, error):
+    count_error(current_handler_name(), error)
+
+metrics.register(metrics.Gauge("bot_notify_queue_depth", "Pending admin-channel notifications", lambda: notifier.depth))
+metrics.register(metrics.Gauge("bot_open_orders", "Orders tracked by the code poller", lambda: len(poller.orders)))
+_metrics_runner = None
 
 # =============== تشغيل ===============
+async def on_startup(_):
+    global _metrics_runner
+    if METRICS_PORT:
+        _metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT + WORKER_INDEX, sampler)
+    throttle.start()
+    await load_cache()
+    start_flusher(shared=WORKERS > 1)
+    await router.start()
+    catalog.start()
+    if WORKER_INDEX == 0:
+        await ledger_reconcile()
+        await broadcaster.resume()
+        archiver.start()
+    await poller.load(shard=(WORKER_INDEX, WORKERS))
+    poller.start()
+    pool.start()
+
+async def on_shutdown(_):
+    sampler.stop()
+    await throttle.stop()
+    await broadcaster.close()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+    await notifier.close()
+    await poller.stop()
+    await pool.close()
+    await catalog.stop()
+    await archiver.stop()
+    exporter.close()
+    await router.close()
+    await dp.storage.close()
+    await shutdown_db()
+
 if __name__ == "__main__":
     init_db()
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    if BOT_MODE == "webhook" and WEBHOOK_WORKERS > 1:
+        webhook.run_front(bot, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                          WEBHOOK_URL + WEBHOOK_PATH, WEBHOOK_WORKERS)
+    elif BOT_MODE == "webhook":
+        webhook.run_worker(dp, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_CONCURRENCY,
+                           on_startup, on_shutdown, webhook_url=WEBHOOK_URL + WEBHOOK_PATH)
+    elif BOT_MODE == "worker":
+        webhook.run_worker(dp, "127.0.0.1", int(os.environ["WORKER_PORT"]), WEBHOOK_PATH, WEBHOOK_SECRET,
+                           WEBHOOK_CONCURRENCY, on_startup, on_shutdown)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
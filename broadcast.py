@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# =============== الرسائل الجماعية ===============
+# يُنسخ رسالة الأدمن (copy_message، أي نوع محتوى) لكل المستخدمين غير المحظورين.
+# المستلمون يُقرؤون صفحةً صفحة بمؤشر على user_id (WHERE user_id > ? LIMIT n)
+# فلا يُحمَّل الجدول في الذاكرة، والإرسال بتوازٍ محدود تحت دلو رموز عام
+# (حد تيليجرام نحو 30 رسالة/ث) مع احترام RetryAfter لكل البث. نقطة الاستئناف
+# هي آخر user_id اكتملت كل الإرسالات قبله، تُحفظ دوريًا مع العدّادات، فإعادة
+# التشغيل تكمل من حيث توقف البث. التقدم يظهر بتعديل رسالة واحدة لدى الأدمن.
+# أعطال الشبكة والمهلة تُعاد محاولتها لكل مستلم عددًا محدودًا ثم يُحسب فاشلًا،
+# فلا يوقف عطلٌ واحد البث ولا يبقى مستلم بلا نتيجة تعلق عندها نقطة الاستئناف.
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import aiohttp
+from aiogram import types
+from aiogram.utils.exceptions import (BotBlocked, ChatNotFound, MessageNotModified, NetworkError, RetryAfter,
+                                      TelegramAPIError, UserDeactivated)
+
+from db import read, write
+from metrics import count_error
+from notify import TokenBucket
+
+log = logging.getLogger(__name__)
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+RUNNING, DONE, CANCELED = "running", "done", "canceled"
+
+
+def _create(con, admin_id, src_chat, src_message, chat_id, message_id):
+    if con.execute("SELECT 1 FROM broadcasts WHERE status=?", (RUNNING,)).fetchone():
+        return None
+    total = con.execute("SELECT COUNT(*) FROM users WHERE blocked=0").fetchone()[0]
+    cur = con.execute("INSERT INTO broadcasts(admin_id,src_chat,src_message,chat_id,message_id,status,total,created_at) "
+                      "VALUES(?,?,?,?,?,?,?,?)", (admin_id, src_chat, src_message, chat_id, message_id, RUNNING, total,
+                                                  datetime.utcnow().isoformat()))
+    return cur.lastrowid
+
+
+def _page(con, after, limit):
+    return [r[0] for r in con.execute("SELECT user_id FROM users WHERE user_id>? AND blocked=0 "
+                                      "ORDER BY user_id LIMIT ?", (after, limit))]
+
+
+def _checkpoint(con, bid, last_user_id, counts, blocked_ids, status):
+    if blocked_ids:
+        con.executemany("UPDATE users SET blocked=1 WHERE user_id=?", [(u,) for u in blocked_ids])
+    con.execute("UPDATE broadcasts SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+?, "
+                "status=CASE WHEN status=? THEN ? ELSE status END, "
+                "finished_at=CASE WHEN ?<>? THEN ? ELSE finished_at END WHERE id=?",
+                (last_user_id, counts[SENT], counts[FAILED], counts[BLOCKED], RUNNING, status,
+                 status, RUNNING, datetime.utcnow().isoformat(), bid))
+    return con.execute("SELECT * FROM broadcasts WHERE id=?", (bid,)).fetchone()
+
+
+def _recipients(con):
+    return con.execute("SELECT COUNT(*) FROM users WHERE blocked=0").fetchone()[0]
+
+
+def _set_status(con, bid, status):
+    con.execute("UPDATE broadcasts SET status=?, finished_at=? WHERE id=? AND status=?",
+                (status, datetime.utcnow().isoformat(), bid, RUNNING))
+
+
+def _running(con):
+    return con.execute("SELECT * FROM broadcasts WHERE status=?", (RUNNING,)).fetchall()
+
+
+def _get(con, bid):
+    return con.execute("SELECT * FROM broadcasts WHERE id=?", (bid,)).fetchone()
+
+
+# ترتيب أعمدة broadcasts
+_ID, _ADMIN, _SRC_CHAT, _SRC_MSG, _CHAT, _MSG, _STATUS, _LAST, _TOTAL, _SENT, _FAILED, _BLOCKED = range(12)
+
+
+class Broadcaster:
+    def __init__(self, bot, rate=25.0, concurrency=10, page=500, progress_every=3.0, retries=3, retry_delay=1.0):
+        self.bot = bot
+        self.rate = rate                # رسائل/ثانية لكل البث
+        self.concurrency = concurrency
+        self.retries = retries          # محاولات إضافية لكل مستلم عند عطل شبكة/مهلة
+        self.retry_delay = retry_delay  # تتضاعف مع كل محاولة
+        self.page = page
+        self.progress_every = progress_every
+        self._tasks = {}                # broadcast id -> Task
+        self._stopping = False
+
+    async def start(self, admin_id, src_chat, src_message, chat_id, message_id):
+        """بدء بث جديد؛ None إن كان هناك بث جارٍ."""
+        bid = await write(_create, admin_id, src_chat, src_message, chat_id, message_id)
+        if bid is not None:
+            self._spawn(await read(_get, bid))
+        return bid
+
+    async def resume(self):
+        """استئناف كل بث لم يكتمل قبل إعادة التشغيل."""
+        for row in await read(_running):
+            if row[_ID] not in self._tasks:
+                log.info("resuming broadcast #%s after user %s", row[_ID], row[_LAST])
+                self._spawn(row)
+
+    async def recipients(self):
+        return await read(_recipients)
+
+    async def cancel(self, bid):
+        # البث قد يجري في عامل آخر: الحالة في القاعدة تُقرأ مع كل نقطة حفظ
+        await write(_set_status, bid, CANCELED)
+
+    async def close(self):
+        """إيقاف أخذ مستلمين جدد، انتظار الجاري منها، ثم حفظ نقطة الاستئناف."""
+        self._stopping = True
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _spawn(self, row):
+        task = asyncio.get_running_loop().create_task(self._run(row))
+        self._tasks[row[_ID]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(row[_ID], None))
+
+    async def _run(self, row):
+        bid, last = row[_ID], row[_LAST]
+        bucket = TokenBucket(self.rate, max(1, int(self.rate)))
+        paused_until = 0.0
+        counts = {SENT: 0, FAILED: 0, BLOCKED: 0}
+        blocked_ids = []
+        ids, results, mark = [], [], 0      # الصفحة الحالية ونتائجها؛ mark = أول غير مكتمل
+        next_report = time.monotonic() + self.progress_every
+
+        async def send(i, user_id):
+            nonlocal paused_until
+            attempt = 0
+            while True:
+                wait = paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await bucket.acquire()
+                try:
+                    await self.bot.copy_message(user_id, row[_SRC_CHAT], row[_SRC_MSG])
+                    results[i] = SENT
+                except RetryAfter as e:
+                    # تيليجرام يطلب التوقف: يتوقف البث كله لا هذه الرسالة فقط
+                    paused_until = max(paused_until, time.monotonic() + e.timeout)
+                    continue
+                except (BotBlocked, UserDeactivated, ChatNotFound):
+                    results[i] = BLOCKED
+                except (NetworkError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt < self.retries:
+                        await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                        attempt += 1
+                        continue
+                    count_error("broadcast", e)
+                    results[i] = FAILED
+                except Exception as e:
+                    # أي خطأ آخر (TelegramAPIError وغيره) يُفشل هذا المستلم وحده
+                    count_error("broadcast", e)
+                    results[i] = FAILED
+                return
+
+        def advance():
+            # نقطة الاستئناف تتقدم فقط على بادئة مكتملة، فلا يتكرر إرسال بعد الاستئناف
+            nonlocal mark, last
+            while mark < len(ids) and results[mark] is not None:
+                counts[results[mark]] += 1
+                if results[mark] == BLOCKED:
+                    blocked_ids.append(ids[mark])
+                last = ids[mark]
+                mark += 1
+
+        async def checkpoint(status=RUNNING):
+            advance()
+            state = await write(_checkpoint, bid, last, counts, blocked_ids, status)
+            for k in counts:
+                counts[k] = 0
+            blocked_ids.clear()
+            await self._report(state)
+            return state
+
+        try:
+            while not self._stopping:
+                ids = await read(_page, last, self.page)
+                if not ids:
+                    await checkpoint(DONE)
+                    return
+                results, mark = [None] * len(ids), 0
+                pending = set()
+                for i, user_id in enumerate(ids):
+                    if self._stopping:
+                        break
+                    # لا نُنشئ مهام أكثر من الحد: ننتظر مقعدًا قبل المستلم التالي
+                    while len(pending) >= self.concurrency:
+                        _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    pending.add(asyncio.ensure_future(send(i, user_id)))
+                    if time.monotonic() >= next_report:
+                        next_report = time.monotonic() + self.progress_every
+                        if (await checkpoint())[_STATUS] != RUNNING:
+                            await asyncio.gather(*pending, return_exceptions=True)
+                            await checkpoint()
+                            return
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+                if (await checkpoint())[_STATUS] != RUNNING:
+                    return
+        except Exception as e:
+            count_error("broadcast", e)
+            log.exception("broadcast #%s stopped", bid)
+
+    async def _report(self, row):
+        total, sent, failed, blocked = row[_TOTAL], row[_SENT], row[_FAILED], row[_BLOCKED]
+        done = sent + failed + blocked
+        head = {RUNNING: "📢 <b>جارٍ الإرسال</b>", DONE: "✅ <b>اكتمل الإرسال</b>",
+                CANCELED: "⏹ <b>أُوقف الإرسال</b>"}.get(row[_STATUS], row[_STATUS])
+        pct = done * 100 // total if total else 100
+        text = (f"{head} #{row[_ID]}\n"
+                f"• التقدم: {done}/{total} ({min(pct, 100)}%)\n"
+                f"• وصلت: {sent}\n"
+                f"• حظروا البوت: {blocked}\n"
+                f"• فشلت: {failed}")
+        kb = None
+        if row[_STATUS] == RUNNING:
+            kb = types.InlineKeyboardMarkup().add(
+                types.InlineKeyboardButton("⏹ إيقاف", callback_data=f"bc_stop_{row[_ID]}"))
+        try:
+            await self.bot.edit_message_text(text, row[_CHAT], row[_MSG], reply_markup=kb)
+        except MessageNotModified:
+            pass
+        except TelegramAPIError as e:
+            count_error("broadcast_progress", e)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# =============== قائمة المزوّدين وجدول التوجيه ===============
+# مهمة خلفية تجلب قوائم الأسعار والمخزون الكاملة من كل مزوّد مفعّل وتخزّنها في
+# جدول catalog(provider, country, service)، ثم تبني جدول routes: لكل (دولة،
+# خدمة) أرخص مزوّد متوفر وسعر البيع (التكلفة × rate × (1 + margin)) وترتيب
+# المزوّدين البديلين. الجدول يُحمَّل في الذاكرة، فلوحات الدول/الخدمات و
+# picked_service تقرأ منه ببحث واحد. التحليل والبناء خارج حلقة الأحداث.
+import asyncio
+import logging
+import math
+import time
+from collections import namedtuple
+
+import metrics
+from db import read, write, bump_cache_version
+from providers import ProviderError
+
+log = logging.getLogger(__name__)
+
+Route = namedtuple("Route", "provider cost price count providers")
+
+
+def _replace(con, provider, rows, now):
+    con.execute("DELETE FROM catalog WHERE provider=?", (provider,))
+    con.executemany("INSERT OR REPLACE INTO catalog(provider,country,service,cost,count,country_name,updated_at) "
+                    "VALUES(?,?,?,?,?,?,?)", ((provider,) + tuple(r) + (now,) for r in rows))
+
+
+def _rebuild(con, providers, rate, margin, step):
+    bump_cache_version(con)         # العمليات الأخرى تعيد تحميل الجدول (db.CACHE_LISTENERS)
+    con.execute("DELETE FROM routes")
+    if not providers:
+        return
+    marks = ",".join("?" * len(providers))
+    cur = con.execute(f"SELECT country, service, provider, cost, count, country_name FROM catalog "
+                      f"WHERE count>0 AND provider IN ({marks}) ORDER BY country, service, cost", providers)
+    out, key, group = [], None, []
+
+    def emit():
+        _, _, provider, cost, _, _ = group[0]
+        price = math.ceil(cost * rate * (1 + margin) / step) * step
+        name = next((g[5] for g in group if g[5]), "")
+        out.append(key + (provider, cost, round(price, 2), sum(g[4] for g in group),
+                          ",".join(g[2] for g in group), name))
+
+    for row in cur:
+        if row[:2] != key:
+            if group:
+                emit()
+            key, group = row[:2], []
+        group.append(row)
+    if group:
+        emit()
+    con.executemany("INSERT INTO routes(country,service,provider,cost,price,count,providers,country_name) "
+                    "VALUES(?,?,?,?,?,?,?,?)", out)
+
+
+def _load(con):
+    routes, services, countries, names = {}, {}, {}, {}
+    for country, service, provider, cost, price, count, providers, name in con.execute(
+            "SELECT country,service,provider,cost,price,count,providers,country_name FROM routes"):
+        routes[(country, service)] = Route(provider, cost, price, count, tuple(providers.split(",")))
+        services.setdefault(country, []).append(service)
+        countries[country] = countries.get(country, 0) + count
+        if name:
+            names[country] = name
+    return routes, services, countries, names
+
+
+class Catalog:
+    def __init__(self, router, enabled_fn, rate=1.0, margin=0.3, step=0.5, interval=600.0, sync=True):
+        self.router = router
+        self.enabled_fn = enabled_fn    # coroutine → المزوّدون المفعّلون بالترتيب
+        self.rate = rate                # تحويل عملة المزوّد إلى عملة البوت
+        self.margin = margin
+        self.step = step                # تقريب السعر للأعلى لأقرب step
+        self.interval = interval
+        self.sync_enabled = sync        # عامل واحد يزامن، والبقية تعيد التحميل فقط
+        self.routes = {}                # (country, service) -> Route
+        self.services = {}              # country -> [service]
+        self.stock = {}                 # country -> مجموع المخزون
+        self.names = {}                 # country -> اسم من المزوّد
+        self.version = 0
+        self.synced_at = None
+        self._task = None
+
+    def route(self, country, service):
+        return self.routes.get((country, service))
+
+    async def sync(self):
+        """جلب قائمة كل مزوّد مفعّل؛ فشل مزوّد يُبقي قائمته السابقة."""
+        enabled = [p for p in await self.enabled_fn() if p in self.router.providers]
+
+        async def fetch(name):
+            try:
+                rows = await self.router.get(name).catalog()
+            except ProviderError as e:
+                metrics.count_error("catalog", e)
+                log.warning("catalog sync for %s failed: %s", name, e)
+                return
+            if rows:
+                await write(_replace, name, rows, time.time())
+
+        await asyncio.gather(*(fetch(p) for p in enabled))
+        self.synced_at = time.time()
+        await self.rebuild()
+
+    async def rebuild(self):
+        """إعادة بناء جدول التوجيه (مثلًا بعد تفعيل/تعطيل مزوّد) ثم تحميله."""
+        enabled = [p for p in await self.enabled_fn() if p in self.router.providers]
+        await write(_rebuild, enabled, self.rate, self.margin, self.step)
+        await self.reload()
+
+    async def reload(self):
+        self.routes, self.services, self.stock, self.names = await read(_load)
+        self.version += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await (self.sync() if self.sync_enabled else self.reload())
+            except Exception as e:
+                metrics.count_error("catalog", e)
+                log.exception("catalog sync failed")
+            await asyncio.sleep(self.interval)
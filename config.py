@@ -5,11 +5,16 @@ ADMIN_IDS=123456789                  # آيديات المدراء مفصولة
 # قنوات الاشتراك الإجباري (عامة - باليوزرنيم)
 FORCE_CH1=@SMSFARS_1
 FORCE_CH2=@SMSFARS_2
+FORCE_SUB_TTL=300                   # مدة تخزين نتيجة الاشتراك الإيجابية (ثوانٍ)
+FORCE_SUB_NEG_TTL=5                 # مدة تخزين النتيجة السلبية
+FORCE_SUB_CACHE_SIZE=10000
 
 # قنوات/مجموعات خاصة (chat_id تبدأ بـ -100)
 CH_ATTEMPTS=-1002627555519          # قناة محاولات الشراء (خاص)
 CH_LOGIN=-10026017331               # إشعارات تسجيل الدخول (تأكّد)
 CH_SUPPORT_IN=-1002555952121        # تجميع رسائل العملاء من البوت (خاص)
+NOTIFY_RATE_PER_MIN=20              # حد الرسائل لكل قناة إدارة؛ الزائد يُدمج في ملخّص
+NOTIFY_BURST=3
 
 # قنوات عامة (للعرض فقط هنا – نستعمل يوزرنيم للاشتراك الإجباري)
 PUBLIC_ACTIVATIONS=@SMSFARS_2        # قناة التفعيلات العامة
@@ -18,6 +23,68 @@ PUBLIC_OFFICIAL=@SMSFARS_1           # القناة الرسمية العامة
 # مفاتيح مزودي الأرقام (أضِفها لاحقًا بأمان)
 FIVESIM_API_KEY=
 SMSACTIVATE_API_KEY=
+FIVESIM_TIMEOUT=10                  # مهلة كل طلب للمزوّد (ثوانٍ)
+SMSACTIVATE_TIMEOUT=10
+PROVIDER_RETRIES=2
+ORDER_TTL=1200                      # مهلة الرقم قبل إلغائه تلقائيًا (ثوانٍ)
+POLL_FIRST_DELAY=3                  # أول فحص للكود بعد (ثوانٍ) ثم تتباعد الفحوص
+POLL_MAX_INTERVAL=30
+POOL_MAX=3                          # أقصى أرقام جاهزة لكل (دولة، خدمة)؛ 0 = تعطيل المخزون
+POOL_HORIZON=60                     # يغطي المخزون الطلب المتوقع خلال (ثوانٍ)
+POOL_MAX_AGE=300                    # يُعاد الرقم غير المباع للمزوّد بعد (ثوانٍ)
+POOL_TICK=5
+CATALOG_RATE=1                      # تحويل عملة المزوّد إلى عملة الرصيد
+CATALOG_MARGIN=0.3                  # هامش الربح فوق أرخص مزوّد متوفر (0.3 = 30%)
+CATALOG_STEP=0.5                    # تقريب سعر البيع للأعلى
+CATALOG_INTERVAL=600                # مزامنة قوائم الأسعار والمخزون كل (ثوانٍ)
+# FIVESIM_URL= / SMSACTIVATE_URL=   # لتوجيه الطلبات لخادم تجريبي محلي (python fakeproviders.py)
 
 # عملة الرصيد
-CURRENCY=₽
\ No newline at end of file
+CURRENCY=₽
+
+# قاعدة البيانات
+DB_PATH=crazy_sms.db
+DB_READERS=4                        # عدد اتصالات/خيوط القراءة
+DB_WRITE_BEHIND=0                   # 1 = تجميع تحديثات last_seen/last_ip وكتابتها دفعةً واحدة
+DB_FLUSH_SECONDS=5
+DB_FLUSH_MAX=500
+DB_KNOWN_USERS=100000               # مستخدمون يُتذكَّر أنهم في القاعدة (الأقدم استعمالًا يُنسى)
+LEDGER_MAX_BATCH=500                # أقصى عمليات رصيد في معاملة واحدة
+DB_MMAP_MB=256                      # ذاكرة mmap لكل اتصال SQLite
+DB_CACHE_MB=16                      # كاش الصفحات لكل اتصال
+DB_OPTIMIZE_HOURS=6                 # PRAGMA optimize دوريًا (0 = فقط عند الإيقاف)
+DB_INIT_BUDGET_MS=200               # تحذير في السجل إن تجاوز تجهيز القاعدة عند الإقلاع هذا الحد
+DB_CACHE_REFRESH_SECONDS=2          # مع WEBHOOK_WORKERS>1: تحقق كل عامل من تعديلات الأسعار/المزوّدين لدى غيره
+ARCHIVE_AFTER_DAYS=30               # نقل الطلبات المنتهية الأقدم من هذا إلى ملفات شهرية (0 = تعطيل)
+# ARCHIVE_DIR=                      # الافتراضي: مجلد archive بجوار ملف القاعدة
+ARCHIVE_INTERVAL_HOURS=6
+
+# القياسات (Prometheus)
+METRICS_HOST=127.0.0.1
+METRICS_PORT=9100                   # 0 = تعطيل؛ مع عدة عمال: 9100 + رقم العامل
+
+# الحد من الإغراق لكل مستخدم (عدد/دقيقة/دفعة) لكل مجموعة معالجات
+THROTTLE_ORDER=20/5
+THROTTLE_ACCOUNT=30/5
+THROTTLE_SUPPORT=6/3
+THROTTLE_ADMIN=120/20
+SHED_LAG=0.5                        # فوق هذا التأخر لحلقة الأحداث (ثوانٍ) يتوقف تحويل رسائل الدعم
+THROTTLE_IDLE_TTL=600               # يُنسى المستخدم الخامل بعد (ثوانٍ)
+
+# الرسائل الجماعية من /admin
+BROADCAST_RATE=25                   # رسالة/ثانية لكل البث (حد تيليجرام نحو 30)
+BROADCAST_CONCURRENCY=10
+
+# حالات المحادثة (FSM)
+FSM_STORAGE=sqlite                  # sqlite أو redis أو memory
+FSM_TTL=86400                       # تُحذف الحالات المهجورة بعد (ثوانٍ)
+# REDIS_URL=redis://localhost:6379/0
+
+# وضع التشغيل
+BOT_MODE=polling                    # polling أو webhook
+WEBHOOK_URL=                        # https://your-app.example.com (بدون المسار)
+WEBHOOK_PATH=/webhook
+WEBHOOK_SECRET=
+WEBAPP_PORT=8080                    # أو PORT الذي توفره المنصة
+WEBHOOK_WORKERS=1                   # >1: عملية أمامية توزّع المستخدمين على N عمليات
+WEBHOOK_CONCURRENCY=64              # أقصى تحديثات متزامنة في العملية الواحدة
@@ -0,0 +1,763 @@
+# -*- coding: utf-8 -*-
+# =============== طبقة قاعدة البيانات (غير حاجبة) ===============
+# كل الاستعلامات تمر عبر مجمّع خيوط: خيط كاتب واحد + عدة خيوط قراءة،
+# ولكل خيط اتصال SQLite دائم (WAL) بدل فتح اتصال جديد مع كل استدعاء.
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from metrics import DB_SECONDS
+
+log = logging.getLogger(__name__)
+
+DB = os.getenv("DB_PATH", "crazy_sms.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+# تأجيل كتابة last_seen/last_ip وتجميعها في دفعة واحدة
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+DB_FLUSH_SECONDS = float(os.getenv("DB_FLUSH_SECONDS", "5"))
+DB_FLUSH_MAX = int(os.getenv("DB_FLUSH_MAX", "500"))
+DB_KNOWN_USERS = int(os.getenv("DB_KNOWN_USERS", "100000"))   # أقصى مستخدمين يُتذكَّر أنهم كُتبوا (LRU)
+# ضبط SQLite لكل اتصال: الذاكرة المخصّصة (MB) وتحديث إحصائيات المخطط دوريًا
+DB_MMAP_MB = int(os.getenv("DB_MMAP_MB", "256"))
+DB_CACHE_MB = int(os.getenv("DB_CACHE_MB", "16"))
+DB_OPTIMIZE_HOURS = float(os.getenv("DB_OPTIMIZE_HOURS", "6"))
+DB_INIT_BUDGET = float(os.getenv("DB_INIT_BUDGET_MS", "200")) / 1000
+# مع عدة عمليات: كل كم ثانية يتحقق العامل من تعديلات الإعدادات/الأسعار لدى غيره
+DB_CACHE_REFRESH = float(os.getenv("DB_CACHE_REFRESH_SECONDS", "2"))
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-reader")
+
+
+def _connect():
+    con = sqlite3.connect(DB, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    # مع WAL يكفي NORMAL: لا فساد عند الانهيار، وقد تضيع آخر معاملة فقط عند انقطاع الكهرباء
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA busy_timeout=5000")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_MB * 1024 * 1024}")
+    con.execute(f"PRAGMA cache_size={-DB_CACHE_MB * 1024}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+
+def _thread_con():
+    con = getattr(_local, "con", None)
+    if con is None:
+        con = _local.con = _connect()
+        with _connections_lock:
+            _connections.append(con)
+    return con
+
+
+def _run_read(fn, args):
+    return fn(_thread_con(), *args)
+
+
+def _run_write(fn, args):
+    con = _thread_con()
+    with con:
+        return fn(con, *args)
+
+
+async def read(fn, *args):
+    """تنفيذ fn(con, *args) على أحد خيوط القراءة."""
+    t = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_readers, _run_read, fn, args)
+    finally:
+        DB_SECONDS.observe((fn.__name__, "read"), time.perf_counter() - t)
+
+
+async def write(fn, *args):
+    """تنفيذ fn(con, *args) داخل معاملة على خيط الكاتب الوحيد."""
+    t = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_writer, _run_write, fn, args)
+    finally:
+        DB_SECONDS.observe((fn.__name__, "write"), time.perf_counter() - t)
+
+
+def _optimize(con):
+    con.execute("PRAGMA optimize")
+
+
+def close_db():
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
+    with _connections_lock:
+        for con in _connections:
+            try:
+                con.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                pass
+            con.close()
+        _connections.clear()
+
+
+# =============== المخطط ===============
+def _add_column(con, table, column, decl):
+    cols = {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# كل خطوة ترفع PRAGMA user_version بواحد وتُطبَّق في معاملتها مع رقمها، فلا
+# يُنفَّذ عند الإقلاع إلا ما لم يُطبَّق بعد. الخطوات 1-5 تصف المخطط كما نما قبل
+# الترقيم، لذا هي متسامحة (IF NOT EXISTS) لتمر على القواعد القديمة بأمان؛
+# الخطوات الجديدة تُضاف في آخر القائمة ولا تُعدَّل خطوة منشورة.
+def _m1_base(con):
+    con.execute("""CREATE TABLE IF NOT EXISTS users(
+        user_id INTEGER PRIMARY KEY,
+        email TEXT,
+        balance REAL DEFAULT 0,
+        created_at TEXT,
+        last_ip TEXT,
+        last_seen TEXT
+    )""")
+    con.execute("""CREATE TABLE IF NOT EXISTS sessions(
+        user_id INTEGER PRIMARY KEY,
+        logged_in INTEGER DEFAULT 0
+    )""")
+    con.execute("""CREATE TABLE IF NOT EXISTS orders(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        provider TEXT,
+        country TEXT,
+        service TEXT,
+        phone TEXT,
+        price REAL,
+        status TEXT,
+        created_at TEXT
+    )""")
+    _add_column(con, "orders", "ext_id", "TEXT")   # رقم التفعيل لدى المزوّد
+    _add_column(con, "orders", "chat_id", "INTEGER")
+    _add_column(con, "orders", "message_id", "INTEGER")
+    _add_column(con, "orders", "code", "TEXT")
+    con.execute("""CREATE TABLE IF NOT EXISTS settings(
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""")
+    con.execute("""CREATE TABLE IF NOT EXISTS prices(
+        country TEXT PRIMARY KEY,
+        price REAL
+    )""")
+    # أسعار افتراضية
+    defaults = {"sa":30,"eg":25,"ye":20,"tr":18}
+    for c,p in defaults.items():
+        con.execute("INSERT OR IGNORE INTO prices(country,price) VALUES(?,?)", (c,p))
+    # مزودون مفعّلون افتراضياً
+    for k,v in [("provider_5sim_enabled","1"),("provider_sms_enabled","1")]:
+        con.execute("INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)",(k,v))
+
+def _m2_fsm(con):
+    con.execute("""CREATE TABLE IF NOT EXISTS fsm(
+        chat TEXT,
+        user TEXT,
+        state TEXT,
+        data TEXT,
+        updated_at REAL,
+        PRIMARY KEY(chat,user)
+    ) WITHOUT ROWID""")
+    con.execute("CREATE INDEX IF NOT EXISTS fsm_updated ON fsm(updated_at)")
+
+def _m3_order_indexes_stats(con):
+    con.execute("CREATE INDEX IF NOT EXISTS orders_user ON orders(user_id, status)")
+    con.execute("CREATE INDEX IF NOT EXISTS orders_created ON orders(created_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS orders_open ON orders(status) WHERE status='WAIT_CODE'")
+    _init_stats(con)
+
+def _m4_ledger(con):
+    # دفتر الرصيد: سجل إلحاقي فقط؛ amount هو أثر العملية على الرصيد
+    # (deposit +، reserve −، commit 0، refund +) فمجموعه لكل مستخدم = رصيده.
+    con.execute("""CREATE TABLE IF NOT EXISTS transactions(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        order_id INTEGER,
+        kind TEXT,
+        amount REAL,
+        created_at TEXT
+    )""")
+    con.execute("CREATE INDEX IF NOT EXISTS tx_user ON transactions(user_id, id)")
+    # حجز واحد لكل طلب، وتسوية واحدة فقط (commit أو refund) — يمنع الصرف المزدوج
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS tx_reserve ON transactions(order_id) WHERE kind='reserve'")
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS tx_settle ON transactions(order_id) WHERE kind IN ('commit','refund')")
+
+def _m5_catalog(con):
+    # قوائم المزوّدين وجدول التوجيه المحسوب منها (catalog.py)
+    con.execute("""CREATE TABLE IF NOT EXISTS catalog(
+        provider TEXT,
+        country TEXT,
+        service TEXT,
+        cost REAL,
+        count INTEGER,
+        country_name TEXT,
+        updated_at REAL,
+        PRIMARY KEY(provider,country,service)
+    ) WITHOUT ROWID""")
+    con.execute("CREATE INDEX IF NOT EXISTS catalog_pair ON catalog(country, service, cost)")
+    con.execute("""CREATE TABLE IF NOT EXISTS routes(
+        country TEXT,
+        service TEXT,
+        provider TEXT,
+        cost REAL,
+        price REAL,
+        count INTEGER,
+        providers TEXT,
+        country_name TEXT,
+        PRIMARY KEY(country,service)
+    ) WITHOUT ROWID""")
+
+def _m6_broadcasts(con):
+    # blocked: حظر المستخدم للبوت (يُكتشف أثناء البث) ويُرفع عند عودته
+    con.execute("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
+    # الرسائل الجماعية (broadcast.py): last_user_id نقطة الاستئناف بعد إعادة التشغيل
+    con.execute("""CREATE TABLE broadcasts(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        src_chat INTEGER,
+        src_message INTEGER,
+        chat_id INTEGER,
+        message_id INTEGER,
+        status TEXT,
+        last_user_id INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        created_at TEXT,
+        finished_at TEXT
+    )""")
+
+def _m7_archive(con):
+    # أرشفة الطلبات القديمة (archive.py): نطاق أرقام الطلبات في كل ملف شهري،
+    # وملخص طلبات كل مستخدم المنقولة للأرشيف
+    con.execute("""CREATE TABLE archive_months(
+        month TEXT PRIMARY KEY,
+        min_id INTEGER,
+        max_id INTEGER,
+        rows INTEGER
+    )""")
+    con.execute("""CREATE TABLE archived_user_stats(
+        user_id INTEGER,
+        status TEXT,
+        n INTEGER,
+        amount REAL,
+        PRIMARY KEY(user_id,status)
+    ) WITHOUT ROWID""")
+
+def _m8_stats_day(con):
+    # عدّاد day كان يُنسب لتاريخ الاكتمال (date('now')) بينما _rebuild_stats ينسبه
+    # لتاريخ الإنشاء؛ نعيد إنشاء المشغّل ونعيد حساب الأيام التي ما زالت طلباتها في الجدول
+    con.execute("DROP TRIGGER IF EXISTS stats_orders_done")
+    con.execute(f"CREATE TRIGGER stats_orders_done {_STATS_TRIGGERS['stats_orders_done']}")
+    first = con.execute("SELECT date(MIN(created_at)) FROM orders").fetchone()[0]
+    if first:
+        con.execute("DELETE FROM stats WHERE kind='day' AND key>=?", (first,))
+        con.execute("INSERT INTO stats SELECT 'day',date(created_at),COUNT(*),COALESCE(SUM(price),0) "
+                    "FROM orders WHERE status='CODE_RECEIVED' GROUP BY 2")
+
+MIGRATIONS = [_m1_base, _m2_fsm, _m3_order_indexes_stats, _m4_ledger, _m5_catalog, _m6_broadcasts, _m7_archive,
+              _m8_stats_day]
+
+def migrate(con):
+    """تطبيق الخطوات المعلّقة فقط؛ يعيد (النسخة السابقة، النسخة الحالية)."""
+    before = con.execute("PRAGMA user_version").fetchone()[0]
+    if before == len(MIGRATIONS):
+        return before, before
+    if before > len(MIGRATIONS):
+        raise SystemExit(f"⚠️ القاعدة بنسخة مخطط {before} أحدث من الكود ({len(MIGRATIONS)})")
+    version = before
+    while version < len(MIGRATIONS):
+        # BEGIN IMMEDIATE ثم إعادة القراءة: عاملان يقلعان معًا لا يطبّقان نفس الخطوة
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            if version < len(MIGRATIONS):
+                step = MIGRATIONS[version]
+                step(con)
+                version += 1
+                con.execute(f"PRAGMA user_version={version}")
+                log.info("schema migration %d (%s) applied", version, step.__name__)
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+    return before, version
+
+def init_db():
+    t = time.perf_counter()
+    with closing(sqlite3.connect(DB, isolation_level=None)) as con:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA busy_timeout=5000")
+        before, after = migrate(con)
+        if before != after:
+            con.execute("PRAGMA optimize")
+    elapsed = time.perf_counter() - t
+    log.log(logging.WARNING if elapsed > DB_INIT_BUDGET else logging.INFO,
+            "init_db: schema v%d → v%d in %.1f ms (budget %.0f ms)", before, after, elapsed * 1000, DB_INIT_BUDGET * 1000)
+    return elapsed
+
+
+# =============== عدّادات الإحصائيات ===============
+# جدول stats(kind, key) تحدّثه المشغّلات (triggers) مع كل كتابة، فلوحة الإدارة
+# تقرأ صفوفًا قليلة بدل COUNT(*) على الجداول. العدّادات تراكمية: حذف/أرشفة
+# الطلبات القديمة لا ينقصها. kind: users, orders, status, provider, country,
+# service, revenue (key فارغ) و day (key = تاريخ إنشاء الطلب، للطلبات المكتملة).
+def _bump(kind, key, n="1", amount="0"):
+    return (f"INSERT INTO stats(kind,key,n,amount) VALUES('{kind}',{key},{n},{amount}) "
+            f"ON CONFLICT(kind,key) DO UPDATE SET n=n+excluded.n, amount=amount+excluded.amount;")
+
+_STATS_TRIGGERS = {
+    "stats_users_ins": "AFTER INSERT ON users BEGIN " + _bump("users", "''") + " END",
+    "stats_orders_ins": ("AFTER INSERT ON orders BEGIN "
+                         + _bump("orders", "''")
+                         + _bump("status", "COALESCE(NEW.status,'')")
+                         + _bump("provider", "COALESCE(NEW.provider,'')")
+                         + _bump("country", "COALESCE(NEW.country,'')")
+                         + _bump("service", "COALESCE(NEW.service,'')") + " END"),
+    "stats_orders_status": ("AFTER UPDATE OF status ON orders WHEN OLD.status IS NOT NEW.status BEGIN "
+                            + _bump("status", "COALESCE(OLD.status,'')", "-1")
+                            + _bump("status", "COALESCE(NEW.status,'')") + " END"),
+    "stats_orders_done": ("AFTER UPDATE OF status ON orders WHEN NEW.status='CODE_RECEIVED' "
+                          "AND OLD.status IS NOT 'CODE_RECEIVED' BEGIN "
+                          + _bump("revenue", "''", "1", "COALESCE(NEW.price,0)")
+                          + _bump("day", "date(NEW.created_at)", "1", "COALESCE(NEW.price,0)") + " END"),
+    "stats_orders_provider": ("AFTER UPDATE OF provider ON orders WHEN OLD.provider IS NOT NEW.provider BEGIN "
+                              + _bump("provider", "COALESCE(OLD.provider,'')", "-1")
+                              + _bump("provider", "COALESCE(NEW.provider,'')") + " END"),
+}
+
+def _init_stats(con):
+    con.execute("""CREATE TABLE IF NOT EXISTS stats(
+        kind TEXT,
+        key TEXT,
+        n INTEGER DEFAULT 0,
+        amount REAL DEFAULT 0,
+        PRIMARY KEY(kind,key)
+    ) WITHOUT ROWID""")
+    for name, body in _STATS_TRIGGERS.items():
+        con.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+    if con.execute("SELECT 1 FROM stats LIMIT 1").fetchone() is None:
+        _rebuild_stats(con)
+
+def _rebuild_stats(con):
+    """ملء العدّادات من الجداول (أول تشغيل بعد الترقية)."""
+    con.execute("DELETE FROM stats")
+    con.execute("INSERT INTO stats SELECT 'users','',COUNT(*),0 FROM users")
+    con.execute("INSERT INTO stats SELECT 'orders','',COUNT(*),0 FROM orders")
+    for col in ("status", "provider", "country", "service"):
+        con.execute(f"INSERT INTO stats SELECT '{col}',COALESCE({col},''),COUNT(*),0 FROM orders GROUP BY 2")
+    con.execute("INSERT INTO stats SELECT 'revenue','',COUNT(*),COALESCE(SUM(price),0) "
+                "FROM orders WHERE status='CODE_RECEIVED'")
+    con.execute("INSERT INTO stats SELECT 'day',date(created_at),COUNT(*),COALESCE(SUM(price),0) "
+                "FROM orders WHERE status='CODE_RECEIVED' GROUP BY 2")
+
+
+# =============== الإعدادات والأسعار ===============
+def _get_setting(con, key, default):
+    r = con.execute("SELECT value FROM settings WHERE key=?",(key,)).fetchone()
+    return r[0] if r else default
+
+def _set_setting(con, key, value):
+    con.execute("INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",(key,str(value)))
+    bump_cache_version(con)
+
+def _get_price(con, country_code, default):
+    r = con.execute("SELECT price FROM prices WHERE country=?",(country_code,)).fetchone()
+    return float(r[0]) if r else default
+
+def _set_price(con, country_code, price):
+    con.execute("INSERT OR REPLACE INTO prices(country,price) VALUES(?,?)",(country_code, float(price)))
+    bump_cache_version(con)
+
+def bump_cache_version(con):
+    """يُستدعى داخل معاملة الكتابة (عبر write) لكل تعديل يجب أن تراه العمليات الأخرى
+    في settings/prices أو ما يتبعهما، مثل جدول المزوّدين في catalog."""
+    con.execute("INSERT INTO settings(key,value) VALUES('cache_version','1') "
+                "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1")
+
+def _cache_version(con):
+    r = con.execute("SELECT value FROM settings WHERE key='cache_version'").fetchone()
+    return r[0] if r else None
+
+# كاش في الذاكرة لجدولي settings وprices: يُحمَّل مرة عند الإقلاع ويُحدَّث
+# مع كل كتابة، فلا تحتاج قوائم الطلب أي قراءة من القاعدة في الحالة المستقرة.
+# مع عدة عمليات يقرأ كل عامل cache_version دوريًا ويعيد التحميل إن تغيّر،
+# ثم يستدعي CACHE_LISTENERS (مثل إعادة تحميل جدول التوجيه).
+_settings = {}
+_prices = {}
+_cache_loaded = False
+_prices_version = 0
+CACHE_STATS = {"hits": 0, "misses": 0}
+CACHE_LISTENERS = []
+
+def prices_version():
+    """يزداد مع كل تعديل للأسعار؛ تُبنى لوحات الأسعار من جديد عند تغيّره."""
+    return _prices_version
+
+def _load_cache(con):
+    return (dict(con.execute("SELECT key,value FROM settings").fetchall()),
+            {c: float(p) for c, p in con.execute("SELECT country,price FROM prices")})
+
+async def load_cache():
+    global _settings, _prices, _cache_loaded, _prices_version
+    _settings, _prices = await read(_load_cache)
+    _cache_loaded = True
+    _prices_version += 1
+
+async def get_setting(key, default=None):
+    if _cache_loaded:
+        CACHE_STATS["hits"] += 1
+        return _settings.get(key, default)
+    CACHE_STATS["misses"] += 1
+    return await read(_get_setting, key, default)
+
+async def set_setting(key, value):
+    await write(_set_setting, key, value)
+    _settings[key] = str(value)
+
+async def refresh_cache():
+    """إعادة التحميل إن عدّلت عملية أخرى الإعدادات أو الأسعار؛ True إن تغيّر شيء."""
+    if await read(_cache_version) == _settings.get("cache_version"):
+        return False
+    await load_cache()
+    for fn in CACHE_LISTENERS:
+        await fn()
+    return True
+
+async def get_price(country_code, default=25):
+    if _cache_loaded:
+        CACHE_STATS["hits"] += 1
+        return _prices.get(country_code, default)
+    CACHE_STATS["misses"] += 1
+    return await read(_get_price, country_code, default)
+
+async def set_price(country_code, price):
+    global _prices_version
+    await write(_set_price, country_code, price)
+    _prices[country_code] = float(price)
+    _prices_version += 1
+
+
+# =============== المستخدمون ===============
+def _get_user(con, user_id):
+    return con.execute("SELECT user_id,email,balance,created_at,last_ip,last_seen FROM users WHERE user_id=?",(user_id,)).fetchone()
+
+_UPSERT_USER = """INSERT INTO users(user_id,email,balance,created_at,last_ip,last_seen) VALUES(?,?,0,?,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        email=COALESCE(excluded.email, users.email),
+        last_ip=COALESCE(excluded.last_ip, users.last_ip),
+        last_seen=CASE WHEN excluded.last_ip IS NULL THEN users.last_seen ELSE excluded.last_seen END,
+        blocked=0"""
+_UPSERT_SESSION = """INSERT INTO sessions(user_id,logged_in) VALUES(?,1)
+    ON CONFLICT(user_id) DO UPDATE SET logged_in=1"""
+
+def _upsert_users(con, rows):
+    # rows: [(user_id, email, ip, now)] — معاملة واحدة مهما كان عدد الصفوف
+    con.executemany(_UPSERT_USER, [(uid, email, now, ip, now) for uid, email, ip, now in rows])
+    con.executemany(_UPSERT_SESSION, [(uid,) for uid, _, _, _ in rows])
+
+def _is_logged_in(con, user_id):
+    r = con.execute("SELECT logged_in FROM sessions WHERE user_id=?", (user_id,)).fetchone()
+    return bool(r and r[0])
+
+def _get_balance(con, user_id):
+    r = con.execute("SELECT COALESCE(balance,0) FROM users WHERE user_id=?", (user_id,)).fetchone()
+    return float(r[0]) if r else 0.0
+
+async def db_get_user(user_id):
+    return await read(_get_user, user_id)
+
+# وضع write-behind: بعد أول كتابة للمستخدم في هذه العملية تُجمَّع تحديثات
+# النشاط في الذاكرة (آخر قيمة لكل user_id) وتُكتب كل DB_FLUSH_SECONDS ثانية
+# أو عند بلوغ DB_FLUSH_MAX مستخدمًا، وتُفرَّغ دائمًا عند الإيقاف.
+_activity = {}
+_known_users = OrderedDict()    # user_id -> None، الأحدث في الآخر
+_flusher = None
+_optimizer = None
+_refresher = None
+
+async def db_upsert_user(user_id, email=None, ip=None):
+    now = datetime.utcnow().isoformat()
+    if DB_WRITE_BEHIND and not email and user_id in _known_users:
+        _known_users.move_to_end(user_id)
+        # استدعاء بلا IP لا يغيّر last_ip/last_seen (كما في UPSERT)، فلا يمحو المؤجَّل قبله
+        if ip or user_id not in _activity:
+            _activity[user_id] = (user_id, None, ip or None, now)
+        if len(_activity) >= DB_FLUSH_MAX:
+            await flush_activity()
+        return
+    await write(_upsert_users, [(user_id, email or None, ip or None, now)])
+    _known_users[user_id] = None
+    _known_users.move_to_end(user_id)
+    if len(_known_users) > DB_KNOWN_USERS:
+        _known_users.popitem(last=False)
+
+async def flush_activity():
+    if not _activity:
+        return
+    rows = list(_activity.values())
+    _activity.clear()
+    try:
+        await write(_upsert_users, rows)
+    except Exception:
+        # نعيد الصفوف للدفعة التالية؛ ما وصل أثناء الكتابة أحدث إلا إن كان بلا IP
+        for row in rows:
+            newer = _activity.get(row[0])
+            if newer is None or (not newer[2] and row[2]):
+                _activity[row[0]] = row
+        raise
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(DB_FLUSH_SECONDS)
+        try:
+            await flush_activity()
+        except Exception:
+            log.exception("activity flush failed; %d users kept for retry", len(_activity))
+
+def start_flusher(shared=False):
+    """مهام القاعدة الخلفية؛ shared=True حين تتشارك عدة عمليات نفس القاعدة."""
+    global _flusher, _optimizer, _refresher
+    if DB_WRITE_BEHIND and _flusher is None:
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+    if DB_OPTIMIZE_HOURS > 0 and _optimizer is None:
+        _optimizer = asyncio.get_running_loop().create_task(_optimize_loop())
+    if shared and DB_CACHE_REFRESH > 0 and _refresher is None:
+        _refresher = asyncio.get_running_loop().create_task(_refresh_loop())
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(DB_CACHE_REFRESH)
+        try:
+            await refresh_cache()
+        except Exception:
+            log.exception("settings cache refresh failed")
+
+async def _optimize_loop():
+    # PRAGMA optimize يحدّث إحصائيات الفهارس التي تغيّرت فقط؛ رخيص عادةً
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_HOURS * 3600)
+        try:
+            await write(_optimize)
+        except sqlite3.Error:
+            log.exception("PRAGMA optimize failed")
+
+async def shutdown_db():
+    global _flusher, _optimizer, _refresher
+    if _flusher is not None:
+        _flusher.cancel()
+        _flusher = None
+    if _refresher is not None:
+        _refresher.cancel()
+        _refresher = None
+    if _optimizer is not None:
+        _optimizer.cancel()
+        _optimizer = None
+    await flush_activity()
+    if _ledger_task is not None:
+        await asyncio.shield(_ledger_task)
+    close_db()
+
+async def db_is_logged_in(user_id)->bool:
+    return await read(_is_logged_in, user_id)
+
+async def db_get_balance(user_id):
+    return await read(_get_balance, user_id)
+
+
+# =============== الطلبات والإحصائيات ===============
+def _insert_order(con, user_id, provider, country, service, phone, price, status, ext_id, chat_id, message_id):
+    cur = con.execute("INSERT INTO orders(user_id,provider,country,service,phone,price,status,created_at,ext_id,chat_id,message_id) VALUES(?,?,?,?,?,?,?,?,?,?,?)",
+                      (user_id, provider, country, service, phone, price, status, datetime.utcnow().isoformat(), ext_id, chat_id, message_id))
+    return cur.lastrowid
+
+def _set_order_number(con, order_id, provider, ext_id, phone):
+    con.execute("UPDATE orders SET provider=?, ext_id=?, phone=? WHERE id=?", (provider, ext_id, phone, order_id))
+
+def _set_order_status(con, order_id, status):
+    # فقط إن كان ما زال مفتوحًا: الفاحص قد يكون أنهاه (وصل الكود) في نفس اللحظة
+    return con.execute("UPDATE orders SET status=? WHERE id=? AND status='WAIT_CODE'",
+                       (status, order_id)).rowcount > 0
+
+_ORDER_COLS = "id,user_id,provider,country,service,phone,price,status,created_at,ext_id,chat_id,message_id,code"
+
+def _open_orders(con):
+    return con.execute(f"SELECT {_ORDER_COLS} FROM orders WHERE status='WAIT_CODE'").fetchall()
+
+def _finish_orders(con, rows):
+    # rows: [(status, code, order_id)] — لا نلمس إلا الطلبات التي ما زالت مفتوحة؛
+    # يعيد أرقام ما تغيّر فعلًا (ما ألغاه المستخدم قبلها يُستبعد)
+    return [oid for status, code, oid in rows
+            if con.execute("UPDATE orders SET status=?, code=? WHERE id=? AND status='WAIT_CODE'",
+                           (status, code, oid)).rowcount]
+
+def _stats(con, since):
+    out = {}
+    for kind, key, n, amount in con.execute("SELECT kind,key,n,amount FROM stats WHERE kind!='day' OR key>=?", (since,)):
+        out.setdefault(kind, {})[key] = (n, amount)
+    return out
+
+def _user_stats(con, user_id):
+    # الطلبات الحالية + ملخص ما نُقل للأرشيف
+    return con.execute("""SELECT status, SUM(n), SUM(amount) FROM (
+            SELECT status, COUNT(*) AS n, SUM(price) AS amount FROM orders WHERE user_id=? GROUP BY status
+            UNION ALL SELECT status, n, amount FROM archived_user_stats WHERE user_id=?)
+        GROUP BY status""", (user_id, user_id)).fetchall()
+
+async def db_insert_order(user_id, provider, country, service, phone, price, status, ext_id=None,
+                          chat_id=None, message_id=None):
+    return await write(_insert_order, user_id, provider, country, service, phone, price, status, ext_id,
+                       chat_id, message_id)
+
+async def db_set_order_number(order_id, provider, ext_id, phone):
+    await write(_set_order_number, order_id, provider, ext_id, phone)
+
+async def db_set_order_status(order_id, status):
+    """إنهاء طلب مفتوح؛ False إن لم يعد WAIT_CODE."""
+    return await write(_set_order_status, order_id, status)
+
+async def db_open_orders():
+    return await read(_open_orders)
+
+async def db_finish_orders(rows):
+    return await write(_finish_orders, rows)
+
+async def db_stats(days=7):
+    """كل العدّادات، مع إيراد آخر days يومًا فقط: {kind: {key: (n, amount)}}."""
+    since = (datetime.utcnow() - timedelta(days=days - 1)).date().isoformat()
+    return await read(_stats, since)
+
+async def db_user_stats(user_id):
+    return await read(_user_stats, user_id)
+
+
+# =============== دفتر الرصيد ===============
+# كل تغيير على الرصيد يمر عبر طابور واحد: العمليات المتراكمة أثناء تنفيذ دفعة
+# تُنفَّذ معًا في معاملة واحدة (group commit)، وكل عملية داخل SAVEPOINT خاص
+# بها فلا يُفشل خطأ واحد بقية الدفعة. الخصم شرطي (balance>=amount) داخل نفس
+# المعاملة فلا سباق بين ضغطتين متزامنتين. كل عملية تعيد None حين لا تُطبَّق
+# (رصيد غير كافٍ، تسوية مكررة تمنعها الفهارس الفريدة، طلب بلا حجز).
+RESERVE, COMMIT, REFUND, DEPOSIT = "reserve", "commit", "refund", "deposit"
+LEDGER_MAX_BATCH = int(os.getenv("LEDGER_MAX_BATCH", "500"))
+LEDGER_STATS = {"batches": 0, "ops": 0}
+
+_ledger_pending = []
+_ledger_task = None
+
+def _add_tx(con, user_id, order_id, kind, amount):
+    con.execute("INSERT INTO transactions(user_id,order_id,kind,amount,created_at) VALUES(?,?,?,?,?)",
+                (user_id, order_id, kind, amount, datetime.utcnow().isoformat()))
+
+def _open_order(con, user_id, price, provider, country, service, phone, ext_id, chat_id, message_id):
+    cur = con.execute("UPDATE users SET balance=balance-? WHERE user_id=? AND balance>=?", (price, user_id, price))
+    if cur.rowcount == 0:
+        return None
+    order_id = _insert_order(con, user_id, provider, country, service, phone, price, "WAIT_CODE",
+                             ext_id, chat_id, message_id)
+    _add_tx(con, user_id, order_id, RESERVE, -price)
+    return order_id
+
+def _settle(con, order_id, kind):
+    r = con.execute("SELECT user_id, amount FROM transactions WHERE order_id=? AND kind='reserve'", (order_id,)).fetchone()
+    if r is None:
+        return None         # طلب قديم من قبل الدفتر
+    user_id, reserved = r
+    _add_tx(con, user_id, order_id, kind, -reserved if kind == REFUND else 0)   # يفشل إن سُوّي مسبقًا
+    if kind == REFUND:
+        con.execute("UPDATE users SET balance=balance-? WHERE user_id=?", (reserved, user_id))
+    return True
+
+def _deposit(con, user_id, amount):
+    cur = con.execute("UPDATE users SET balance=balance+? WHERE user_id=? AND balance+?>=0", (amount, user_id, amount))
+    if cur.rowcount == 0:
+        return None
+    _add_tx(con, user_id, None, DEPOSIT, amount)
+    return con.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)).fetchone()[0]
+
+def _apply_ledger(con, ops):
+    con.execute("BEGIN IMMEDIATE")
+    out = []
+    for fn, args in ops:
+        con.execute("SAVEPOINT op")
+        try:
+            out.append((True, fn(con, *args)))
+        except sqlite3.IntegrityError:
+            # قيد مكرر (تسوية ثانية لنفس الطلب): العملية لم تُطبَّق، كعدم كفاية الرصيد
+            con.execute("ROLLBACK TO op")
+            out.append((True, None))
+        except Exception as e:
+            con.execute("ROLLBACK TO op")
+            out.append((False, e))
+        con.execute("RELEASE op")
+    return out
+
+def _ledger_submit(fn, *args):
+    global _ledger_task
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    _ledger_pending.append((fn, args, fut))
+    if _ledger_task is None:
+        _ledger_task = loop.create_task(_ledger_drain())
+    return fut
+
+async def _ledger_drain():
+    global _ledger_task
+    try:
+        while _ledger_pending:
+            batch = _ledger_pending[:LEDGER_MAX_BATCH]
+            del _ledger_pending[:LEDGER_MAX_BATCH]
+            try:
+                results = await write(_apply_ledger, [(fn, args) for fn, args, _ in batch])
+            except Exception as e:
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            LEDGER_STATS["batches"] += 1
+            LEDGER_STATS["ops"] += len(batch)
+            for (_, _, fut), (ok, value) in zip(batch, results):
+                if fut.done():
+                    continue
+                if ok:
+                    fut.set_result(value)
+                else:
+                    fut.set_exception(value)
+    finally:
+        _ledger_task = None
+
+async def ledger_open_order(user_id, price, provider, country, service, phone, ext_id=None,
+                            chat_id=None, message_id=None):
+    """خصم السعر وإنشاء الطلب وقيد الحجز ذرّيًا؛ None إن لم يكفِ الرصيد."""
+    return await _ledger_submit(_open_order, user_id, price, provider, country, service, phone,
+                                ext_id, chat_id, message_id)
+
+async def ledger_settle(order_id, kind):
+    """تسوية حجز الطلب (COMMIT أو REFUND)؛ True، أو None إن سُوّي مسبقًا أو لا حجز له."""
+    return await _ledger_submit(_settle, order_id, kind)
+
+async def ledger_deposit(user_id, amount):
+    """شحن (أو خصم إداري) الرصيد؛ يعيد الرصيد الجديد أو None."""
+    return await _ledger_submit(_deposit, user_id, amount)
+
+def _unsettled(con):
+    return con.execute("""SELECT t.order_id, o.status FROM transactions t JOIN orders o ON o.id=t.order_id
+        WHERE t.kind='reserve' AND o.status!='WAIT_CODE'
+          AND NOT EXISTS(SELECT 1 FROM transactions s WHERE s.order_id=t.order_id AND s.kind IN ('commit','refund'))""").fetchall()
+
+async def ledger_reconcile():
+    """تسوية الطلبات التي انتهت دون تسوية (توقف مفاجئ بين الخطوتين)."""
+    rows = await read(_unsettled)
+    await asyncio.gather(*(ledger_settle(oid, COMMIT if status == "CODE_RECEIVED" else REFUND)
+                           for oid, status in rows))
+    return len(rows)
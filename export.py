@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# =============== التصدير للمحاسبة ===============
+# الطلبات (بمدى تاريخ، مع ملفات الأرشيف الشهرية) والمستخدمون ودفتر الرصيد
+# تُقرأ بمؤشر على دفعات (fetchmany) وتُكتب مباشرة عبر gzip إلى ملف CSV مؤقت،
+# فالذاكرة ثابتة مهما بلغ عدد الصفوف. العمل كله في خيط مستقل باتصال قراءة فقط
+# خاص به، فلا يشغل خيوط القراءة ولا حلقة الأحداث؛ ثم يُرفع الملف بـ send_document.
+import asyncio
+import csv
+import gzip
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from db import DB, _ORDER_COLS
+
+CHUNK = 5000
+
+_USER_COLS = "user_id,email,balance,created_at,last_ip,last_seen,blocked"
+_LEDGER_COLS = "id,user_id,order_id,kind,amount,created_at"
+
+
+def _order_queries(con, archive_dir, start, end):
+    """(استعلام، معاملات) لكل مصدر بالترتيب: الأشهر المؤرشفة ثم الجدول الساخن."""
+    months = [r[0] for r in con.execute("SELECT month FROM archive_months WHERE month>=? AND month<=? ORDER BY month",
+                                        (start[:7], end[:7]))]
+    for month in months:
+        path = os.path.join(archive_dir, f"orders-{month}.db")
+        if archive_dir and os.path.exists(path):
+            alias = "arch_" + month.replace("-", "_")
+            # ما زال في الجدول الساخن (توقف بين النسخ والحذف) يُصدَّر مرة واحدة من هناك
+            yield (f"SELECT {_ORDER_COLS} FROM {alias}.orders "
+                   f"WHERE created_at>=? AND created_at<? AND id NOT IN (SELECT id FROM main.orders) ORDER BY id",
+                   (start, end), (alias, path))
+    yield f"SELECT {_ORDER_COLS} FROM orders WHERE created_at>=? AND created_at<? ORDER BY created_at", (start, end), None
+
+
+def _write_csv(kind, progress, archive_dir=None, start=None, end=None):
+    if kind == "orders":
+        header = _ORDER_COLS.split(",")
+    elif kind == "users":
+        header = _USER_COLS.split(",")
+    else:
+        header = _LEDGER_COLS.split(",")
+    fd, path = tempfile.mkstemp(prefix=f"export-{kind}-", suffix=".csv.gz")
+    os.close(fd)
+    try:
+        with closing(sqlite3.connect(f"file:{DB}?mode=ro", uri=True)) as con, \
+                gzip.open(path, "wt", encoding="utf-8-sig", newline="", compresslevel=6) as f:
+            w = csv.writer(f)
+            w.writerow(header)
+            if kind == "orders":
+                sources = list(_order_queries(con, archive_dir, start, end))
+            elif kind == "users":
+                sources = [(f"SELECT {_USER_COLS} FROM users ORDER BY user_id", (), None)]
+            else:
+                sources = [(f"SELECT {_LEDGER_COLS} FROM transactions ORDER BY id", (), None)]
+            for sql, args, attach in sources:
+                if attach:
+                    con.execute(f"ATTACH DATABASE ? AS {attach[0]}", (f"file:{attach[1]}?mode=ro",))
+                cur = con.execute(sql, args)
+                while True:
+                    rows = cur.fetchmany(CHUNK)
+                    if not rows:
+                        break
+                    w.writerows(rows)
+                    progress[0] += len(rows)
+                cur.close()
+                if attach:
+                    con.execute(f"DETACH DATABASE {attach[0]}")
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, progress[0]
+
+
+class Exporter:
+    def __init__(self, archive_dir=None):
+        self.archive_dir = archive_dir
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+        self.progress = [0]         # الصفوف المكتوبة في التصدير الجاري (يقرؤها البوت للعرض)
+        self.busy = False
+
+    def start(self, kind, start=None, end=None):
+        """بدء كتابة ملف csv.gz مؤقت؛ يعيد Future بـ(المسار، عدد الصفوف) والملف يحذفه المستدعي، أو None إن كان تصدير جارٍ."""
+        if self.busy:
+            return None
+        self.busy = True
+        self.progress = [0]
+        fut = asyncio.get_running_loop().run_in_executor(
+            self._pool, _write_csv, kind, self.progress, self.archive_dir, start, end)
+        fut.add_done_callback(lambda _: setattr(self, "busy", False))
+        return fut
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# =============== خادم مزوّدين وهمي ===============
+# خادم aiohttp محلي يحاكي واجهتي 5SIM وSMS-Activate بالمسارات وصيغ الردود
+# نفسها (JSON/نص عادي لـ5SIM، نص "ACCESS_NUMBER:…" لـSMS-Activate)، مع حقن
+# أعطال لكل مزوّد: HTTP 500/429، تعليق حتى المهلة، NO_NUMBERS، رد مشوّه.
+# يُستعمل في فحوص loadtest.py --providers، أو يدويًا لتشغيل البوت بلا مزوّد حقيقي:
+#
+#   python fakeproviders.py --port 8099
+#   FIVESIM_URL=http://127.0.0.1:8099/v1 SMSACTIVATE_URL=http://127.0.0.1:8099/stubs/handler_api.php \
+#   FIVESIM_API_KEY=x SMSACTIVATE_API_KEY=x python bot.py
+import argparse
+import asyncio
+import itertools
+import json
+from collections import Counter, deque
+
+from aiohttp import web
+
+FIVESIM, SMSACTIVATE = "5sim", "sms-activate"
+# أنواع الأعطال المقبولة في fail() وdown
+FAULTS = ("500", "429", "timeout", "no_numbers", "garbage")
+
+_FIVESIM_COUNTRIES = {"saudiarabia": ("sa", "Saudi Arabia"), "egypt": ("eg", "Egypt"),
+                      "yemen": ("ye", "Yemen"), "turkey": ("tr", "Turkey")}
+_SMSACTIVATE_COUNTRIES = {"53": "sa", "21": "eg", "30": "ye", "62": "tr"}
+
+
+class FakeProviders:
+    def __init__(self, api_key="test", hang=30.0, cost=10.0, stock=50):
+        self.api_key = api_key
+        self.hang = hang                # مدة تعليق العطل "timeout" (أطول من مهلة العميل)
+        self.cost = cost
+        self.stock = stock
+        self.hits = Counter()           # provider -> عدد الطلبات المستلمة
+        self.faults = {FIVESIM: deque(), SMSACTIVATE: deque()}
+        self.down = {}                  # provider -> عطل دائم حتى يُحذف
+        self.activations = {}           # id -> [provider, status, code]
+        self._ids = itertools.count(1000)
+
+    # --- التحكم من الفحوص ---
+    def fail(self, provider, fault, times=1):
+        """الطلبات الـtimes التالية لهذا المزوّد تفشل بالعطل fault."""
+        self.faults[provider].extend([fault] * times)
+
+    def deliver(self, activation_id, code):
+        """وصول رسالة SMS للتفعيل."""
+        self.activations[str(activation_id)][2] = code
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/v1/guest/countries", self._fivesim_countries)
+        app.router.add_get("/v1/guest/prices", self._fivesim_prices)
+        app.router.add_get("/v1/user/buy/activation/{country}/{operator}/{product}", self._fivesim_buy)
+        app.router.add_get("/v1/user/check/{id}", self._fivesim_check)
+        app.router.add_get("/v1/user/cancel/{id}", self._fivesim_cancel)
+        app.router.add_get("/stubs/handler_api.php", self._smsactivate)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """تشغيل الخادم؛ يعيد (runner, base) حيث base مثل http://127.0.0.1:PORT."""
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://{host}:{port}"
+
+    async def _fault(self, provider):
+        self.hits[provider] += 1
+        q = self.faults[provider]
+        fault = q.popleft() if q else self.down.get(provider)
+        if fault == "timeout":
+            await asyncio.sleep(self.hang)
+        return fault
+
+    def _new(self, provider):
+        aid = str(next(self._ids))
+        self.activations[aid] = [provider, "WAIT", None]
+        return aid
+
+    # --- 5SIM: JSON عند النجاح ونص عادي للأخطاء ---
+    def _fivesim_auth(self, request):
+        return request.headers.get("Authorization") == f"Bearer {self.api_key}"
+
+    async def _fivesim_error(self, fault):
+        if fault in ("500", "429"):
+            return web.Response(status=int(fault), text="server error")
+        if fault == "no_numbers":
+            return web.Response(text="no free phones")
+        if fault == "garbage":
+            return web.Response(text="<html>bad gateway</html>", content_type="text/html")
+        return None
+
+    async def _fivesim_countries(self, request):
+        r = await self._fivesim_error(await self._fault(FIVESIM))
+        if r is not None:
+            return r
+        return web.json_response({name: {"iso": {iso: 1}, "text_en": text}
+                                  for name, (iso, text) in _FIVESIM_COUNTRIES.items()})
+
+    async def _fivesim_prices(self, request):
+        r = await self._fivesim_error(await self._fault(FIVESIM))
+        if r is not None:
+            return r
+        return web.json_response({name: {"whatsapp": {"virtual1": {"cost": self.cost, "count": self.stock},
+                                                      "virtual2": {"cost": self.cost + 5, "count": 0}},
+                                         "telegram": {"virtual1": {"cost": self.cost / 2, "count": self.stock}}}
+                                  for name in _FIVESIM_COUNTRIES})
+
+    async def _fivesim_buy(self, request):
+        if not self._fivesim_auth(request):
+            return web.Response(status=401, text="Unauthorized")
+        r = await self._fivesim_error(await self._fault(FIVESIM))
+        if r is not None:
+            return r
+        if request.match_info["country"] not in _FIVESIM_COUNTRIES:
+            return web.Response(text="no product")
+        aid = self._new(FIVESIM)
+        return web.json_response({"id": int(aid), "phone": f"+9665{aid:0>8}", "price": self.cost,
+                                  "status": "PENDING", "sms": []})
+
+    async def _fivesim_check(self, request):
+        r = await self._fivesim_error(await self._fault(FIVESIM))
+        if r is not None:
+            return r
+        a = self.activations.get(request.match_info["id"])
+        if a is None:
+            return web.Response(text="order not found")
+        status = {"WAIT": "RECEIVED" if a[2] else "PENDING", "CANCEL": "CANCELED"}[a[1]]
+        return web.json_response({"id": int(request.match_info["id"]), "status": status,
+                                  "sms": [{"code": a[2], "text": f"code {a[2]}"}] if a[2] else []})
+
+    async def _fivesim_cancel(self, request):
+        r = await self._fivesim_error(await self._fault(FIVESIM))
+        if r is not None:
+            return r
+        a = self.activations.get(request.match_info["id"])
+        if a is None:
+            return web.Response(text="order not found")
+        if a[2]:
+            return web.Response(text="order has sms")
+        a[1] = "CANCEL"
+        return web.json_response({"id": int(request.match_info["id"]), "status": "CANCELED"})
+
+    # --- SMS-Activate: نقطة واحدة ونص عادي ---
+    async def _smsactivate(self, request):
+        q = request.query
+        if q.get("api_key") != self.api_key:
+            return web.Response(text="BAD_KEY")
+        fault = await self._fault(SMSACTIVATE)
+        if fault in ("500", "429"):
+            return web.Response(status=int(fault), text="server error")
+        if fault == "garbage":
+            return web.Response(text="<html>bad gateway</html>")
+        action = q.get("action")
+        if action == "getNumber":
+            if fault == "no_numbers" or q.get("country") not in _SMSACTIVATE_COUNTRIES:
+                return web.Response(text="NO_NUMBERS")
+            aid = self._new(SMSACTIVATE)
+            return web.Response(text=f"ACCESS_NUMBER:{aid}:7900{aid}")
+        a = self.activations.get(q.get("id", ""))
+        if action == "getStatus":
+            if a is None:
+                return web.Response(text="NO_ACTIVATION")
+            if a[1] == "CANCEL":
+                return web.Response(text="STATUS_CANCEL")
+            return web.Response(text=f"STATUS_OK:{a[2]}" if a[2] else "STATUS_WAIT_CODE")
+        if action == "setStatus":
+            if a is None:
+                return web.Response(text="NO_ACTIVATION")
+            a[1] = "CANCEL"
+            return web.Response(text="ACCESS_CANCEL")
+        if action == "getActiveActivations":
+            active = [{"activationId": aid, "phoneNumber": f"7900{aid}", "smsCode": [code] if code else None,
+                       "activationStatus": "2" if code else "4"}
+                      for aid, (provider, status, code) in self.activations.items()
+                      if provider == SMSACTIVATE and status == "WAIT"]
+            return web.Response(text=json.dumps({"status": "success", "activeActivations": active}))
+        if action == "getPrices":
+            return web.Response(text=json.dumps({cid: {"wa": {"cost": self.cost - 1, "count": self.stock},
+                                                       "tg": {"cost": self.cost, "count": 0}}
+                                                 for cid in _SMSACTIVATE_COUNTRIES}))
+        return web.Response(text="BAD_ACTION")
+
+
+def main():
+    p = argparse.ArgumentParser(description="خادم 5SIM/SMS-Activate وهمي")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8099)
+    p.add_argument("--api-key", default="x", help="المفتاح المقبول (FIVESIM_API_KEY/SMSACTIVATE_API_KEY)")
+    p.add_argument("--down", action="append", default=[], metavar="PROVIDER=FAULT",
+                   help=f"عطل دائم لمزوّد، مثل 5sim=500؛ الأعطال: {', '.join(FAULTS)}")
+    args = p.parse_args()
+    fake = FakeProviders(api_key=args.api_key)
+    for item in args.down:
+        provider, fault = item.split("=", 1)
+        fake.down[provider] = fault
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1167 @@
+# -*- coding: utf-8 -*-
+# =============== محاكاة الحمل على البوت ===============
+# يشغّل dp الحقيقي من bot.py مع Bot وهمي (يسجّل استدعاءات API بتأخير محاكى)
+# ومزوّد أرقام وهمي، ويعيد تشغيل سيناريوهات تحديثات صناعية. لكل سيناريو:
+# الإنتاجية، p50/p95/p99 لزمن معالجة التحديث، زمن قاعدة البيانات، وعدد
+# استدعاءات API. النتائج تُكتب JSON للمقارنة بين الإصدارات (--baseline).
+#
+#   python loadtest.py --users 500 --latency 30 --json results.json
+#   python loadtest.py --scenario order --baseline results.json
+#   python loadtest.py --scenario start --users 1 --startup-budget 1500   # فحص زمن الإقلاع
+#   python loadtest.py --history 10000000 --json archive.json              # أثر الأرشفة على الإدراج والحجم، وبقاء المؤرشف مرئيًا
+#   python loadtest.py --stats 1000000                                     # إحصائيات الإدارة: العدّادات مقابل COUNT(*)
+#   python loadtest.py --ledger 50000 --users 500                          # ضغط دفتر الرصيد: خصم/ثانية وعدم الصرف المزدوج
+#   python loadtest.py --providers                                         # عملاء المزوّدين ضد خادم وهمي (fakeproviders.py)
+#   python loadtest.py --bench db --users 500                              # القاعدة: اتصال حاجب لكل استدعاء مقابل مجمّع الخيوط
+#   python loadtest.py --bench fsm                                         # كلفة FSM لكل تحديث: SQLite مقابل الذاكرة
+#   python loadtest.py --bench keyboards                                   # اللوحات الجاهزة مقابل بنائها مع كل رد
+#   python loadtest.py --bench dispatch                                    # قاموس الأزرار مقابل سلسلة فلاتر حتى 200 زر
+#   python loadtest.py --webhook 4 --scenario order                        # عبر HTTP: أمامية + 4 عمال (الترتيب والتوزيع)
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+SCENARIOS = ("start", "order", "pool", "admin", "support")
+BENCHES = ("db", "fsm", "keyboards", "dispatch")
+ADMINS = 10
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="محاكاة حمل على dispatcher البوت")
+    p.add_argument("--scenario", action="append", choices=SCENARIOS, help="يمكن تكراره؛ الافتراضي الكل")
+    p.add_argument("--users", type=int, default=200, help="عدد المستخدمين المتزامنين في كل سيناريو")
+    p.add_argument("--concurrency", type=int, default=100, help="أقصى مستخدمين يُعالَجون في نفس اللحظة")
+    p.add_argument("--latency", type=float, default=20.0, help="تأخير كل استدعاء Telegram API (ms)")
+    p.add_argument("--provider-latency", type=float, default=50.0, help="تأخير كل استدعاء للمزوّد (ms)")
+    p.add_argument("--pool-max", type=int, default=None, help="POOL_MAX للمحاكاة (الافتراضي من البيئة)")
+    p.add_argument("--throttle", action="store_true", help="إبقاء حدود THROTTLE_* (تُرفع افتراضيًا لأن المدراء يكررون)")
+    p.add_argument("--storage", default="sqlite", help="FSM_STORAGE: sqlite أو memory أو redis")
+    p.add_argument("--db", default="", help="ملف قاعدة البيانات (الافتراضي ملف مؤقت جديد)")
+    p.add_argument("--label", default="", help="وسم يُحفظ مع النتائج (مثل رقم الإيداع)")
+    p.add_argument("--json", default="", help="مسار ملف النتائج، أو - للطباعة")
+    p.add_argument("--baseline", default="", help="ملف نتائج سابق للمقارنة")
+    p.add_argument("--history", type=int, default=0,
+                   help="بدل السيناريوهات: تاريخ من N طلبًا، ثم زمن الإدراج وحجم القاعدة قبل الأرشفة وبعدها")
+    p.add_argument("--stats", type=int, default=0, metavar="N",
+                   help="بدل السيناريوهات: N طلبًا صناعيًا، ثم زمن قراءة إحصائيات الإدارة من العدّادات مقابل "
+                        "COUNT(*) على الجداول، وتطابق العدّادات التراكمية مع إعادة الحساب")
+    p.add_argument("--ledger", type=int, default=0, metavar="N",
+                   help="بدل السيناريوهات: N محاولة خصم متزامنة على --users مستخدمًا مع تسويات مكررة وسحب إداري، "
+                        "ثم التحقق أن كل رصيد = مجموع قيوده ولا رصيد سالب ولا تسوية مزدوجة")
+    p.add_argument("--webhook", type=int, default=0, metavar="N",
+                   help="إرسال التحديثات POST إلى أمامية webhook أمام N عمال (في نفس العملية) بدل process_update")
+    p.add_argument("--bench", action="append", choices=BENCHES,
+                   help="بدل السيناريوهات: قياس دقيق لجزء واحد (يمكن تكراره)؛ db: دوال القاعدة الحاجبة القديمة مقابل "
+                        "المجمّع مع --users معالجًا متزامنًا، fsm: كلفة تخزين الحالة لكل تحديث، "
+                        "keyboards: تخصيص وتسلسل اللوحات لكل رد، dispatch: توجيه الأزرار حسب عددها")
+    p.add_argument("--providers", action="store_true",
+                   help="بدل السيناريوهات: فحص عملاء 5SIM/SMS-Activate والتوجيه عبر HTTP ضد fakeproviders.py")
+    p.add_argument("--startup-budget", type=float, default=0.0,
+                   help="أقصى زمن إقلاع بارد (ms): استيراد bot + ترحيل قاعدة جديدة + تحميل الكاش؛ تجاوزه = خروج برمز 1")
+    return p.parse_args()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Recorder:
+    """عدّادات السيناريو الحالي: أزمنة التحديثات، زمن DB، واستدعاءات API."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = []
+        self.db_times = []
+        self.db_writes = 0
+        self.api = Counter()
+        self.last_text = ""
+
+    def timed(self, fn, write=False):
+        def wrapper(*args):
+            if write:
+                self.db_writes += 1
+            t = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.db_times.append(time.perf_counter() - t)
+        return wrapper
+
+
+def setup(args, rec):
+    """ضبط البيئة ثم استيراد bot.py مع Bot ومزوّد وهميين."""
+    os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "bot.db")
+    os.environ["ADMIN_IDS"] = ",".join(str(i) for i in range(1, ADMINS + 1))
+    os.environ["FSM_STORAGE"] = args.storage
+    if not args.throttle:
+        for group in ("ORDER", "ACCOUNT", "SUPPORT", "ADMIN"):
+            os.environ[f"THROTTLE_{group}"] = "1000000/1000000"
+    if args.pool_max is not None:
+        os.environ["POOL_MAX"] = str(args.pool_max)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import db
+    import bot as B
+    from aiogram import Bot, Dispatcher
+    from providers import Activation, Provider, WAIT_CODE
+
+    db._run_read = rec.timed(db._run_read)
+    db._run_write = rec.timed(db._run_write, write=True)
+
+    message_ids = itertools.count(1_000_000)
+    api_latency = args.latency / 1000
+
+    async def request(method, data=None, files=None, **kwargs):
+        rec.api[method] += 1
+        await asyncio.sleep(api_latency)
+        data = data or {}
+        if method == "sendMessage":
+            rec.last_text = data.get("text", "")
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(data.get("user_id", 1)), "is_bot": False, "first_name": "u"}}
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = data.get("chat_id", 1)
+            return {"message_id": next(message_ids), "date": int(time.time()), "text": data.get("text", ""),
+                    "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 1, "type": "private"}}
+        return True
+
+    class FakeProvider(Provider):
+        def __init__(self, name, latency):
+            super().__init__("loadtest")
+            self.name = name
+            self.latency = latency
+            self._ids = itertools.count(1)
+
+        async def buy(self, country, service):
+            await asyncio.sleep(self.latency)
+            i = next(self._ids)
+            return Activation(self.name, str(i), f"+1555{i:07d}", country, service)
+
+        async def status(self, activation_id):
+            await asyncio.sleep(self.latency)
+            return WAIT_CODE, None
+
+        async def cancel(self, activation_id):
+            await asyncio.sleep(self.latency)
+
+    B.bot.request = request
+    B.router.providers = {name: FakeProvider(name, args.provider_latency / 1000) for name, _ in B.PROVIDER_SETTINGS}
+    Bot.set_current(B.bot)
+    Dispatcher.set_current(B.dp)
+    return B
+
+
+# --------------- بناء التحديثات ---------------
+_update_ids = itertools.count(1)
+_msg_ids = itertools.count(1)
+
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "language_code": "ar"}
+
+
+def message(uid, text):
+    m = {"message_id": next(_msg_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+         "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": m}
+
+
+def callback(uid, data):
+    return {"update_id": next(_update_ids), "callback_query": {
+        "id": str(next(_msg_ids)), "chat_instance": str(uid), "from": _user(uid), "data": data,
+        "message": {"message_id": next(_msg_ids), "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"}, "text": "…"}}}
+
+
+def scenario_updates(name, users, base):
+    """قائمة (user_id, [تحديثات بالترتيب]) لكل مستخدم في السيناريو."""
+    if name == "start":
+        return [(base + i, [message(base + i, "/start")]) for i in range(users)]
+    if name in ("order", "pool"):
+        return [(base + i, [message(base + i, "/start"), message(base + i, "⚡ طلب رقم"),
+                            callback(base + i, "c_sa"), callback(base + i, "s_whatsapp"),
+                            callback(base + i, "cancel_num")]) for i in range(users)]
+    if name == "admin":
+        lanes = []
+        for a in range(1, ADMINS + 1):
+            steps = []
+            for r in range(max(1, users // ADMINS)):
+                steps += [message(a, "/admin"), callback(a, "ad_prices"), callback(a, "adp_eg"),
+                          message(a, str(20 + r % 10))]
+            lanes.append((a, steps))
+        return lanes
+    if name == "support":
+        return [(base + i, [message(base + i, f"مرحبا، عندي مشكلة في الطلب رقم {i}")]) for i in range(users)]
+    raise ValueError(name)
+
+
+async def prepare(B, name, lanes):
+    if name in ("order", "pool"):
+        # رصيد كافٍ قبل القياس
+        for uid, steps in lanes:
+            await B.db_upsert_user(uid)
+            await B.ledger_deposit(uid, 1000)
+
+
+def summarize(name, lanes, rec, wall, errors):
+    ms = [x * 1000 for x in rec.latencies]
+    return {
+        "scenario": name,
+        "users": len(lanes),
+        "updates": len(ms),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "throughput_ups": round(len(ms) / wall, 1) if wall else 0.0,
+        "latency_ms": {"p50": round(percentile(ms, 50), 2), "p95": round(percentile(ms, 95), 2),
+                       "p99": round(percentile(ms, 99), 2), "max": round(max(ms, default=0), 2)},
+        "db": {"calls": len(rec.db_times), "total_ms": round(sum(rec.db_times) * 1000, 1),
+               "per_update_ms": round(sum(rec.db_times) * 1000 / max(1, len(ms)), 3)},
+        "api": dict(sorted(rec.api.items())),
+        "api_per_update": round(sum(rec.api.values()) / max(1, len(ms)), 2),
+        "pool": {"hits": 0, "misses": 0, "hit_rate": None},
+    }
+
+
+async def run_scenario(B, rec, name, args, base):
+    from aiogram import types
+
+    lanes = scenario_updates(name, args.users, base)
+    await prepare(B, name, lanes)
+    sem = asyncio.Semaphore(args.concurrency)
+    errors = 0
+
+    async def lane(steps):
+        nonlocal errors
+        async with sem:
+            for data in steps:
+                t = time.perf_counter()
+                try:
+                    # مهمة لكل تحديث كما في الـ executor (حالة الفلاتر في ContextVar)
+                    await asyncio.create_task(B.dp.process_update(types.Update(**data)))
+                except Exception:
+                    errors += 1
+                rec.latencies.append(time.perf_counter() - t)
+
+    # pool: موجة باردة تولّد الطلب، تعبئة المخزون، ثم موجة دافئة من المخزون
+    waves = [lanes[:len(lanes) // 2], lanes[len(lanes) // 2:]] if name == "pool" else [lanes]
+    hits0, misses0 = B.POOL_TAKES.get(("hit",)), B.POOL_TAKES.get(("miss",))
+    rec.reset()
+    wall = 0.0
+    for n, wave in enumerate(waves):
+        if n:
+            await B.pool.refill()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(lane(steps) for _, steps in wave))
+        wall += time.perf_counter() - t0
+    hits, misses = B.POOL_TAKES.get(("hit",)) - hits0, B.POOL_TAKES.get(("miss",)) - misses0
+    out = summarize(name, lanes, rec, wall, errors)
+    out["pool"] = {"hits": hits, "misses": misses,
+                   "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None}
+    return out
+
+
+async def run_webhook_scenario(B, rec, name, args, base):
+    """السيناريو عبر HTTP: POST لكل تحديث إلى الأمامية (كما يفعل تيليجرام، التالي بعد 200)،
+    ثم التحقق أن كل تحديث عولج في عامل user_id % N وبترتيب إرساله لكل مستخدم، وأن
+    الأمامية ترد 503 (فيعيد تيليجرام الإرسال) حين يتعطل العامل."""
+    import aiohttp
+    from aiohttp import web
+    import webhook
+
+    lanes = scenario_updates(name, args.users, base)
+    await prepare(B, name, lanes)
+    path, secret, n = "/webhook", "loadtest", args.webhook
+    sent, done = {}, {}             # update_id -> وقت الإرسال / (العامل، المفتاح، وقت الانتهاء)
+    runners, urls = [], []
+
+    async def serve(app):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        runners.append(runner)
+        return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{path}"
+
+    for i in range(n):
+        app, scheduler = webhook.worker_app(B.dp, path, secret, args.concurrency)
+
+        async def recorded(data, handler=scheduler.handler, i=i):
+            try:
+                await handler(data)
+            finally:
+                done[data["update_id"]] = (i, webhook.update_key(data), time.perf_counter())
+        scheduler.handler = recorded
+        urls.append((await serve(app))[1])
+    _, front = await serve(webhook.front_app(urls, path, secret))
+
+    sem = asyncio.Semaphore(args.concurrency)
+    errors = 0
+    total = sum(len(steps) for _, steps in lanes)
+
+    async with aiohttp.ClientSession(headers={webhook.SECRET_HEADER: secret}) as session:
+        async def lane(steps):
+            nonlocal errors
+            async with sem:
+                for data in steps:
+                    sent[data["update_id"]] = time.perf_counter()
+                    async with session.post(front, json=data) as r:
+                        if r.status != 200:
+                            errors += 1
+
+        rec.reset()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(lane(steps) for _, steps in lanes))
+        while len(done) < total - errors and time.perf_counter() - t0 < 60:
+            await asyncio.sleep(0.01)
+        wall = time.perf_counter() - t0
+        rec.latencies = [done[u][2] - sent[u] for u in done]
+
+        # الترتيب لكل مستخدم (update_id يتزايد مع ترتيب الإرسال) والتوزيع على العمال
+        by_key = {}
+        for u, (worker, key, at) in sorted(done.items(), key=lambda kv: kv[1][2]):
+            by_key.setdefault(key, []).append(u)
+        reordered = sum(1 for ids in by_key.values() if ids != sorted(ids))
+        misrouted = sum(1 for worker, key, _ in done.values() if worker != key % n)
+
+        # عامل متوقف: يجب ألا تقبل الأمامية التحديث
+        await runners[0].cleanup()
+        uid = next(u for u, _ in lanes if u % n == 0) if any(u % n == 0 for u, _ in lanes) else n
+        async with session.post(front, json=message(uid, "/start")) as r:
+            redelivery = r.status
+    for runner in runners[1:]:
+        await runner.cleanup()
+
+    out = summarize(name, lanes, rec, wall, errors)
+    out["webhook"] = {"workers": n, "processed": len(done), "reordered_users": reordered,
+                      "misrouted": misrouted, "worker_down_status": redelivery}
+    return out
+
+
+def _seed_orders(con, start, count, months):
+    # طلبات منتهية موزّعة على آخر months شهرًا (الأحدث أولًا للأقل عددًا)
+    now = time.time()
+    statuses = ("CODE_RECEIVED", "CODE_RECEIVED", "CANCELED", "TIMEOUT")
+    rows = []
+    for i in range(start, start + count):
+        ts = now - (i * 7919 % (months * 30 * 86400)) - 3600
+        rows.append((i % 50_000 + 1, "5sim", "sa", "whatsapp", f"+9665{i:08d}", 25.0, statuses[i % 4],
+                     time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)), str(i)))
+    con.executemany("INSERT INTO orders(user_id,provider,country,service,phone,price,status,created_at,ext_id) "
+                    "VALUES(?,?,?,?,?,?,?,?,?)", rows)
+
+
+def _live_bytes(con):
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    page = con.execute("PRAGMA page_size").fetchone()[0]
+    return (con.execute("PRAGMA page_count").fetchone()[0] - con.execute("PRAGMA freelist_count").fetchone()[0]) * page
+
+
+async def history_bench(B, rec, args, inserts=2000):
+    """زمن db_insert_order وحجم القاعدة مع تاريخ كبير، قبل أرشفة ما هو أقدم من 30 يومًا وبعدها."""
+    import db
+    from archive import Archiver
+
+    t = time.perf_counter()
+    chunk = 200_000
+    for start in range(0, args.history, chunk):
+        await db.write(_seed_orders, start, min(chunk, args.history - start), 24)
+        print(f"\rseed {min(start + chunk, args.history):,}/{args.history:,}", end="", flush=True)
+    print(f"  ({time.perf_counter() - t:.0f} s)")
+
+    async def measure():
+        ms = []
+        for i in range(inserts):
+            t = time.perf_counter()
+            await db.db_insert_order(i % 50_000 + 1, "5sim", "sa", "whatsapp", "+9660", 25.0, "WAIT_CODE")
+            ms.append((time.perf_counter() - t) * 1000)
+        t = time.perf_counter()
+        for i in range(200):
+            await db.db_user_stats(i * 97 % 50_000 + 1)
+        stats_ms = (time.perf_counter() - t) * 1000 / 200
+        return {"hot_rows": await db.read(lambda con: con.execute("SELECT COUNT(*) FROM orders").fetchone()[0]),
+                "insert_ms": {"p50": round(percentile(ms, 50), 3), "p95": round(percentile(ms, 95), 3),
+                              "p99": round(percentile(ms, 99), 3)},
+                "user_stats_ms": round(stats_ms, 3),
+                "db_live_mb": round(await db.write(_live_bytes) / 2 ** 20, 1),
+                "db_file_mb": round(os.path.getsize(db.DB) / 2 ** 20, 1)}
+
+    out = {"orders": args.history, "before": await measure()}
+    archiver = Archiver(after_days=30)
+    cutoff = (datetime.utcnow() - timedelta(days=30)).isoformat()
+    probe = await db.write(_probe_order, 49_999_999)
+    sample = await db.read(lambda con: con.execute(
+        "SELECT id,user_id,phone FROM orders WHERE created_at<? AND status!='WAIT_CODE' ORDER BY id LIMIT 200",
+        (cutoff,)).fetchall())
+    t = time.perf_counter()
+    out["archived"] = await archiver.run_once()
+    out["archive_s"] = round(time.perf_counter() - t, 1)
+    out["archived_lookup"] = await archived_lookup(B, rec, sample, probe)
+    out["ok"] = out["archived_lookup"]["ok"]
+    out["archive_mb"] = round(sum(os.path.getsize(os.path.join(archiver.directory, f))
+                                  for f in os.listdir(archiver.directory)) / 2 ** 20, 1)
+    out["after"] = await measure()
+    await archiver.stop()
+    for k in ("before", "after"):
+        r = out[k]
+        print(f"{k:<7} hot {r['hot_rows']:>10,}  insert p50 {r['insert_ms']['p50']:.3f} p95 {r['insert_ms']['p95']:.3f} "
+              f"p99 {r['insert_ms']['p99']:.3f} ms  user_stats {r['user_stats_ms']:.3f} ms  "
+              f"db {r['db_live_mb']} MB مستعمل / {r['db_file_mb']} MB ملف")
+    print(f"archive {out['archived']:,} طلبًا في {out['archive_s']} s → {out['archive_mb']} MB ملفات شهرية")
+    r = out["archived_lookup"]
+    print(f"{'✅' if r['ok'] else '❌'} طلبات مؤرشفة ما زالت مرئية: get_order {r['found']}/{r['sample']} "
+          f"({r['get_order_ms']} ms)  user_orders {r['in_history']}/{r['sample']}  "
+          f"/order {'✓' if r['handler'] else '✗'}  📊 الإحصائيات {'✓' if r['my_stats'] else '✗'}")
+    return out
+
+
+def _probe_order(con, user_id):
+    # طلب قديم منتهٍ لمستخدم لا طلبات أخرى له؛ يُؤرشف مع البقية
+    created = (datetime.utcnow() - timedelta(days=90)).isoformat()
+    return con.execute("INSERT INTO orders(user_id,provider,country,service,phone,price,status,created_at) "
+                       "VALUES(?,'5sim','sa','whatsapp','+966500000000',25.0,'CODE_RECEIVED',?)",
+                       (user_id, created)).lastrowid, user_id
+
+
+async def archived_lookup(B, rec, sample, probe):
+    """طلبات نُقلت للأرشيف تبقى مرئية عبر archiver.get_order/user_orders وعبر معالجي
+    /order (أدمن) و«📊 الإحصائيات» كما يراها المستخدم."""
+    from aiogram import types
+    import db
+
+    gone = await db.read(lambda con: sum(con.execute("SELECT 1 FROM orders WHERE id=?", (oid,)).fetchone() is None
+                                         for oid, _, _ in sample))
+    found = in_history = 0
+    t = time.perf_counter()
+    for oid, uid, phone in sample:
+        row = await B.archiver.get_order(oid)
+        found += row is not None and row[0] == oid and row[5] == phone
+    ms = (time.perf_counter() - t) * 1000 / max(1, len(sample))
+    for oid, uid, phone in sample:
+        in_history += any(o[0] == oid for o in await B.archiver.user_orders(uid, limit=10_000))
+    handler = False
+    if sample:
+        oid, uid, phone = sample[0]
+        await asyncio.create_task(B.dp.process_update(types.Update(**message(1, f"/order {oid}"))))
+        handler = f"#{oid}" in rec.last_text and phone in rec.last_text
+    # مستخدم كل طلباته في الأرشيف: «آخر الطلبات» تأتي من الملف الشهري
+    oid, uid = probe
+    await asyncio.create_task(B.dp.process_update(types.Update(**message(uid, "📊 الإحصائيات"))))
+    my_stats = f"#{oid}" in rec.last_text
+    return {"sample": len(sample), "archived": gone, "found": found, "in_history": in_history,
+            "get_order_ms": round(ms, 3), "handler": handler, "my_stats": my_stats,
+            "ok": gone == found == in_history == len(sample) and handler and my_stats}
+
+
+def _finish_seeded(con, first_id):
+    # الطلبات تُدرج WAIT_CODE ثم تُنهى بتحديث، كما في البوت، فتعمل مشغّلات الحالة والإيراد
+    con.execute("UPDATE orders SET status=CASE id % 4 WHEN 0 THEN 'TIMEOUT' WHEN 1 THEN 'CANCELED' "
+                "ELSE 'CODE_RECEIVED' END WHERE id>=? AND status='WAIT_CODE'", (first_id,))
+
+
+def _scan_stats(con, since):
+    """نفس ناتج db._stats لكن بمسح الجداول كما كانت لوحة الإدارة تفعل قبل العدّادات."""
+    out = {"users": {"": (con.execute("SELECT COUNT(*) FROM users").fetchone()[0], 0)},
+           "orders": {"": (con.execute("SELECT COUNT(*) FROM orders").fetchone()[0], 0)}}
+    for col in ("status", "provider", "country", "service"):
+        out[col] = {k: (n, 0) for k, n in con.execute(f"SELECT COALESCE({col},''),COUNT(*) FROM orders GROUP BY 1")}
+    n, amount = con.execute("SELECT COUNT(*),COALESCE(SUM(price),0) FROM orders WHERE status='CODE_RECEIVED'").fetchone()
+    out["revenue"] = {"": (n, amount)}
+    out["day"] = {k: (n, a) for k, n, a in con.execute(
+        "SELECT date(created_at),COUNT(*),COALESCE(SUM(price),0) FROM orders "
+        "WHERE status='CODE_RECEIVED' AND created_at>=? GROUP BY 1", (since,))}
+    return out
+
+
+async def stats_bench(B, args, reads=200):
+    """لوحة الإدارة مع جدول طلبات كبير: قراءة db_stats (صفوف stats) مقابل COUNT(*)/GROUP BY
+    على orders، والتحقق أن العدّادات التي حدّثتها المشغّلات تساوي ما يعطيه المسح."""
+    import db
+
+    await db.write(lambda con: con.executemany("INSERT OR IGNORE INTO users(user_id,created_at) VALUES(?,?)",
+                                               ((i, "2024-01-01T00:00:00") for i in range(1, 50_001))))
+    t = time.perf_counter()
+    chunk = 200_000
+    for start in range(0, args.stats, chunk):
+        first = await db.read(lambda con: (con.execute("SELECT MAX(id) FROM orders").fetchone()[0] or 0) + 1)
+        await db.write(lambda con, start=start: _seed_orders(con, start, min(chunk, args.stats - start), 12)
+                       or con.execute("UPDATE orders SET status='WAIT_CODE' WHERE id>=?", (first,)))
+        await db.write(_finish_seeded, first)
+        print(f"\rseed {min(start + chunk, args.stats):,}/{args.stats:,}", end="", flush=True)
+    print(f"  ({time.perf_counter() - t:.0f} s)")
+
+    out = {"orders": args.stats}
+    for days in (1, 7):
+        since = (datetime.utcnow() - timedelta(days=days - 1)).date().isoformat()
+        t = time.perf_counter()
+        for _ in range(reads):
+            counters = await db.db_stats(days=days)
+        counters_ms = (time.perf_counter() - t) * 1000 / reads
+        t = time.perf_counter()
+        for _ in range(max(1, reads // 20)):
+            scanned = await db.read(_scan_stats, since)
+        scan_ms = (time.perf_counter() - t) * 1000 / max(1, reads // 20)
+
+        def norm(st):
+            return {kind: {k: (n, round(a, 2)) for k, (n, a) in rows.items() if n}
+                    for kind, rows in st.items() if kind in scanned}
+        diff = sorted(kind for kind in scanned if norm(counters).get(kind, {}) != norm(scanned)[kind])
+        out[f"days_{days}"] = {"counters_ms": round(counters_ms, 3), "scan_ms": round(scan_ms, 1),
+                               "speedup": round(scan_ms / max(counters_ms, 1e-6)), "mismatched": diff}
+    out["ok"] = not any(out[f"days_{d}"]["mismatched"] for d in (1, 7))
+    for days in (1, 7):
+        r = out[f"days_{days}"]
+        print(f"{'✅' if not r['mismatched'] else '❌'} ad_stats days={days}: العدّادات {r['counters_ms']:.3f} ms  "
+              f"المسح {r['scan_ms']:.1f} ms  ×{r['speedup']}  اختلاف: {', '.join(r['mismatched']) or '—'}")
+    return out
+
+
+def _ledger_audit(con):
+    """المخالفات: رصيد ≠ مجموع القيود، رصيد سالب، طلب بأكثر من تسوية أو بلا حجز."""
+    return {
+        "balance_mismatch": con.execute("""SELECT COUNT(*) FROM users u WHERE abs(u.balance -
+            (SELECT COALESCE(SUM(amount),0) FROM transactions t WHERE t.user_id=u.user_id)) > 1e-6""").fetchone()[0],
+        "negative_balance": con.execute("SELECT COUNT(*) FROM users WHERE balance < 0").fetchone()[0],
+        "double_settled": con.execute("""SELECT COUNT(*) FROM (SELECT order_id FROM transactions
+            WHERE kind IN ('commit','refund') GROUP BY order_id HAVING COUNT(*) > 1)""").fetchone()[0],
+        "unreserved_orders": con.execute("""SELECT COUNT(*) FROM orders o WHERE NOT EXISTS(
+            SELECT 1 FROM transactions t WHERE t.order_id=o.id AND t.kind='reserve')""").fetchone()[0],
+    }
+
+
+async def ledger_bench(B, args):
+    """ضغط دفتر الرصيد عبر ledger_* كما يستعملها البوت: كل مستخدم يكفي رصيده لنصف
+    محاولاته تقريبًا، والمحاولات كلها متزامنة (مع سحب إداري سالب بينها)؛ ثم كل طلب
+    يُسوّى مرتين متزامنتين (commit وrefund) فيجب أن تنجح واحدة فقط."""
+    import random
+    import db
+
+    users, attempts, price = args.users, args.ledger, 10.0
+    base = 30_000_000
+    per_user = max(1, attempts // users)
+    await db.write(lambda con: con.executemany("INSERT OR IGNORE INTO users(user_id,balance,created_at) VALUES(?,0,?)",
+                                               ((base + u, "2024-01-01T00:00:00") for u in range(users))))
+    await asyncio.gather(*(B.ledger_deposit(base + u, price * per_user / 2) for u in range(users)))
+    rnd = random.Random(7)
+    ops = [("open", base + i % users) for i in range(attempts)]
+    ops += [("withdraw", base + rnd.randrange(users)) for _ in range(attempts // 20)]
+    rnd.shuffle(ops)
+
+    async def one(kind, uid):
+        if kind == "open":
+            return kind, await B.ledger_open_order(uid, price, "5sim", "sa", "whatsapp", "+1555")
+        return kind, await B.ledger_deposit(uid, -price * 3)
+
+    batches0, ops0 = db.LEDGER_STATS["batches"], db.LEDGER_STATS["ops"]
+    t = time.perf_counter()
+    done = await asyncio.gather(*(one(kind, uid) for kind, uid in ops))
+    debit_s = time.perf_counter() - t
+    orders = [v for kind, v in done if kind == "open" and v is not None]
+    withdrawn = sum(1 for kind, v in done if kind == "withdraw" and v is not None)
+
+    settles = []
+    for oid in orders:
+        pair = [B.COMMIT, B.REFUND]
+        rnd.shuffle(pair)
+        settles += [(oid, kind) for kind in pair]
+    t = time.perf_counter()
+    settled = await asyncio.gather(*(B.ledger_settle(oid, kind) for oid, kind in settles))
+    settle_s = time.perf_counter() - t
+    won = Counter(oid for (oid, _), ok in zip(settles, settled) if ok)
+
+    audit = await db.read(_ledger_audit)
+    batches, applied = db.LEDGER_STATS["batches"] - batches0, db.LEDGER_STATS["ops"] - ops0
+    out = {"users": users, "attempts": attempts, "debited": len(orders), "rejected": attempts - len(orders),
+           "withdrawals": withdrawn, "ops_per_s": round(len(ops) / debit_s, 1),
+           "settles_per_s": round(len(settles) / settle_s, 1),
+           "settled_once": sum(1 for n in won.values() if n == 1), "settle_none": settled.count(None),
+           "avg_batch": round(applied / max(1, batches), 1), **audit}
+    out["ok"] = (not any(audit.values()) and out["settled_once"] == len(orders) == len(won)
+                 and out["settle_none"] == len(orders))
+    print(f"ledger  {len(ops):,} عملية ({attempts:,} خصم + {len(ops) - attempts:,} سحب) على {users} مستخدم: "
+          f"{out['ops_per_s']:,.0f} عملية/ث  نجح {out['debited']:,} رُفض {out['rejected']:,}  "
+          f"دفعة متوسطة {out['avg_batch']}")
+    print(f"        {len(settles):,} تسوية متزامنة: {out['settles_per_s']:,.0f}/ث  مرة واحدة لكل طلب "
+          f"{out['settled_once']:,}/{len(orders):,}  المكررة أعادت None: {out['settle_none']:,}")
+    print(f"{'✅' if out['ok'] else '❌'} رصيد ≠ القيود {audit['balance_mismatch']} | سالب {audit['negative_balance']} | "
+          f"تسوية مزدوجة {audit['double_settled']} | طلب بلا حجز {audit['unreserved_orders']}")
+    return out
+
+
+# --------------- قياسات دقيقة (--bench) ---------------
+def _us(values):
+    us = [x * 1e6 for x in values]
+    return {"mean": round(sum(us) / max(1, len(us)), 1), "p50": round(percentile(us, 50), 1),
+            "p95": round(percentile(us, 95), 1), "p99": round(percentile(us, 99), 1)}
+
+
+def _blocking_helpers(path):
+    """دوال القاعدة كما كانت قبل db.py: اتصال جديد لكل استدعاء وتنفيذ على حلقة الأحداث."""
+    import sqlite3
+    from contextlib import closing
+
+    def get_user(user_id):
+        with closing(sqlite3.connect(path)) as con:
+            return con.execute("SELECT user_id,email,balance,created_at,last_ip,last_seen FROM users WHERE user_id=?",
+                               (user_id,)).fetchone()
+
+    def upsert_user(user_id, email=None, ip=None):
+        now = datetime.utcnow().isoformat()
+        row = get_user(user_id)
+        with closing(sqlite3.connect(path)) as con, con:
+            if row is None:
+                con.execute("INSERT INTO users(user_id,email,balance,created_at,last_ip,last_seen) VALUES(?,?,?,?,?,?)",
+                            (user_id, email, 0, now, ip, now))
+            elif ip:
+                con.execute("UPDATE users SET last_ip=?, last_seen=? WHERE user_id=?", (ip, now, user_id))
+            con.execute("INSERT OR REPLACE INTO sessions(user_id,logged_in) VALUES(?,?)", (user_id, 1))
+
+    def is_logged_in(user_id):
+        with closing(sqlite3.connect(path)) as con:
+            r = con.execute("SELECT logged_in FROM sessions WHERE user_id=?", (user_id,)).fetchone()
+            return bool(r and r[0])
+
+    def get_balance(user_id):
+        with closing(sqlite3.connect(path)) as con:
+            r = con.execute("SELECT COALESCE(balance,0) FROM users WHERE user_id=?", (user_id,)).fetchone()
+            return float(r[0]) if r else 0.0
+
+    return upsert_user, get_user, is_logged_in, get_balance
+
+
+async def db_bench(B, rec, args, rounds=3):
+    """--users معالجًا متزامنًا، كل منها rounds مرات: upsert (مع IP) ثم قراءة المستخدم والجلسة
+    والرصيد ثم استدعاء API محاكى (--latency). القديم يستدعي الدوال الحاجبة مباشرة
+    فيحجز الحلقة، والجديد عبر db.py (خيط كاتب + خيوط قراءة). يقاس زمن المعالج،
+    الإنتاجية، وأقصى تأخر لحلقة الأحداث (تأخر استيقاظ مؤقّت كل 5 ms)."""
+    import db
+
+    upsert, get_user, logged_in, balance = _blocking_helpers(db.DB)
+    api = args.latency / 1000
+
+    async def old(uid):
+        upsert(uid, ip="10.0.0.1")
+        get_user(uid), logged_in(uid), balance(uid)
+        await asyncio.sleep(api)
+
+    async def new(uid):
+        await db.db_upsert_user(uid, ip="10.0.0.1")
+        await asyncio.gather(db.db_get_user(uid), db.db_is_logged_in(uid), db.db_get_balance(uid))
+        await asyncio.sleep(api)
+
+    async def lag_probe(stop, lags):
+        while not stop.is_set():
+            t = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - t - 0.005)
+
+    out = {}
+    for n, (kind, handler) in enumerate((("blocking", old), ("pooled", new))):
+        base = 40_000_000 + n * args.users
+        times, lags, stop = [], [], asyncio.Event()
+
+        async def one(uid):
+            for _ in range(rounds):
+                t = time.perf_counter()
+                await handler(uid)
+                times.append(time.perf_counter() - t)
+
+        probe = asyncio.ensure_future(lag_probe(stop, lags))
+        t = time.perf_counter()
+        await asyncio.gather(*(one(base + i) for i in range(args.users)))
+        wall = time.perf_counter() - t
+        stop.set()
+        await probe
+        ms = [x * 1000 for x in times]
+        out[kind] = {"handlers": len(times), "wall_s": round(wall, 3), "handlers_per_s": round(len(times) / wall, 1),
+                     "latency_ms": {"p50": round(percentile(ms, 50), 2), "p95": round(percentile(ms, 95), 2),
+                                    "p99": round(percentile(ms, 99), 2)},
+                     "loop_lag_ms": {"p99": round(percentile(lags, 99) * 1000, 2),
+                                     "max": round(max(lags, default=0) * 1000, 2)}}
+    for kind, r in out.items():
+        lat = r["latency_ms"]
+        print(f"db {kind:<9} {args.users} معالج × {rounds}: {r['handlers_per_s']:>8.1f} معالج/ث  "
+              f"p50 {lat['p50']:>7.2f}  p95 {lat['p95']:>7.2f}  p99 {lat['p99']:>7.2f} ms  "
+              f"تأخر الحلقة p99 {r['loop_lag_ms']['p99']:.2f} / أقصى {r['loop_lag_ms']['max']:.2f} ms")
+    return out
+
+
+async def fsm_bench(B, rec, args, users=2000):
+    """كلفة FSM لكل تحديث في مسار الطلب (فحص الحالة ثم update_data/set_state أو finish)
+    مع MemoryStorage وSQLiteStorage، وعدد معاملات الكتابة لكل تحديث، وبقاء الحالة
+    بعد إعادة التشغيل. كل مستخدم يرسل 3 تحديثات متتالية، والمستخدمون متزامنون."""
+    from aiogram.dispatcher import FSMContext
+    from storage import SQLiteStorage, make_storage
+
+    async def flow(storage, uid, first, times):
+        ctx = FSMContext(storage, uid, uid)
+        steps = (("Order:service", {"country": "sa"}), ("Order:wait", {"service": "whatsapp"}), None)
+        for step in steps:
+            t = time.perf_counter()
+            await ctx.get_state()                   # فلتر الحالة
+            if step is None:
+                await ctx.get_data()
+                await ctx.finish()
+            else:
+                await ctx.update_data(**step[1])
+                await ctx.set_state(step[0])
+            (times if step is not steps[0] else first).append(time.perf_counter() - t)
+            await asyncio.sleep(0)                  # بقية المعالج (استدعاءات API)
+
+    out = {}
+    for kind in ("memory", "sqlite"):
+        storage = make_storage(kind)
+        base = 20_000_000 + len(out) * users
+        rec.reset()
+        first, times = [], []
+        t = time.perf_counter()
+        await asyncio.gather(*(flow(storage, base + i, first, times) for i in range(users)))
+        t_close = time.perf_counter()
+        await storage.close()
+        wall = time.perf_counter() - t
+        updates = len(first) + len(times)
+        # أول تحديث لمستخدم جديد يقرأ القاعدة (كاش بارد)، وما بعده من الكاش
+        out[kind] = {"updates": updates, "per_update_us": _us(times), "first_update_us": _us(first),
+                     "updates_per_s": round(updates / wall, 1),
+                     "flush_ms": round((time.perf_counter() - t_close) * 1000, 1),
+                     "db_writes": rec.db_writes,
+                     "db_writes_per_update": round(rec.db_writes / updates, 4)}
+
+    # إعادة تشغيل: حالة نصف مكتملة تُقرأ من القاعدة بمخزن جديد (كاش بارد)
+    storage = SQLiteStorage()
+    base = 20_000_000 + len(out) * users
+    await asyncio.gather(*(FSMContext(storage, base + i, base + i).update_data(country="sa") for i in range(users)))
+    await asyncio.gather(*(FSMContext(storage, base + i, base + i).set_state("Order:service") for i in range(users)))
+    await storage.close()
+    storage = SQLiteStorage()
+    rec.reset()
+    times, kept = [], 0
+    for i in range(users):
+        t = time.perf_counter()
+        ctx = FSMContext(storage, base + i, base + i)
+        kept += await ctx.get_state() == "Order:service" and (await ctx.get_data()).get("country") == "sa"
+        times.append(time.perf_counter() - t)
+    await storage.close()
+    out["sqlite_restart"] = {"kept": kept, "of": users, "cold_read_us": _us(times)}
+
+    for kind in ("memory", "sqlite"):
+        r = out[kind]
+        print(f"fsm {kind:<7} {r['updates']:>6} upd  {r['updates_per_s']:>9.1f} upd/s  "
+              f"mean {r['per_update_us']['mean']:>6.1f}  p95 {r['per_update_us']['p95']:>6.1f}  "
+              f"p99 {r['per_update_us']['p99']:>6.1f} µs  أول تحديث p50 {r['first_update_us']['p50']:>8.1f} µs  "
+              f"كتابات {r['db_writes']} ({r['db_writes_per_update']}/upd)  flush {r['flush_ms']} ms")
+    r = out["sqlite_restart"]
+    print(f"{'✅' if r['kept'] == r['of'] else '❌'} بعد إعادة التشغيل: {r['kept']}/{r['of']} حالة محفوظة  "
+          f"قراءة باردة p50 {r['cold_read_us']['p50']} µs")
+    return out
+
+
+async def keyboards_bench(B, rec, args, rounds=5000):
+    """كلفة لوحة الرد كما يراها aiogram عند الإرسال (prepare_arg): بناء الكائنات ثم
+    تسلسلها مع كل رد (السلوك القديم) مقابل نص JSON الجاهز، وللوحة الدول المعتمدة
+    على الأسعار: بناؤها مقابل كاش price_keyboard. الزمن بالميكروثانية والتخصيص
+    بذروة الذاكرة المتتبَّعة (tracemalloc) لكل رد."""
+    import tracemalloc
+    from aiogram import types
+    from aiogram.utils.payload import prepare_arg
+
+    def rebuild(spec):
+        # نفس خطوات البناء الأصلية: كائن اللوحة ثم صف أزرار لكل سطر
+        if "keyboard" in spec:
+            kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+            for row in spec["keyboard"]:
+                kb.row(*(b if isinstance(b, str) else types.KeyboardButton(**b) for b in row))
+        else:
+            kb = types.InlineKeyboardMarkup()
+            for row in spec["inline_keyboard"]:
+                kb.row(*(types.InlineKeyboardButton(**b) for b in row))
+        return kb
+
+    async def measure(make):
+        await make()                                # تسخين الكاش
+        t = time.perf_counter()
+        for _ in range(rounds):
+            await make()
+        us = (time.perf_counter() - t) * 1e6 / rounds
+        tracemalloc.start()
+        peaks = []
+        for _ in range(200):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            await make()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.stop()
+        return {"us": round(us, 2), "alloc_bytes": int(percentile(peaks, 50))}
+
+    out = {}
+    for name in ("MAIN_MENU", "ACCOUNT_MENU", "ORDER_ACTIONS_KB", "ADMIN_KB"):
+        frozen = getattr(B, name)
+
+        async def built(spec=json.loads(frozen)):
+            return prepare_arg(rebuild(spec))
+
+        async def ready(frozen=frozen):
+            return prepare_arg(frozen)
+
+        out[name] = {"rebuilt": await measure(built), "frozen": await measure(ready)}
+
+    async def countries_built():
+        return prepare_arg(await B._countries_kb(0))
+
+    async def countries_cached():
+        return prepare_arg(await B.countries_keyboard(0))
+
+    out["countries"] = {"rebuilt": await measure(countries_built), "frozen": await measure(countries_cached)}
+    for name, r in out.items():
+        a, b = r["rebuilt"], r["frozen"]
+        print(f"kb {name:<16} بناء {a['us']:>8.2f} µs {a['alloc_bytes']:>7} B   جاهزة {b['us']:>6.2f} µs "
+              f"{b['alloc_bytes']:>5} B   ×{a['us'] / max(b['us'], 0.01):.0f}")
+    return out
+
+
+async def dispatch_bench(B, rec, args, sizes=(10, 50, 200), rounds=2000):
+    """كلفة توجيه تحديث نصي عبر dp.process_update مع تزايد عدد الأزرار: معالج لكل زر
+    بفلتر lambda (السلوك القديم، تُفحص الفلاتر بالترتيب) مقابل معالج واحد يبحث في
+    قاموس كما يفعل route_text. لكل حجم: أول زر، آخر زر، ونص لا يطابق (للدعم)."""
+    from aiogram import Dispatcher, types
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+    async def handled(m):
+        pass
+
+    def chain(labels):
+        dp = Dispatcher(B.bot, storage=MemoryStorage())
+        for label in labels:
+            dp.register_message_handler(handled, lambda m, label=label: m.text == label)
+        dp.register_message_handler(handled, content_types=types.ContentTypes.TEXT)
+        return dp
+
+    def table(labels):
+        dp = Dispatcher(B.bot, storage=MemoryStorage())
+        buttons = dict.fromkeys(labels, handled)
+
+        async def route(m):
+            await buttons.get(m.text, handled)(m)
+        dp.register_message_handler(route, content_types=types.ContentTypes.TEXT)
+        return dp
+
+    async def one(dp, update):
+        Dispatcher.set_current(dp)
+        await dp.process_update(update)
+
+    async def measure(dp, text):
+        updates = [types.Update(**message(1, text)) for _ in range(rounds)]
+        t = time.perf_counter()
+        for update in updates:
+            await asyncio.create_task(one(dp, update))
+        return round((time.perf_counter() - t) * 1e6 / rounds, 1)
+
+    out = {}
+    for n in sizes:
+        labels = [f"زر {i}" for i in range(n)]
+        out[n] = {kind: {"first_us": await measure(dp, labels[0]), "last_us": await measure(dp, labels[-1]),
+                         "unmatched_us": await measure(dp, "نص حر")}
+                  for kind, dp in (("chain", chain(labels)), ("dict", table(labels)))}
+        a, b = out[n]["chain"], out[n]["dict"]
+        print(f"dispatch {n:>4} زر  سلسلة: أول {a['first_us']:>7.1f} آخر {a['last_us']:>7.1f} "
+              f"غير مطابق {a['unmatched_us']:>7.1f} µs   قاموس: أول {b['first_us']:>6.1f} آخر {b['last_us']:>6.1f} "
+              f"غير مطابق {b['unmatched_us']:>6.1f} µs")
+    Dispatcher.set_current(B.dp)
+    return out
+
+
+BENCH_FUNCS = {"db": db_bench, "fsm": fsm_bench, "keyboards": keyboards_bench, "dispatch": dispatch_bench}
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(cond, message):
+    if not cond:
+        raise CheckFailed(message)
+
+
+async def provider_checks():
+    """عملاء المزوّدين والتوجيه عبر HTTP حقيقي ضد خادم وهمي: التحليل، إعادة المحاولة،
+    المهلة، NO_NUMBERS، القاطع والتحويل بين المزوّدين. يعيد [{name, ok, ms, detail}]."""
+    from fakeproviders import FakeProviders, FIVESIM, SMSACTIVATE
+    from providers import (FiveSim, SmsActivate, ProviderRouter, ProviderError, NoNumbers, CircuitOpen,
+                           CircuitBreaker, WAIT_CODE, CODE_RECEIVED, CANCELED)
+
+    fake = FakeProviders(api_key="test", hang=2.0)
+    runner, base = await fake.start()
+
+    async def fresh():
+        # عملاء جدد لكل فحص: قاطع مغلق ومهلة قصيرة
+        def opts():
+            return {"timeout": 0.3, "retries": 2, "backoff": 0.02,
+                    "breaker": CircuitBreaker(failures=3, reset_after=0.3)}
+        router = ProviderRouter([FiveSim("test", base_url=base + "/v1", **opts()),
+                                 SmsActivate("test", base_url=base + "/stubs/handler_api.php", **opts())])
+        await router.start()
+        fake.faults[FIVESIM].clear()
+        fake.faults[SMSACTIVATE].clear()
+        fake.down.clear()
+        return router, router.get(FIVESIM), router.get(SMSACTIVATE)
+
+    async def parse_fivesim(router, five, sa):
+        a = await five.buy("sa", "whatsapp")
+        expect(a.provider == FIVESIM and a.phone.startswith("+9665") and a.cost == fake.cost, f"buy: {a}")
+        expect(await five.status(a.id) == (WAIT_CODE, None), "status before sms")
+        b = await five.buy("eg", "telegram")
+        fake.deliver(a.id, "123456")
+        await five.cancel(b.id)
+        got = await five.statuses([a.id, b.id])
+        expect(got == {a.id: (CODE_RECEIVED, "123456"), b.id: (CANCELED, None)}, f"statuses: {got}")
+
+    async def parse_smsactivate(router, five, sa):
+        a, b, c = [await sa.buy("sa", "whatsapp") for _ in range(3)]
+        expect(a.provider == SMSACTIVATE and a.phone == f"+7900{a.id}", f"buy: {a}")
+        fake.deliver(a.id, "4321")
+        await sa.cancel(c.id)
+        got = await sa.statuses([a.id, b.id, c.id])
+        expect(got == {a.id: (CODE_RECEIVED, "4321"), b.id: (WAIT_CODE, None), c.id: (CANCELED, None)},
+               f"statuses: {got}")
+
+    async def catalogs(router, five, sa):
+        rows = await five.catalog()
+        expect(len(rows) == 8 and ("sa", "whatsapp", fake.cost, fake.stock, "Saudi Arabia") in rows, f"5sim: {rows}")
+        rows = await sa.catalog()
+        expect(sorted(r[:2] for r in rows) == [(c, "whatsapp") for c in ("eg", "sa", "tr", "ye")], f"sms-activate: {rows}")
+
+    async def no_numbers(router, five, sa):
+        for p in (five, sa):
+            fake.fail(p.name, "no_numbers")
+            try:
+                await p.buy("sa", "whatsapp")
+                expect(False, f"{p.name}: no NoNumbers")
+            except NoNumbers:
+                pass
+            expect(p.breaker.failures == 0, f"{p.name}: NO_NUMBERS counted as a failure")
+
+    async def retries(router, five, sa):
+        fake.fail(FIVESIM, "500", 1)
+        fake.fail(FIVESIM, "429", 1)
+        hits = fake.hits[FIVESIM]
+        t = time.perf_counter()
+        await five.buy("sa", "whatsapp")
+        elapsed = time.perf_counter() - t
+        expect(fake.hits[FIVESIM] - hits == 3, f"{fake.hits[FIVESIM] - hits} requests, expected 3")
+        # تأخير 0.02 ثم 0.04 مع jitter بين 0.5 و1.5
+        expect(0.03 <= elapsed < 1.0, f"backoff {elapsed:.3f}s")
+        expect(five.breaker.failures == 0, "success must reset the breaker")
+
+    async def timeouts(router, five, sa):
+        fake.fail(SMSACTIVATE, "timeout", 3)
+        t = time.perf_counter()
+        try:
+            await sa.buy("sa", "whatsapp")
+            expect(False, "no ProviderError")
+        except ProviderError as e:
+            expect(not isinstance(e, NoNumbers), repr(e))
+        elapsed = time.perf_counter() - t
+        expect(elapsed < 3 * 0.3 + 0.5, f"gave up after {elapsed:.2f}s")
+        expect(sa.breaker.failures == 1, f"breaker failures {sa.breaker.failures}")
+
+    async def garbage(router, five, sa):
+        for p in (five, sa):
+            fake.fail(p.name, "garbage")
+            try:
+                await p.buy("sa", "whatsapp")
+                expect(False, f"{p.name}: garbage accepted")
+            except NoNumbers:
+                expect(False, f"{p.name}: garbage read as NO_NUMBERS")
+            except ProviderError:
+                pass
+
+    async def breaker(router, five, sa):
+        fake.down[FIVESIM] = "500"
+        for _ in range(3):
+            try:
+                await five.buy("sa", "whatsapp")
+            except ProviderError:
+                pass
+        expect(five.breaker.is_open, "breaker still closed after 3 failures")
+        hits = fake.hits[FIVESIM]
+        try:
+            await five.buy("sa", "whatsapp")
+            expect(False, "open breaker let the call through")
+        except CircuitOpen:
+            pass
+        expect(fake.hits[FIVESIM] == hits, "open breaker still hit the server")
+        del fake.down[FIVESIM]
+        await asyncio.sleep(0.35)
+        await five.buy("sa", "whatsapp")        # نصف مفتوح: محاولة تجريبية تنجح فيُغلق
+        expect(not five.breaker.is_open, "breaker not closed after a successful probe")
+
+    async def failover(router, five, sa):
+        fake.down[FIVESIM] = "500"
+        order = [FIVESIM, SMSACTIVATE]
+        a = await router.buy("sa", "whatsapp", order)
+        expect(a.provider == SMSACTIVATE, f"bought from {a.provider}")
+        for _ in range(2):
+            await router.buy("sa", "whatsapp", order)
+        expect(five.breaker.is_open, "5sim breaker still closed")
+        hits = fake.hits[FIVESIM]
+        a = await router.buy("sa", "whatsapp", order)
+        expect(a.provider == SMSACTIVATE and fake.hits[FIVESIM] == hits, "router did not skip the open provider")
+
+    async def router_errors(router, five, sa):
+        order = [FIVESIM, SMSACTIVATE]
+        fake.fail(FIVESIM, "no_numbers")
+        fake.fail(SMSACTIVATE, "no_numbers")
+        try:
+            await router.buy("sa", "whatsapp", order)
+            expect(False, "no NoNumbers")
+        except NoNumbers:
+            pass
+        fake.fail(FIVESIM, "no_numbers")
+        fake.fail(SMSACTIVATE, "500", 3)
+        try:
+            await router.buy("sa", "whatsapp", order)
+            expect(False, "no ProviderError")
+        except NoNumbers:
+            expect(False, "an outage was reported as NO_NUMBERS")
+        except ProviderError:
+            pass
+
+    async def replace(router, five, sa):
+        a = await router.buy("sa", "whatsapp", [FIVESIM])
+        b = await router.replace(FIVESIM, a.id, "sa", "whatsapp", [FIVESIM, SMSACTIVATE])
+        expect(b.provider == FIVESIM and b.id != a.id, f"replacement {b}")
+        expect(fake.activations[a.id][1] == "CANCEL", "old number not cancelled")
+
+    results = []
+    for check in (parse_fivesim, parse_smsactivate, catalogs, no_numbers, retries, timeouts, garbage,
+                  breaker, failover, router_errors, replace):
+        router, five, sa = await fresh()
+        t = time.perf_counter()
+        try:
+            await check(router, five, sa)
+            ok, detail = True, ""
+        except CheckFailed as e:
+            ok, detail = False, str(e)
+        except Exception as e:
+            ok, detail = False, repr(e)
+        results.append({"name": check.__name__, "ok": ok, "ms": round((time.perf_counter() - t) * 1000, 1),
+                        "detail": detail})
+        await router.close()
+    await runner.cleanup()
+    for r in results:
+        print(f"{'✅' if r['ok'] else '❌'} {r['name']:<18} {r['ms']:>7.1f} ms  {r['detail']}")
+    return results
+
+
+def print_result(r, base=None):
+    lat = r["latency_ms"]
+    line = (f"{r['scenario']:<8} {r['updates']:>6} upd  {r['throughput_ups']:>8.1f} upd/s  "
+            f"p50 {lat['p50']:>7.1f}  p95 {lat['p95']:>7.1f}  p99 {lat['p99']:>7.1f} ms  "
+            f"db {r['db']['per_update_ms']:>6.2f} ms/upd  api {r['api_per_update']:>5.2f}/upd")
+    if r["errors"]:
+        line += f"  ⚠️ {r['errors']} errors"
+    print(line)
+    if base:
+        d_tp = (r["throughput_ups"] / base["throughput_ups"] - 1) * 100 if base["throughput_ups"] else 0.0
+        d_p95 = (lat["p95"] / base["latency_ms"]["p95"] - 1) * 100 if base["latency_ms"]["p95"] else 0.0
+        print(f"{'':<8} مقارنة بالأساس: الإنتاجية {d_tp:+.1f}%  p95 {d_p95:+.1f}%")
+    if r.get("webhook"):
+        w = r["webhook"]
+        ok = not w["reordered_users"] and not w["misrouted"] and w["worker_down_status"] == 503
+        print(f"{'':<8} {'✅' if ok else '❌'} webhook: {w['workers']} عمال | خارج الترتيب {w['reordered_users']} | "
+              f"عامل خاطئ {w['misrouted']} | عامل متوقف → HTTP {w['worker_down_status']}")
+    if r["pool"]["hit_rate"] is not None:
+        print(f"{'':<8} مخزون الأرقام: إصابة {r['pool']['hits']}/{r['pool']['hits'] + r['pool']['misses']}")
+    print(f"{'':<8} {r['api']}")
+
+
+async def main():
+    args = parse_args()
+    if args.providers:
+        results = await provider_checks()
+        if args.json:
+            text = json.dumps({"label": args.label, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                               "providers": results}, ensure_ascii=False, indent=2)
+            if args.json == "-":
+                print(text)
+            else:
+                with open(args.json, "w", encoding="utf-8") as f:
+                    f.write(text)
+        sys.exit(0 if all(r["ok"] for r in results) else 1)
+    rec = Recorder()
+    # زمن الإقلاع البارد: قاعدة جديدة تمر بكل خطوات الترحيل، ثم إقلاع ثانٍ بلا خطوات
+    t = time.perf_counter()
+    B = setup(args, rec)
+    startup = {"import_ms": (time.perf_counter() - t) * 1000}
+    startup["init_db_cold_ms"] = B.init_db() * 1000
+    startup["init_db_warm_ms"] = B.init_db() * 1000
+    t = time.perf_counter()
+    await B.load_cache()
+    startup["load_cache_ms"] = (time.perf_counter() - t) * 1000
+    startup = {k: round(v, 1) for k, v in startup.items()}
+    startup["total_ms"] = round(startup["import_ms"] + startup["init_db_cold_ms"] + startup["load_cache_ms"], 1)
+    print(f"startup  import {startup['import_ms']:.1f}  init_db {startup['init_db_cold_ms']:.1f} "
+          f"(ثانٍ {startup['init_db_warm_ms']:.1f})  load_cache {startup['load_cache_ms']:.1f}  "
+          f"= {startup['total_ms']:.1f} ms")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {r["scenario"]: r for r in json.load(f)["scenarios"]}
+
+    results = []
+    history = await history_bench(B, rec, args) if args.history else None
+    stats = await stats_bench(B, args) if args.stats else None
+    ledger = await ledger_bench(B, args) if args.ledger else None
+    benches = {}
+    for name in args.bench or ():
+        benches[name] = await BENCH_FUNCS[name](B, rec, args)
+    run = run_webhook_scenario if args.webhook else run_scenario
+    for i, name in enumerate([] if args.history or args.stats or args.ledger or args.bench else args.scenario or SCENARIOS):
+        r = await run(B, rec, name, args, base=(i + 1) * 10_000_000)
+        results.append(r)
+        print_result(r, baseline.get(name))
+
+    # إيقاف بلا انتظار طابور الإشعارات (مقيَّد بحد القنوات)
+    await B.pool.close()
+    await B.notifier.close(timeout=0.1)
+    await B.dp.storage.close()
+    await B.shutdown_db()
+
+    if args.json:
+        out = {"label": args.label, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "config": {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "label")},
+               "startup": startup, "history": history, "stats": stats, "ledger": ledger, "benches": benches,
+               "scenarios": results}
+        text = json.dumps(out, ensure_ascii=False, indent=2)
+        if args.json == "-":
+            print(text)
+        else:
+            with open(args.json, "w", encoding="utf-8") as f:
+                f.write(text)
+
+    if args.startup_budget and startup["total_ms"] > args.startup_budget:
+        print(f"⚠️ زمن الإقلاع {startup['total_ms']:.1f} ms تجاوز الحد {args.startup_budget:.0f} ms")
+        sys.exit(1)
+    if any(r and not r["ok"] for r in (history, stats, ledger)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
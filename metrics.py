@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# =============== القياسات ونقطة /metrics ===============
+# هيستوغرامات وعدّادات داخل العملية (قاموس لكل مجموعة وسوم، بلا أقفال ولا
+# مكتبات خارجية) تُعرض بصيغة Prometheus على منفذ محلي. تُقاس المعالجات عبر
+# middleware، واستدعاءات قاعدة البيانات في db.read/write، وكل استدعاءات
+# Telegram عبر bot.request. المحلّل بأخذ العينات اختياري ويُشغَّل من /admin.
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Counter
+from contextvars import ContextVar
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _esc(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    parts = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    def __init__(self, name, doc, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}       # labels -> [counts per bucket..., +Inf], sum
+
+    def observe(self, labels, value):
+        s = self._series.get(labels)
+        if s is None:
+            s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in list(self._series.items()):
+            acc = 0
+            for le, n in zip(self.buckets + ("+Inf",), counts):
+                acc += n
+                le = _labels(self.labelnames, labels, 'le="%s"' % le)
+                out.append(f"{self.name}_bucket{le} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {acc}")
+        return out
+
+
+class Counter:
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self._values = _Counter()
+
+    def inc(self, labels=(), n=1):
+        self._values[labels] += n
+
+    def get(self, labels=()):
+        return self._values[labels]
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in list(self._values.items())]
+        return out
+
+
+class Gauge:
+    """قيمة تُقرأ لحظة العرض من دالة (لا تكلفة في المسار الساخن)."""
+
+    def __init__(self, name, doc, fn):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            log.exception("gauge %s failed", self.name)
+            return []
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+HANDLER_SECONDS = register(Histogram("bot_handler_seconds", "Handler run time", ("handler", "kind")))
+DB_SECONDS = register(Histogram("bot_db_seconds", "DB call time incl. queueing", ("op", "mode")))
+API_SECONDS = register(Histogram("bot_telegram_api_seconds", "Telegram Bot API call time", ("method",)))
+ERRORS = register(Counter("bot_errors_total", "Errors, incl. ones handled or swallowed", ("where", "error")))
+UNHANDLED = register(Counter("bot_unhandled_updates_total", "Updates no handler matched", ("kind",)))
+
+
+def count_error(where, exc):
+    ERRORS.inc((where, type(exc).__name__))
+
+
+def render():
+    lines = []
+    for m in REGISTRY:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+
+# =============== Middleware ===============
+_SKIP_KINDS = ("update", "error")
+_handler_name = ContextVar("metrics_handler", default="dispatcher")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """زمن كل معالج باسمه؛ resolve(handler, obj) يتيح تسمية أدق (مثل موجّه الأزرار)."""
+
+    def __init__(self, resolve=None):
+        super().__init__()
+        self.resolve = resolve
+
+    async def trigger(self, action, args):
+        if action.startswith("process_"):
+            if action[len("process_"):] in _SKIP_KINDS:
+                return
+            obj, data = args[0], args[-1]
+            handler = current_handler.get()
+            if self.resolve is not None:
+                handler = self.resolve(handler, obj)
+            name = getattr(handler, "__name__", "?")
+            _handler_name.set(name)
+            data["_metrics"] = (name, time.perf_counter())
+        elif action.startswith("post_process_"):
+            kind = action[len("post_process_"):]
+            if kind in _SKIP_KINDS:
+                return
+            started = args[-1].get("_metrics")
+            if started is None:
+                UNHANDLED.inc((kind,))
+            else:
+                HANDLER_SECONDS.observe((started[0], kind), time.perf_counter() - started[1])
+
+
+def current_handler_name():
+    """اسم المعالج الجاري في هذا التحديث (لعدّ الأخطاء في errors_handler)."""
+    return _handler_name.get()
+
+
+def instrument_bot(bot):
+    """توقيت كل استدعاءات Bot API (send_message, edit_text, get_chat_member...) في نقطة واحدة."""
+    request = bot.request
+
+    async def timed_request(method, data=None, files=None, **kwargs):
+        t = time.perf_counter()
+        try:
+            return await request(method, data, files, **kwargs)
+        except Exception as e:
+            count_error(f"api:{method}", e)
+            raise
+        finally:
+            API_SECONDS.observe((method,), time.perf_counter() - t)
+
+    bot.request = timed_request
+
+
+# =============== نقطة /metrics ===============
+async def serve(host, port, sampler=None):
+    """خادم aiohttp محلي: /metrics و(إن وُجد محلّل) /profile بصيغة collapsed stacks."""
+    from aiohttp import web
+
+    async def metrics(_):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def profile(_):
+        return web.Response(text=sampler.collapsed() if sampler else "", content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/profile", profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("metrics on http://%s:%s/metrics", host, port)
+    return runner
+
+
+# =============== المحلّل بأخذ العينات ===============
+class Sampler:
+    """خيط يأخذ مكدس خيط الحلقة كل interval ثانية؛ كلفته صفر وهو متوقف."""
+
+    def __init__(self, interval=0.005, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = _Counter()
+        self.samples = 0
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._target = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self._target = threading.get_ident()      # يُستدعى من خيط الحلقة
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "\n".join(f"{';'.join(s)} {n}" for s, n in self.stacks.most_common())
+
+    def top(self, n=10):
+        """أكثر الدوال ظهورًا في أعلى المكدس (الوقت الذاتي)."""
+        leaves = _Counter()
+        for stack, count in self.stacks.items():
+            if stack:
+                leaves[stack[-1]] += count
+        return leaves.most_common(n)
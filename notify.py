@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# =============== طابور إشعارات قنوات الإدارة ===============
+# الإشعارات تُدفع للطابور ويعود المعالج فورًا؛ لكل قناة عامل خلفي ودلو رموز
+# (token bucket) يحترم حدود تيليجرام. إذا تراكمت عدة إشعارات بانتظار رمز
+# تُدمج في رسالة ملخّص واحدة بدل أن تُفقد، ويُحترم RetryAfter عند الحظر المؤقت.
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+
+from aiogram.utils.exceptions import RetryAfter
+
+from metrics import count_error
+
+log = logging.getLogger(__name__)
+
+MAX_MESSAGE = 4000
+
+
+@dataclass
+class Event:
+    kind: str
+    text: str
+    summary: str
+    ts: float
+    attempts: int = 0
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Notifier:
+    def __init__(self, bot, rate=20 / 60, burst=3, max_queue=1000, max_attempts=3):
+        self.bot = bot
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self._queues = {}      # chat_id -> deque[Event]
+        self._buckets = {}
+        self._workers = {}
+        self.stats = Counter(sent=0, merged=0, dropped=0, failed=0, retries=0)
+
+    @property
+    def depth(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def push(self, chat_id, text, kind="", summary=None):
+        q = self._queues.setdefault(chat_id, deque())
+        if len(q) >= self.max_queue:
+            q.popleft()
+            self.stats["dropped"] += 1
+        q.append(Event(kind, text, summary or text, time.monotonic()))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.get_running_loop().create_task(self._worker(chat_id))
+
+    def _take(self, q):
+        """إشعار واحد كما هو، أو ملخّص لكل ما تراكم (ضمن حد طول الرسالة)."""
+        if len(q) == 1:
+            ev = q.popleft()
+            return [ev], ev.text
+        batch, size = [], 200
+        while q and (not batch or size + len(q[0].summary) + 1 <= MAX_MESSAGE):
+            ev = q.popleft()
+            batch.append(ev)
+            size += len(ev.summary) + 1
+        secs = max(1, int(time.monotonic() - batch[0].ts))
+        counts = Counter(ev.kind for ev in batch)
+        head = f"📦 <b>ملخّص {len(batch)} إشعارًا خلال آخر {secs} ث</b>\n"
+        head += "".join(f"• {n} × {kind or 'إشعار'}\n" for kind, n in counts.items())
+        return batch, head + "━━━━━━━━━━━━━━━\n" + "\n".join(ev.summary for ev in batch)
+
+    async def _worker(self, chat_id):
+        q = self._queues[chat_id]
+        bucket = self._buckets.setdefault(chat_id, TokenBucket(self.rate, self.burst))
+        try:
+            while q:
+                await bucket.acquire()
+                batch, text = self._take(q)
+                try:
+                    await self.bot.send_message(chat_id, text, disable_web_page_preview=True)
+                    self.stats["sent"] += 1
+                    self.stats["merged"] += len(batch) - 1
+                except RetryAfter as e:
+                    self.stats["retries"] += 1
+                    q.extendleft(reversed(batch))
+                    await asyncio.sleep(e.timeout)
+                except Exception as e:
+                    count_error("notifier", e)
+                    log.exception("notification to %s failed", chat_id)
+                    retry = [ev for ev in batch if ev.attempts + 1 < self.max_attempts]
+                    for ev in retry:
+                        ev.attempts += 1
+                    self.stats["failed"] += len(batch) - len(retry)
+                    if retry:
+                        self.stats["retries"] += 1
+                        q.extendleft(reversed(retry))
+                        await asyncio.sleep(2 ** retry[0].attempts)
+        finally:
+            self._workers.pop(chat_id, None)
+
+    async def close(self, timeout=5.0):
+        """انتظار تفريغ الطوابير عند الإيقاف (بحد أقصى timeout)."""
+        if self._workers:
+            await asyncio.wait(list(self._workers.values()), timeout=timeout)
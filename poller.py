@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# =============== مُجدول جلب أكواد التفعيل ===============
+# مهمة خلفية واحدة تتابع كل طلبات WAIT_CODE المفتوحة: تُرتَّب في كومة حسب
+# موعد الفحص التالي، وفي كل نبضة تُجمَّع الطلبات المستحقة حسب المزوّد وتُفحص
+# دفعةً واحدة (نقطة جماعية إن وُجدت). فترة الفحص تبدأ قصيرة وتطول تدريجيًا،
+# والطلب ينتهي تلقائيًا بعد مهلة المزوّد. النتائج تُكتب في معاملة واحدة.
+import asyncio
+import heapq
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from db import db_open_orders, db_finish_orders
+from metrics import count_error
+from providers import ProviderError, WAIT_CODE, CODE_RECEIVED, CANCELED, TIMEOUT
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class OpenOrder:
+    id: int
+    user_id: int
+    provider: str
+    ext_id: str
+    country: str
+    service: str
+    phone: str
+    price: float
+    chat_id: int
+    message_id: int
+    expires_at: float
+    interval: float
+    next_at: float
+
+
+class CodePoller:
+    def __init__(self, router, on_finish, tick=1.0, first_delay=3.0, max_interval=30.0,
+                 factor=1.5, ttl=1200.0, batch=100):
+        self.router = router
+        self.on_finish = on_finish      # coroutine(order, status, code)
+        self.tick = tick
+        self.first_delay = first_delay
+        self.max_interval = max_interval
+        self.factor = factor
+        self.ttl = ttl
+        self.batch = batch
+        self.orders = {}                # order_id -> OpenOrder
+        self._heap = []                 # (next_at, order_id)
+        self._task = None
+
+    def track(self, order_id, user_id, provider, ext_id, country, service, phone, price,
+              chat_id, message_id, created_at=None):
+        now = time.monotonic()
+        age = time.time() - created_at if created_at else 0.0
+        o = OpenOrder(order_id, user_id, provider, ext_id, country, service, phone, price,
+                      chat_id, message_id, now + self.ttl - age, self.first_delay, now + self.first_delay)
+        self.orders[order_id] = o
+        heapq.heappush(self._heap, (o.next_at, order_id))
+
+    def untrack(self, order_id):
+        # الحذف من الكومة كسول: المدخل القديم يُتجاهل عند خروجه
+        return self.orders.pop(order_id, None)
+
+    def resume(self, o):
+        """إعادة متابعة طلب أُوقف (فشل إلغاؤه لدى المزوّد)، بفحص فوري."""
+        o.next_at = time.monotonic()
+        self.orders[o.id] = o
+        heapq.heappush(self._heap, (o.next_at, o.id))
+
+    async def load(self, shard=(0, 1)):
+        """تحميل الطلبات المفتوحة؛ shard=(index, count) يحصر التحميل في مستخدمي هذا العامل."""
+        index, count = shard
+        for (oid, uid, provider, country, service, phone, price, _, created_at, ext_id,
+             chat_id, message_id, _) in await db_open_orders():
+            if not ext_id or uid % count != index:
+                continue
+            created = datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc).timestamp() if created_at else None
+            self.track(oid, uid, provider, ext_id, country, service, phone, price, chat_id, message_id, created)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.poll_due()
+            except Exception as e:
+                count_error("poller", e)
+                log.exception("code poller tick failed")
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            at, oid = heapq.heappop(self._heap)
+            o = self.orders.get(oid)
+            if o is not None and o.next_at == at:
+                due.append(o)
+        return due
+
+    def _reschedule(self, o, now):
+        o.interval = min(o.interval * self.factor, self.max_interval)
+        o.next_at = now + o.interval
+        heapq.heappush(self._heap, (o.next_at, o.id))
+
+    async def poll_due(self):
+        now = time.monotonic()
+        due = self._pop_due(now)
+        if not due:
+            return
+        finished = []   # (order, status, code)
+        by_provider = {}
+        for o in due:
+            if o.expires_at <= now:
+                finished.append((o, TIMEOUT, None))
+            else:
+                by_provider.setdefault(o.provider, []).append(o)
+
+        async def check(provider, chunk):
+            try:
+                return chunk, await self.router.get(provider).statuses([o.ext_id for o in chunk])
+            except ProviderError:
+                return chunk, {}
+
+        jobs = [check(p, group[i:i + self.batch])
+                for p, group in by_provider.items() for i in range(0, len(group), self.batch)]
+        for chunk, results in await asyncio.gather(*jobs):
+            for o in chunk:
+                status, code = results.get(o.ext_id, (WAIT_CODE, None))
+                if status in (CODE_RECEIVED, CANCELED, TIMEOUT):
+                    finished.append((o, status, code))
+                else:
+                    self._reschedule(o, now)
+
+        # قد يكون المستخدم ألغى/غيّر الرقم أثناء الفحص
+        finished = [(o, s, c) for o, s, c in finished if self.orders.get(o.id) is o]
+        if not finished:
+            return
+        for o, _, _ in finished:
+            self.orders.pop(o.id, None)
+        done = set(await db_finish_orders([(s, c, o.id) for o, s, c in finished]))
+        finished = [(o, s, c) for o, s, c in finished if o.id in done]
+        # إعادة الأرقام المنتهية للمزوّد حتى لا تُحتسب علينا
+        results = await asyncio.gather(*(self.router.cancel(o.provider, o.ext_id) for o, s, _ in finished if s == TIMEOUT),
+                                       return_exceptions=True)
+        results += await asyncio.gather(*(self.on_finish(o, s, c) for o, s, c in finished), return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                count_error("poller", r)
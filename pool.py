@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# =============== مخزون الأرقام الجاهزة ===============
+# لكل (دولة، خدمة) عليها طلب حديث نحتفظ بعدد صغير من الأرقام المشتراة مسبقًا،
+# فيُسلَّم الرقم فور الضغط بدل انتظار جولة كاملة عند المزوّد. حجم المخزون
+# يتبع الطلب في آخر window ثانية (صفر إن لم يُطلب شيء)، والأرقام التي تقترب
+# من انتهاء مهلتها تُعاد للمزوّد (إلغاء مجاني) حتى لا ندفع ثمن أرقام لا تُباع.
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+import metrics
+from providers import ProviderError, NoNumbers
+
+log = logging.getLogger(__name__)
+
+POOL_TAKES = metrics.register(metrics.Counter("bot_pool_takes_total", "Number pool lookups", ("result",)))
+POOL_RELEASED = metrics.register(metrics.Counter("bot_pool_released_total", "Pooled numbers given back", ("reason",)))
+
+
+class NumberPool:
+    def __init__(self, router, order_fn, max_size=3, horizon=60.0, window=600.0, max_age=300.0,
+                 tick=5.0, buy_concurrency=5):
+        self.router = router
+        self.order_fn = order_fn        # coroutine(country, service) → ترتيب الشراء (مسار القائمة الأرخص أولًا)
+        self.max_size = max_size
+        self.horizon = horizon          # نغطي الطلب المتوقع خلال هذه المدة
+        self.window = window
+        self.max_age = max_age          # بعدها يُعاد الرقم (يبقى للمستخدم ttl - max_age على الأقل)
+        self.tick = tick
+        self._sem = asyncio.Semaphore(buy_concurrency)
+        self._stock = {}                # (country, service) -> deque[(Activation, bought_at)]
+        self._demand = {}               # (country, service) -> deque[ts]
+        self._task = None
+        metrics.register(metrics.Gauge("bot_pool_size", "Numbers held in the pool", lambda: self.size))
+
+    @property
+    def size(self):
+        return sum(len(q) for q in self._stock.values())
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def take(self, country, service):
+        """رقم جاهز أو None؛ يعيد (Activation, وقت الشراء) ويسجّل الطلب."""
+        if not self.enabled:
+            return None
+        key = (country, service)
+        now = time.time()
+        self._demand.setdefault(key, deque()).append(now)
+        q = self._stock.get(key)
+        while q:
+            act, bought_at = q.popleft()
+            if now - bought_at < self.max_age:
+                POOL_TAKES.inc(("hit",))
+                return act, bought_at
+            asyncio.get_running_loop().create_task(self._release(act, "expired"))
+        POOL_TAKES.inc(("miss",))
+        return None
+
+    def put_back(self, act, bought_at):
+        """إرجاع رقم لم يُستعمل (مثلًا رصيد غير كافٍ) لأول المخزون."""
+        self._stock.setdefault((act.country, act.service), deque()).appendleft((act, bought_at))
+
+    def target(self, key, now):
+        d = self._demand.get(key)
+        if not d:
+            return 0
+        while d and d[0] < now - self.window:
+            d.popleft()
+        return min(self.max_size, math.ceil(len(d) * self.horizon / self.window))
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """إيقاف التعبئة وإعادة كل الأرقام غير المستعملة للمزوّد."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        held = [act for q in self._stock.values() for act, _ in q]
+        self._stock.clear()
+        await asyncio.gather(*(self._release(act, "shutdown") for act in held))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.refill()
+            except Exception as e:
+                metrics.count_error("pool", e)
+                log.exception("number pool refill failed")
+
+    async def refill(self):
+        now = time.time()
+        jobs = []
+        for key in set(self._stock) | set(self._demand):
+            q = self._stock.setdefault(key, deque())
+            # الأقدم أولًا: ما اقترب من انتهائه، ثم ما زاد على الحاجة
+            while q and now - q[0][1] >= self.max_age:
+                jobs.append(self._release(q.popleft()[0], "expired"))
+            want = self.target(key, now)
+            while len(q) > want:
+                jobs.append(self._release(q.popleft()[0], "surplus"))
+            if want > len(q):
+                order = await self.order_fn(*key)
+                jobs += [self._buy(key, order) for _ in range(want - len(q))]
+            if not q and not want:
+                del self._stock[key]
+                self._demand.pop(key, None)
+        if jobs:
+            await asyncio.gather(*jobs)
+
+    async def _buy(self, key, order):
+        async with self._sem:
+            try:
+                act = await self.router.buy(key[0], key[1], order)
+            except NoNumbers:
+                return
+            except ProviderError as e:
+                metrics.count_error("pool", e)
+                return
+        self._stock.setdefault(key, deque()).append((act, time.time()))
+
+    async def _release(self, act, reason):
+        try:
+            await self.router.cancel(act.provider, act.id)
+            POOL_RELEASED.inc((reason,))
+        except ProviderError as e:
+            # بعض المزوّدين يرفضون الإلغاء المبكر؛ ينتهي الرقم وحده لدى المزوّد
+            metrics.count_error("pool", e)
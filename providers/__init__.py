@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+from .base import (Activation, Provider, ProviderError, NoNumbers, CircuitOpen, CircuitBreaker,
+                   WAIT_CODE, CODE_RECEIVED, CANCELED, TIMEOUT)
+from .fivesim import FiveSim
+from .smsactivate import SmsActivate
+from .router import ProviderRouter
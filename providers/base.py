@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# =============== الواجهة المشتركة لمزوّدي الأرقام ===============
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import aiohttp
+
+# حالات التفعيل الموحّدة بين المزوّدين
+WAIT_CODE = "WAIT_CODE"
+CODE_RECEIVED = "CODE_RECEIVED"
+CANCELED = "CANCELED"
+TIMEOUT = "TIMEOUT"
+
+
+@dataclass
+class Activation:
+    provider: str
+    id: str
+    phone: str
+    country: str
+    service: str
+    cost: float = 0.0
+
+
+class ProviderError(Exception):
+    """خطأ من المزوّد أو من الشبكة."""
+
+
+class NoNumbers(ProviderError):
+    """لا توجد أرقام متاحة لهذه الدولة/الخدمة (ليس عطلًا في المزوّد)."""
+
+
+class CircuitOpen(ProviderError):
+    """القاطع مفتوح: المزوّد معطّل مؤقتًا بعد أخطاء متتالية."""
+
+
+class CircuitBreaker:
+    def __init__(self, failures=5, reset_after=30.0):
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # نصف مفتوح: نسمح بمحاولة تجريبية بعد انقضاء المهلة
+        return time.monotonic() - self.opened_at >= self.reset_after
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+
+class Provider:
+    name = ""
+
+    def __init__(self, api_key, base_url=None, timeout=10.0, retries=2, backoff=0.3, breaker=None):
+        self.api_key = api_key
+        if base_url:
+            self.base_url = base_url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def _request(self, path="", params=None, headers=None):
+        """GET مع إعادة المحاولة (تأخير أُسّي + jitter) وقاطع دائرة. يعيد (content_type, body)."""
+        if not self.breaker.allow():
+            raise CircuitOpen(f"{self.name}: circuit open")
+        last = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            try:
+                async with self.session.get(self.base_url + path, params=params, headers=headers,
+                                            timeout=self.timeout) as r:
+                    body = await r.text()
+                    if r.status >= 500 or r.status == 429:
+                        last = ProviderError(f"{self.name}: HTTP {r.status}")
+                        continue
+                    self.breaker.success()
+                    return r.content_type, body
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last = ProviderError(f"{self.name}: {e!r}")
+        self.breaker.failure()
+        raise last
+
+    # --- يجب أن يطبّقها كل مزوّد ---
+    async def buy(self, country: str, service: str) -> Activation:
+        raise NotImplementedError
+
+    async def status(self, activation_id: str):
+        """يعيد (الحالة، الكود أو None)."""
+        raise NotImplementedError
+
+    async def cancel(self, activation_id: str):
+        raise NotImplementedError
+
+    async def statuses(self, activation_ids):
+        """استعلام جماعي؛ الافتراضي استعلامات متوازية لمن لا يملك نقطة جماعية."""
+        results = await asyncio.gather(*(self.status(i) for i in activation_ids), return_exceptions=True)
+        return {i: r for i, r in zip(activation_ids, results) if not isinstance(r, Exception)}
+
+    async def catalog(self):
+        """الأسعار والمخزون بأكوادنا: [(country, service, cost, count, country_name)]."""
+        return []
+
+    async def _parse(self, fn, *args):
+        # القوائم الكاملة قد تبلغ عدة ميغابايت: التحليل خارج حلقة الأحداث
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# =============== 5SIM ===============
+import json
+
+from .base import (Activation, Provider, ProviderError, NoNumbers,
+                   WAIT_CODE, CODE_RECEIVED, CANCELED, TIMEOUT)
+
+COUNTRIES = {"sa": "saudiarabia", "eg": "egypt", "ye": "yemen", "tr": "turkey"}
+SERVICES = {"whatsapp": "whatsapp", "telegram": "telegram"}
+
+_STATUS = {
+    "PENDING": WAIT_CODE,
+    "RECEIVED": WAIT_CODE,      # تصبح CODE_RECEIVED عند وجود رسالة
+    "FINISHED": CODE_RECEIVED,
+    "CANCELED": CANCELED,
+    "BANNED": CANCELED,
+    "TIMEOUT": TIMEOUT,
+}
+
+
+_PRODUCTS = {v: k for k, v in SERVICES.items()}
+
+
+def _flatten(countries_body, prices_body):
+    """{country: {product: {operator: {cost, count}}}} → صفوف بأكواد ISO، وأرخص مشغّل متوفر."""
+    iso_of, names = {}, {}
+    for name, info in json.loads(countries_body).items():
+        for iso in (info.get("iso") or {}):
+            iso_of[name] = iso.lower()
+            names[iso.lower()] = (name, info.get("text_en") or name)
+    rows = []
+    for name, products in json.loads(prices_body).items():
+        iso = iso_of.get(name)
+        if iso is None:
+            continue
+        for product, operators in products.items():
+            stocked = [o for o in operators.values() if o.get("count")]
+            if not stocked:
+                continue
+            rows.append((iso, _PRODUCTS.get(product, product), float(min(o["cost"] for o in stocked)),
+                         sum(int(o["count"]) for o in stocked), names[iso][1]))
+    return {iso: n[0] for iso, n in names.items()}, rows
+
+
+class FiveSim(Provider):
+    name = "5sim"
+    base_url = "https://5sim.net/v1"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.countries = dict(COUNTRIES)    # تُستكمل من /guest/countries عند مزامنة القائمة
+
+    async def _body(self, path):
+        ctype, body = await self._request(path, headers={"Authorization": f"Bearer {self.api_key}",
+                                                         "Accept": "application/json"})
+        if ctype != "application/json":
+            # 5SIM يعيد الأخطاء نصًّا عاديًا
+            if "no free phones" in body or "no product" in body:
+                raise NoNumbers(f"{self.name}: {body.strip()}")
+            raise ProviderError(f"{self.name}: {body.strip()}")
+        return body
+
+    async def _get(self, path):
+        return json.loads(await self._body(path))
+
+    async def buy(self, country, service):
+        if country not in self.countries:
+            raise NoNumbers(f"{self.name}: unsupported {country}/{service}")
+        product = SERVICES.get(service, service)
+        d = await self._get(f"/user/buy/activation/{self.countries[country]}/any/{product}")
+        return Activation(self.name, str(d["id"]), d["phone"], country, service, float(d.get("price") or 0))
+
+    async def catalog(self):
+        countries = await self._body("/guest/countries")
+        prices = await self._body("/guest/prices")
+        try:
+            names, rows = await self._parse(_flatten, countries, prices)
+        except (ValueError, KeyError, TypeError) as e:
+            raise ProviderError(f"{self.name}: bad catalog ({e})")
+        self.countries.update(names)
+        return rows
+
+    @staticmethod
+    def _parse_status(d):
+        sms = d.get("sms") or []
+        code = sms[-1].get("code") if sms else None
+        status = CODE_RECEIVED if code else _STATUS.get(d.get("status"), WAIT_CODE)
+        return status, code
+
+    async def status(self, activation_id):
+        return self._parse_status(await self._get(f"/user/check/{activation_id}"))
+
+    async def cancel(self, activation_id):
+        await self._get(f"/user/cancel/{activation_id}")
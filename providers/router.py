@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# =============== التوجيه بين المزوّدين مع التحويل التلقائي ===============
+import aiohttp
+
+from .base import ProviderError, NoNumbers
+
+
+class ProviderRouter:
+    def __init__(self, providers, connections=100):
+        self.providers = {p.name: p for p in providers}
+        self.connections = connections
+        self.session = None
+
+    async def start(self):
+        # جلسة aiohttp واحدة مشتركة (تجمّع اتصالات) لكل المزوّدين
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections, ttl_dns_cache=300))
+        for p in self.providers.values():
+            p.session = self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def get(self, name):
+        p = self.providers.get(name)
+        if p is None:
+            raise ProviderError(f"unknown provider {name}")
+        return p
+
+    def candidates(self, order):
+        """المزوّدون بالترتيب المطلوب مع استبعاد غير المُعدّين أو ذوي القاطع المفتوح."""
+        return [self.providers[n] for n in order if n in self.providers and self.providers[n].breaker.allow()]
+
+    async def buy(self, country, service, order):
+        errors = []
+        for p in self.candidates(order):
+            try:
+                return await p.buy(country, service)
+            except ProviderError as e:
+                errors.append(e)
+        if not errors:
+            raise ProviderError("no provider available")
+        if all(isinstance(e, NoNumbers) for e in errors):
+            raise NoNumbers("; ".join(map(str, errors)))
+        raise ProviderError("; ".join(map(str, errors)))
+
+    async def status(self, provider, activation_id):
+        return await self.get(provider).status(activation_id)
+
+    async def cancel(self, provider, activation_id):
+        await self.get(provider).cancel(activation_id)
+
+    async def replace(self, provider, activation_id, country, service, order):
+        """إلغاء الرقم الحالي وشراء بديل، مع تفضيل نفس المزوّد ثم البقية."""
+        try:
+            await self.cancel(provider, activation_id)
+        except ProviderError:
+            pass
+        return await self.buy(country, service, [provider] + [n for n in order if n != provider])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# =============== SMS-Activate ===============
+import json
+
+from .base import (Activation, Provider, ProviderError, NoNumbers,
+                   WAIT_CODE, CODE_RECEIVED, CANCELED)
+
+COUNTRIES = {"sa": "53", "eg": "21", "ye": "30", "tr": "62"}
+SERVICES = {"whatsapp": "wa", "telegram": "tg"}
+
+SET_STATUS_CANCEL = "8"
+
+
+_ISO = {v: k for k, v in COUNTRIES.items()}
+_SERVICE = {v: k for k, v in SERVICES.items()}
+
+
+def _flatten(body):
+    """{country_id: {service: {cost, count}}} → صفوف بأكوادنا (ما له مقابل في الجداول أعلاه فقط)."""
+    rows = []
+    for cid, services in json.loads(body).items():
+        iso = _ISO.get(str(cid))
+        if iso is None:
+            continue
+        for code, info in services.items():
+            if code in _SERVICE and info.get("count"):
+                rows.append((iso, _SERVICE[code], float(info["cost"]), int(info["count"]), ""))
+    return rows
+
+
+class SmsActivate(Provider):
+    name = "sms-activate"
+    base_url = "https://api.sms-activate.org/stubs/handler_api.php"
+
+    async def _call(self, action, **params):
+        _, body = await self._request(params={"api_key": self.api_key, "action": action, **params})
+        return body.strip()
+
+    async def buy(self, country, service):
+        if country not in COUNTRIES or service not in SERVICES:
+            raise NoNumbers(f"{self.name}: unsupported {country}/{service}")
+        r = await self._call("getNumber", service=SERVICES[service], country=COUNTRIES[country])
+        if r.startswith("ACCESS_NUMBER:"):
+            _, aid, phone = r.split(":", 2)
+            return Activation(self.name, aid, "+" + phone.lstrip("+"), country, service)
+        if r in ("NO_NUMBERS", "NO_ACTIVATION"):
+            raise NoNumbers(f"{self.name}: {r}")
+        raise ProviderError(f"{self.name}: {r}")
+
+    async def status(self, activation_id):
+        r = await self._call("getStatus", id=activation_id)
+        if r.startswith("STATUS_OK:"):
+            return CODE_RECEIVED, r.split(":", 1)[1]
+        if r == "STATUS_CANCEL":
+            return CANCELED, None
+        if r.startswith("STATUS_WAIT"):
+            return WAIT_CODE, None
+        raise ProviderError(f"{self.name}: {r}")
+
+    async def statuses(self, activation_ids):
+        # نقطة جماعية: كل التفعيلات النشطة في طلب واحد؛ ما لا يظهر فيها
+        # (أُلغي أو انتهى) يُستعلم عنه منفردًا
+        r = await self._call("getActiveActivations")
+        try:
+            active = json.loads(r).get("activeActivations") or []
+        except ValueError:
+            raise ProviderError(f"{self.name}: {r}")
+        by_id = {str(a.get("activationId")): a for a in active}
+        out, missing = {}, []
+        for aid in activation_ids:
+            a = by_id.get(str(aid))
+            if a is None:
+                missing.append(aid)
+                continue
+            codes = a.get("smsCode")
+            code = codes[-1] if isinstance(codes, list) and codes else (codes or None)
+            out[aid] = (CODE_RECEIVED, code) if code else (WAIT_CODE, None)
+        if missing:
+            out.update(await super().statuses(missing))
+        return out
+
+    async def catalog(self):
+        r = await self._call("getPrices")
+        try:
+            return await self._parse(_flatten, r)
+        except ValueError:
+            raise ProviderError(f"{self.name}: {r[:200]}")
+
+    async def cancel(self, activation_id):
+        r = await self._call("setStatus", id=activation_id, status=SET_STATUS_CANCEL)
+        if not r.startswith("ACCESS_CANCEL"):
+            raise ProviderError(f"{self.name}: {r}")
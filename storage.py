@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# =============== تخزين حالات FSM ===============
+# بديل MemoryStorage يحفظ الحالة والبيانات في SQLite (نفس القاعدة، WAL) فلا
+# تضيع الطلبات الجارية عند إعادة التشغيل. القراءات تُخدم من كاش LRU في الذاكرة،
+# والكتابات المتتالية لنفس المستخدم (set_state ثم update_data مثلًا) تُدمج
+# وتُكتب في معاملة واحدة بعد flush_delay. الحالات المهجورة تنتهي بعد ttl.
+# الكاش آمن مع عدة عمليات لأن وضع webhook يثبّت كل مستخدم على عامل واحد.
+import asyncio
+import copy
+import json
+import logging
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+
+from db import read, write
+from metrics import count_error
+
+log = logging.getLogger(__name__)
+
+_UPSERT = """INSERT INTO fsm(chat,user,state,data,updated_at) VALUES(?,?,?,?,?)
+    ON CONFLICT(chat,user) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at"""
+
+
+def _load(con, chat, user):
+    return con.execute("SELECT state,data,updated_at FROM fsm WHERE chat=? AND user=?", (chat, user)).fetchone()
+
+
+def _save(con, rows, deletes, expire_before):
+    if rows:
+        con.executemany(_UPSERT, rows)
+    if deletes:
+        con.executemany("DELETE FROM fsm WHERE chat=? AND user=?", deletes)
+    if expire_before:
+        con.execute("DELETE FROM fsm WHERE updated_at<?", (expire_before,))
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, ttl=86400.0, flush_delay=0.05, cache_size=10000):
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self.cache_size = cache_size
+        self._cache = OrderedDict()     # (chat, user) -> {"state", "data", "ts"}
+        self._dirty = {}
+        self._flush_task = None
+        self._last_sweep = time.time()
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    def _fresh(self, rec):
+        return rec["ts"] >= time.time() - self.ttl
+
+    async def _record(self, chat, user):
+        key = self._key(chat, user)
+        rec = self._dirty.get(key) or self._cache.get(key)
+        if rec is None:
+            row = await read(_load, *key)
+            rec = self._dirty.get(key) or self._cache.get(key)   # ربما حمّله غيرنا أثناء الانتظار
+            if rec is None:
+                rec = {"state": None, "data": {}, "ts": 0.0}
+                if row:
+                    rec = {"state": row[0], "data": json.loads(row[1] or "{}"), "ts": row[2]}
+        if not self._fresh(rec):
+            rec.update(state=None, data={})
+        self._cache[key] = rec
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)   # غير المكتوب بعد يبقى في _dirty
+        return key, rec
+
+    def _touch(self, key, rec):
+        rec["ts"] = time.time()
+        self._dirty[key] = rec
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            count_error("fsm_flush", e)
+            log.exception("FSM flush failed")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        rows, deletes = [], []
+        for (chat, user), rec in dirty.items():
+            if rec["state"] is None and not rec["data"]:
+                deletes.append((chat, user))
+            else:
+                rows.append((chat, user, rec["state"], json.dumps(rec["data"], ensure_ascii=False), rec["ts"]))
+        now = time.time()
+        expire_before = None
+        if now - self._last_sweep > min(self.ttl / 10, 3600):
+            expire_before, self._last_sweep = now - self.ttl, now
+        try:
+            await write(_save, rows, deletes, expire_before)
+        except Exception:
+            for k, v in dirty.items():
+                self._dirty.setdefault(k, v)
+            raise
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, rec = await self._record(chat, user)
+        return rec["state"] if rec["state"] is not None else default
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, rec = await self._record(chat, user)
+        return copy.deepcopy(rec["data"]) if rec["data"] else (default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, rec = await self._record(chat, user)
+        rec["state"] = self.resolve_state(state)
+        self._touch(key, rec)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, rec = await self._record(chat, user)
+        rec["data"] = copy.deepcopy(data) if data else {}
+        self._touch(key, rec)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, rec = await self._record(chat, user)
+        if data is None:
+            data = {}
+        rec["data"].update(data, **kwargs)
+        self._touch(key, rec)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key, rec = await self._record(chat, user)
+        rec["state"] = None
+        if with_data:
+            rec["data"] = {}
+        self._touch(key, rec)
+
+
+def make_storage(kind="sqlite", ttl=86400.0, redis_url=""):
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "redis":
+        try:
+            from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        except ImportError:
+            raise SystemExit("⚠️ FSM_STORAGE=redis يتطلب تثبيت aioredis")
+        u = urlparse(redis_url or "redis://localhost:6379/0")
+        return RedisStorage2(host=u.hostname or "localhost", port=u.port or 6379,
+                             db=int((u.path or "/0").lstrip("/") or 0), password=u.password,
+                             state_ttl=int(ttl), data_ttl=int(ttl))
+    return SQLiteStorage(ttl=ttl)
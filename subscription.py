@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# =============== التحقق من الاشتراك الإجباري ===============
+# كل القنوات تُفحص بالتوازي، والنتائج تُخزَّن لكل (مستخدم، قناة) في كاش LRU
+# محدود الحجم: الإيجابية لمدة ttl والسلبية لمدة قصيرة فقط حتى يعمل زر التحقق.
+# الضغطات المتكررة من نفس المستخدم (وبنفس النوع) تشترك في طلب واحد قيد التنفيذ.
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class SubscriptionChecker:
+    def __init__(self, bot, channels, ttl=300.0, negative_ttl=5.0, maxsize=10000):
+        self.bot = bot
+        self.channels = list(channels)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._cache = OrderedDict()   # (user_id, channel) -> (ok, expires_at)
+        self._inflight = {}           # (user_id, fresh) -> Future
+
+    async def check(self, user_id: int, fresh: bool = False) -> bool:
+        """fresh=True يتجاهل النتائج السلبية المخزنة (لزر «تحقّقت من الاشتراك»)."""
+        # الطلب الطازج لا ينضم لفحص عادي قد يعيد نتيجة سلبية مخزنة
+        key = (user_id, fresh)
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._check(user_id, fresh))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(fut)
+
+    def _cached(self, key, fresh):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        ok, expires = entry
+        if expires < time.monotonic() or (fresh and not ok):
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return ok
+
+    def _store(self, key, ok):
+        self._cache[key] = (ok, time.monotonic() + (self.ttl if ok else self.negative_ttl))
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def _check(self, user_id, fresh):
+        pending = []
+        for ch in self.channels:
+            ok = self._cached((user_id, ch), fresh)
+            if ok is False:
+                return False
+            if ok is None:
+                pending.append(ch)
+        if not pending:
+            return True
+        results = await asyncio.gather(*(self.bot.get_chat_member(ch, user_id) for ch in pending),
+                                       return_exceptions=True)
+        member = True
+        for ch, st in zip(pending, results):
+            if isinstance(st, Exception):
+                # لا نخزّن أخطاء الشبكة/الصلاحيات، فقط نرفض هذه المرة
+                member = False
+                continue
+            ok = st.status not in ("left", "kicked")
+            self._store((user_id, ch), ok)
+            member = member and ok
+        return member
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# =============== الحد من الإغراق وتخفيف الحمل ===============
+# دلو رموز لكل (مستخدم، مجموعة معالجات) في الذاكرة: الطلب والحساب والدعم
+# والإدارة لكلٍّ حدّه. ما يتجاوز الحد يُسقط قبل أن يلمس القاعدة أو تيليجرام؛
+# الضغطة المكررة على نفس الزر تُجاب بـ answer فقط. مراقب تأخر حلقة الأحداث
+# يوقف الأعمال غير الضرورية (تحويل رسائل الدعم) للجميع ما دام التأخر مرتفعًا،
+# وسجلات المستخدمين الخاملين تُحذف دوريًا فتبقى الذاكرة محدودة.
+import asyncio
+import logging
+import time
+
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+THROTTLED = metrics.register(metrics.Counter("bot_throttled_total", "Updates dropped by the throttle", ("group", "reason")))
+
+
+class _User:
+    __slots__ = ("seen", "buckets", "callback")
+
+    def __init__(self, now):
+        self.seen = now
+        self.buckets = {}           # group -> [tokens, last]
+        self.callback = None        # [(message_id, data), started, finished]
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, limits, classify, default="account", shed=("support",), lag_threshold=0.5,
+                 duplicate_window=1.0, idle_ttl=600.0, tick=0.25):
+        super().__init__()
+        self.limits = limits                # group -> (rate/ثانية, burst)
+        self.classify = classify            # (handler, obj) -> group أو None
+        self.default = default
+        self.shed = shed                    # مجموعات تتوقف عند ارتفاع التأخر
+        self.lag_threshold = lag_threshold
+        self.duplicate_window = duplicate_window
+        self.idle_ttl = idle_ttl
+        self.tick = tick
+        self.lag = 0.0
+        self._users = {}
+        self._task = None
+        metrics.register(metrics.Gauge("bot_loop_lag_seconds", "Event loop lag", lambda: round(self.lag, 4)))
+        metrics.register(metrics.Gauge("bot_throttle_users", "Users tracked by the throttle", lambda: len(self._users)))
+
+    @property
+    def shedding(self):
+        return self.lag > self.lag_threshold
+
+    def _allow(self, user, group, now):
+        rate, burst = self.limits.get(group) or self.limits[self.default]
+        b = user.buckets.get(group)
+        if b is None:
+            b = user.buckets[group] = [burst, now]
+        b[0] = min(burst, b[0] + (now - b[1]) * rate)
+        b[1] = now
+        if b[0] < 1:
+            return False
+        b[0] -= 1
+        return True
+
+    def _check(self, obj, user_id, now):
+        """None للسماح، أو سبب الإسقاط."""
+        group = self.classify(current_handler.get(), obj) or self.default
+        if group in self.shed and self.shedding:
+            THROTTLED.inc((group, "shed"))
+            return "shed"
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _User(now)
+        user.seen = now
+        if not self._allow(user, group, now):
+            THROTTLED.inc((group, "rate"))
+            return "rate"
+        return None
+
+    async def on_process_message(self, message, data):
+        if self._check(message, message.from_user.id, time.monotonic()):
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, call, data):
+        now = time.monotonic()
+        user = self._users.get(call.from_user.id)
+        key = (call.message.message_id if call.message else call.inline_message_id, call.data)
+        if user is not None and user.callback is not None and user.callback[0] == key:
+            _, started, finished = user.callback
+            if finished is None or now - finished < self.duplicate_window:
+                THROTTLED.inc(("callback", "duplicate"))
+                await call.answer()
+                raise CancelHandler()
+        reason = self._check(call, call.from_user.id, now)
+        if reason:
+            await call.answer("⏳ ضغطات كثيرة، انتظر لحظة." if reason == "rate" else "⏳ ضغط مرتفع، حاول بعد قليل.")
+            raise CancelHandler()
+        # السجل نفسه في data: post_process يُستدعى أيضًا للضغطات المُلغاة أعلاه
+        self._users[call.from_user.id].callback = data["throttle_callback"] = [key, now, None]
+
+    async def on_post_process_callback_query(self, call, results, data):
+        # فقط الضغطة التي سجّلت user.callback تختمه؛ المكررة لا تنهي الأصلية الجارية
+        own = data.get("throttle_callback")
+        if own is not None and own[2] is None:
+            own[2] = time.monotonic()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def sweep(self, now):
+        idle = [uid for uid, u in self._users.items() if now - u.seen > self.idle_ttl]
+        for uid in idle:
+            del self._users[uid]
+        return len(idle)
+
+    async def _run(self):
+        # التأخر = كم تأخر استيقاظ sleep عن موعده؛ يهبط تدريجيًا حتى لا يتذبذب الإسقاط
+        last_sweep = time.monotonic()
+        while True:
+            t = time.monotonic()
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            lag = max(0.0, now - t - self.tick)
+            was = self.shedding
+            self.lag = max(lag, self.lag * 0.8)
+            if self.shedding != was:
+                log.warning("event loop lag %.3fs: shedding %s", self.lag, "on" if self.shedding else "off")
+            if now - last_sweep > min(60.0, self.idle_ttl):
+                self.sweep(now)
+                last_sweep = now
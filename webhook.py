@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# =============== وضع Webhook متعدد العمليات ===============
+# عملية أمامية واحدة تستقبل تحديثات تيليجرام على المنفذ العام وتوزّعها على
+# N عملية عاملة حسب user_id (user_id % N)، فيبقى كل مستخدم على نفس العامل.
+# داخل كل عملية تُعالَج التحديثات بتوازٍ محدود، مع الحفاظ على ترتيب تحديثات
+# المستخدم الواحد (طابور لكل مستخدم). الأمامية لا ترد على تيليجرام بـ200 إلا
+# بعد أن يستلم العامل التحديث، فلا يضيع تحديث عند تعطّل عامل. مع عامل واحد
+# لا توجد عملية أمامية.
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_UPDATE_KINDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                 "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+                 "chat_join_request", "channel_post", "edited_channel_post")
+
+
+def update_key(data: dict) -> int:
+    """مفتاح الترتيب: آيدي المستخدم (أو المحادثة) صاحب التحديث."""
+    for kind in _UPDATE_KINDS:
+        obj = data.get(kind)
+        if obj:
+            user = obj.get("from") or obj.get("user")
+            if user:
+                return user["id"]
+            chat = obj.get("chat")
+            if chat:
+                return chat["id"]
+    return data.get("update_id", 0)
+
+
+class KeyedScheduler:
+    """توازٍ محدود بين المفاتيح، وتنفيذ تسلسلي لعناصر المفتاح الواحد."""
+
+    def __init__(self, handler, concurrency=64, max_pending=10000):
+        self.handler = handler
+        self.sem = asyncio.Semaphore(concurrency)
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lanes = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def submit(self, key, item) -> bool:
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        self._idle.clear()
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque([item])
+            asyncio.get_running_loop().create_task(self._drain(key, lane))
+        else:
+            lane.append(item)
+        return True
+
+    async def _drain(self, key, lane):
+        try:
+            while lane:
+                async with self.sem:
+                    try:
+                        await self.handler(lane[0])
+                    except Exception:
+                        log.exception("update handling failed")
+                lane.popleft()
+                self.pending -= 1
+        finally:
+            del self._lanes[key]
+            if not self._lanes:
+                self._idle.set()
+
+    async def join(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _receiver(scheduler, secret, confirm=False):
+    async def handle(request: web.Request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        data = await request.json()
+        if not confirm:
+            if not scheduler.submit(update_key(data), data):
+                # مزدحم: تيليجرام سيعيد إرسال التحديث لاحقًا
+                return web.Response(status=503)
+            return web.Response()
+        # الأمامية: لا نرد 200 قبل أن يستلم العامل التحديث، وإلا ضاع عند تعطّله
+        done = asyncio.get_running_loop().create_future()
+        if not scheduler.submit(update_key(data), (data, done)) or not await done:
+            return web.Response(status=503)
+        return web.Response()
+    return handle
+
+
+def worker_app(dp: Dispatcher, path, secret="", concurrency=64):
+    """تطبيق العامل ومُجدوله: يستقبل التحديثات ويعالجها بترتيب كل مستخدم."""
+    async def process(data):
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        # مهمة لكل تحديث كما في executor: aiogram يحفظ حالة المعالجة في ContextVar،
+        # وتحديثات المستخدم الواحد تمر تباعًا في نفس مهمة الطابور
+        await asyncio.create_task(dp.process_update(types.Update(**data)))
+
+    scheduler = KeyedScheduler(process, concurrency)
+    app = web.Application()
+    app.router.add_post(path, _receiver(scheduler, secret))
+    return app, scheduler
+
+
+def run_worker(dp: Dispatcher, host, port, path, secret="", concurrency=64,
+               on_startup=None, on_shutdown=None, webhook_url=None):
+    """عملية تعالج التحديثات بنفسها (عامل خلف الأمامية، أو خادم وحيد إن أُعطي webhook_url)."""
+    app, scheduler = worker_app(dp, path, secret, concurrency)
+
+    async def startup(_):
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        if on_startup:
+            await on_startup(dp)
+        if webhook_url:
+            await dp.bot.set_webhook(webhook_url, secret_token=secret or None)
+
+    async def shutdown(_):
+        await scheduler.join(timeout=10)
+        if on_shutdown:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await dp.bot.get_session()).close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=host, port=port, print=None)
+
+
+def front_app(urls, path, secret="", concurrency=256, attempts=3):
+    """تطبيق الأمامية: كل تحديث لعامل مستخدمه (user_id % N) بالترتيب، ويُرد على
+    تيليجرام بـ200 فقط بعد أن يقبله العامل؛ وإلا 503 فيعيد تيليجرام إرساله."""
+    session = None
+
+    async def forward(item):
+        data, done = item
+        url = urls[update_key(data) % len(urls)]
+        ok = False
+        try:
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(0.2 * 2 ** (attempt - 1))
+                try:
+                    async with session.post(url, json=data, headers={SECRET_HEADER: secret}) as r:
+                        if r.status == 200:
+                            ok = True
+                            return
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+            log.warning("update %s not forwarded: worker %s unavailable, Telegram will redeliver",
+                        data.get("update_id"), url)
+        finally:
+            if not done.done():
+                done.set_result(ok)
+
+    scheduler = KeyedScheduler(forward, concurrency)
+    app = web.Application()
+    app.router.add_post(path, _receiver(scheduler, secret, confirm=True))
+
+    async def startup(_):
+        nonlocal session
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+
+    async def shutdown(_):
+        await scheduler.join(timeout=10)
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
+
+
+def run_front(bot: Bot, host, port, path, secret, webhook_url, workers, concurrency=256):
+    """العملية الأمامية: تشغّل العمال وتمرّر لكل منهم تحديثات مستخدميه بالترتيب.
+    العامل الذي يخرج فجأة يُعاد تشغيله حتى لا يبقى مستخدموه على 503."""
+    urls = [f"http://127.0.0.1:{port + 1 + i}{path}" for i in range(workers)]
+    procs = {}       # رقم العامل -> (العملية، وقت التشغيل)
+    app = front_app(urls, path, secret, concurrency)
+    supervisor = None
+    closing = False
+
+    def spawn(i):
+        if closing:
+            return
+        env = dict(os.environ, BOT_MODE="worker", WORKER_INDEX=str(i), WORKER_PORT=str(port + 1 + i))
+        procs[i] = (subprocess.Popen([sys.executable, sys.argv[0]], env=env), time.monotonic())
+
+    async def supervise():
+        backoff = [1.0] * workers
+        while True:
+            await asyncio.sleep(1)
+            for i, (p, started) in list(procs.items()):
+                code = p.poll()
+                if code is None:
+                    continue
+                # انهيار سريع بعد التشغيل: ننتظر أطول قبل المحاولة التالية
+                backoff[i] = min(backoff[i] * 2, 30.0) if time.monotonic() - started < 30 else 1.0
+                log.error("worker %d exited with code %s, restarting in %.0fs", i, code, backoff[i])
+                del procs[i]
+                asyncio.get_running_loop().call_later(backoff[i], spawn, i)
+
+    async def stop(p):
+        loop = asyncio.get_running_loop()
+        p.terminate()
+        try:
+            await asyncio.wait_for(loop.run_in_executor(None, p.wait), 10)
+        except asyncio.TimeoutError:
+            log.warning("worker pid %d did not stop in 10s, killing", p.pid)
+            p.kill()
+            await loop.run_in_executor(None, p.wait)
+
+    async def startup(_):
+        nonlocal supervisor
+        for i in range(workers):
+            spawn(i)
+        supervisor = asyncio.create_task(supervise())
+        await bot.set_webhook(webhook_url, secret_token=secret or None)
+
+    async def shutdown(_):
+        nonlocal closing
+        closing = True
+        supervisor.cancel()
+        await (await bot.get_session()).close()
+        await asyncio.gather(*(stop(p) for p, _ in list(procs.values())))
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=host, port=port, print=None)